@@ -1,16 +1,40 @@
-import ast
 import asyncio
-from functools import lru_cache
+from functools import lru_cache, partial
 import logging
-import re
 import sys
-from typing import Any, Dict, List, AsyncGenerator, Optional, TypedDict
+import time
+from typing import Any, Dict, List, AsyncGenerator, Literal, Optional, Set
 
+_genai_import_started = time.perf_counter()
 from google import genai
 from google.genai import types
+# Reported by /ready: the SDK is the heaviest import of a worker's cold start. It stays eager, since
+# `types` is needed on every request path and deferring it would only move the cost onto the first user.
+GENAI_IMPORT_SECONDS = time.perf_counter() - _genai_import_started
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import Field, SecretStr
 from models import HistoryItem
+from response_cache import ResponseCache, StreamCache, build_cache_backend, make_cache_key
+from single_flight import SingleFlight, StreamFanout
+from client_pool import ClientPool, Lease, LeasedStream, PooledKey, build_genai_client
+from rate_limiter import RateLimitExceeded, RateLimiter, estimate_tokens
+from scheduler import Priority, SchedulerRejected, Ticket, UpstreamScheduler
+from disconnect import CancellationTracker, ClientDisconnected, cancel_on_disconnect, run_until_disconnect
+from resumable_streams import ResumableStreams
+from usage import BudgetExceeded, TokenBudgets, UsageMeter, empty_usage, usage_from_metadata
+from embeddings import EmbeddingBatcher, EmbeddingSpace, EmbeddingStore, pack_vector
+from json_stream import IncrementalJSONParser, StructuredOutputError, parse_document
+from retry_policy import CircuitOpenError, DeadlineExceededError, RetryEngine, RetryPolicy
+from model_router import AUTO_MODEL, ModelRouter
+from model_registry import ModelRegistry
+from history_compaction import HistoryCompactor, estimate_item_tokens
+from error_classifier import ErrorData, classify_error
+from metrics import UPSTREAM_DURATION, UPSTREAM_ERRORS, start_span
+from sessions import Session, SessionNotFound, SessionStore, build_session_store
+from shared_state import (
+    SharedCacheBackend, SharedModelRateLimiter, SharedSingleFlight, SharedTokenBudgets,
+    default_socket_path, shared_state_client, worker_bootstrap
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,29 +45,186 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# How long a worker may hold a session's context-cache refresh before another can take it over
+CONTEXT_CACHE_CLAIM_SECONDS = 120.0
+
+# Context-cache refreshes running after the reply; referenced here so they aren't garbage collected
+_CACHE_REFRESHES: Set[asyncio.Task] = set()
+
 # --- 1. Configuration Layer (STAYS UNCHANGED) ---
 
 class Settings(BaseSettings):
     gemini_api_key: SecretStr = Field(..., alias="GEMINI_API_KEY")
+    # Extra keys/projects to spread load over, e.g. GEMINI_API_KEYS='["key-b", "key-c"]'
+    gemini_api_keys: List[SecretStr] = Field(default_factory=list, alias="GEMINI_API_KEYS")
+    key_rate_limited_cooldown: float = Field(default=10.0)
+    key_tier_blocked_cooldown: float = Field(default=600.0)
+
+    # Upstream HTTP connection pool, per key
+    http_max_connections: int = Field(default=200)
+    http_max_keepalive: int = Field(default=100)
+    http_keepalive_expiry: float = Field(default=30.0)
+    http2_enabled: bool = Field(default=True)
     gemini_model: str = Field(default="gemini-2.5-flash-lite")
+    # "fake" swaps Gemini for benchmarks/fake_genai.py (configured via FAKE_GENAI_CONFIG) for load tests
+    llm_backend: Literal["gemini", "fake"] = Field(default="gemini")
+
+    # Response cache for /complete
+    # Under serve.py with several workers, "memory" means the coordinator's memory shared by all of them
+    response_cache_backend: Literal["memory", "redis"] = Field(default="memory")
+    response_cache_ttl: float = Field(default=300.0)
+    response_cache_max_bytes: int = Field(default=32 * 1024 * 1024)
+    response_cache_max_entries: int = Field(default=10_000)
+    redis_url: Optional[str] = Field(default=None, alias="REDIS_URL")
+
+    # Replay cache for /stream and /stream/sse (shares the response cache backend)
+    stream_cache_enabled: bool = Field(default=True)
+    stream_cache_record_timing: bool = Field(default=True)
+    stream_cache_replay_paced: bool = Field(default=False)
+
+    # Stream framing: "fast" uses pre-encoded framing, "classic" the original formatters.
+    # Per-endpoint overrides, e.g. STREAM_FORMATTER_ENDPOINT_ENGINES='{"/stream/sse": "classic"}'
+    stream_formatter_engine: Literal["classic", "fast"] = Field(default="fast")
+    stream_formatter_endpoint_engines: Dict[str, Literal["classic", "fast"]] = Field(default_factory=dict)
+
+    # Default chunk coalescing for streams; clients can override it with X-Flush-Policy
+    stream_flush_policy: Literal["immediate", "balanced", "throughput"] = Field(default="balanced")
+
+    # Response compression (br/zstd need the optional brotli/zstandard packages)
+    compression_enabled: bool = Field(default=True)
+    compression_min_size: int = Field(default=1024)
+    compression_preference: List[str] = Field(default_factory=lambda: ["zstd", "br", "gzip"])
+    compression_gzip_level: int = Field(default=5)
+    compression_brotli_quality: int = Field(default=4)
+    compression_zstd_level: int = Field(default=3)
+    # Shared SSE/NDJSON framing dictionary (Content-Encoding: dcz), served at /compression/dictionary
+    compression_dictionary_enabled: bool = Field(default=False)
+
+    # Single-flight fan-out of identical streams
+    stream_fanout_queue_size: int = Field(default=256)
+
+    # Client-side admission control, e.g. RATE_LIMIT_MODEL_BUDGETS='{"gemini-2.5-flash": {"rpm": 10, "tpm": 250000}}'
+    # Opt-in: models without an RPM budget (and no default RPM) are only limited by Gemini itself
+    rate_limit_default_rpm: Optional[int] = Field(default=None, gt=0)
+    rate_limit_default_tpm: int = Field(default=1_000_000, gt=0)
+    rate_limit_model_budgets: Dict[str, Dict[str, int]] = Field(default_factory=dict)
+    rate_limit_max_wait: float = Field(default=2.0)
+    rate_limit_max_queue: int = Field(default=100)
+    # Requests a full bucket lets through at once, in seconds of the RPM budget
+    rate_limit_burst_seconds: float = Field(default=10.0)
+
+    # Retries, circuit breaking and hedging of upstream calls
+    retry_max_attempts: int = Field(default=3)
+    retry_base_delay: float = Field(default=0.25)
+    retry_max_delay: float = Field(default=4.0)
+    # Bounds opening a stream or an embedding call; full completions are never cut short, only not retried past it
+    retry_deadline: float = Field(default=30.0)
+    breaker_failure_threshold: int = Field(default=5)
+    breaker_reset_timeout: float = Field(default=30.0)
+    hedge_enabled: bool = Field(default=True)
+    hedge_quantile: float = Field(default=0.95)
+    hedge_min_delay: float = Field(default=0.5)
+
+    # Background model availability refresh
+    models_refresh_interval: float = Field(default=300.0)
+    models_reload_check_interval: float = Field(default=5.0)
+    # Inconclusive pings (429, timeout, 5xx) in a row before a model is hidden
+    models_max_ping_failures: int = Field(default=3)
+    models_cache_max_age: int = Field(default=60)
+
+    # Token-aware history compaction
+    history_compaction_enabled: bool = Field(default=True)
+    history_token_budget: int = Field(default=32_000)
+    history_model_budgets: Dict[str, int] = Field(default_factory=dict)
+    history_keep_recent_turns: int = Field(default=6)
+    history_summary_block: int = Field(default=8)
+    history_summary_model: str = Field(default="gemini-2.5-flash-lite")
+    history_summary_max_tokens: int = Field(default=512)
+
+    # Server-side sessions and Gemini context caching of their stable prefix
+    session_backend: Literal["memory", "sqlite"] = Field(default="memory")
+    session_sqlite_path: str = Field(default="data/sessions.sqlite3")
+    session_ttl: float = Field(default=3600.0)
+    session_max_sessions: int = Field(default=10_000)
+    context_cache_enabled: bool = Field(default=True)
+    context_cache_min_tokens: int = Field(default=4096)
+    context_cache_ttl: int = Field(default=3600)
+
+    # POST /batch
+    batch_max_concurrency: int = Field(default=8)
+    batch_max_items: int = Field(default=10_000)
+    batch_poll_interval: float = Field(default=30.0)
+
+    # Multi-worker entry point (serve.py); 0 workers means one per CPU core
+    workers: int = Field(default=0)
+    # Defaults to a per-user directory ($XDG_RUNTIME_DIR/llm-api, else /tmp/llm-api-<uid>)
+    shared_state_socket: str = Field(default_factory=default_socket_path)
+    shared_flight_ttl: float = Field(default=60.0)
+
+    # Upstream scheduler: bounded slots per model, priority classes, fair share per API consumer
+    scheduler_enabled: bool = Field(default=True)
+    scheduler_default_concurrency: int = Field(default=32)
+    scheduler_model_concurrency: Dict[str, int] = Field(default_factory=dict)
+    scheduler_max_queue: int = Field(default=256)
+    scheduler_max_queue_per_tenant: int = Field(default=32)
+    scheduler_max_wait: Dict[str, float] = Field(default_factory=lambda: {"interactive": 5.0, "standard": 15.0, "batch": 60.0})
+    scheduler_tenant_weights: Dict[str, float] = Field(default_factory=dict)
+
+    # How often a waiting request checks whether its client is still connected
+    disconnect_poll_interval: float = Field(default=0.5)
+
+    # SSE Last-Event-ID / NDJSON offset resumption; a stream keeps running this long without readers
+    resumable_streams_enabled: bool = Field(default=True)
+    resumable_stream_ttl: float = Field(default=120.0)
+    resumable_max_streams: int = Field(default=1000)
+    resumable_stream_max_chars: int = Field(default=256_000)
+    resumable_detach_grace: float = Field(default=10.0)
+
+    # Startup warm-up: connections opened per key before /ready turns green
+    warmup_enabled: bool = Field(default=True)
+    warmup_connections: int = Field(default=4)
+    warmup_timeout: float = Field(default=10.0)
+
+    # Embeddings: concurrent requests share upstream calls (max_batch texts, or after linger seconds)
+    embedding_model: str = Field(default="gemini-embedding-001")
+    embedding_dimensions: int = Field(default=768)
+    embedding_max_batch: int = Field(default=100)
+    embedding_batch_linger: float = Field(default=0.005)
+    # Per-text input limit of the embedding model; longer texts are refused before batching
+    embedding_max_input_tokens: int = Field(default=2048)
+    # Float32 vectors memory-mapped from disk, keyed by a hash of the text
+    embedding_cache_enabled: bool = Field(default=True)
+    embedding_cache_dir: str = Field(default="data/embeddings")
+
+    # Token usage per model/client/endpoint, appended to a JSONL log (empty path: in memory only)
+    usage_log_path: str = Field(default="data/usage.jsonl")
+    usage_flush_interval: float = Field(default=30.0)
+    # Tokens per client (hashed X-API-Key, else address; never X-Client-Id) per window; no default = unlimited
+    token_budget_default: Optional[int] = Field(default=None)
+    token_budget_clients: Dict[str, int] = Field(default_factory=dict)
+    token_budget_window: float = Field(default=86400.0)
+
+    # Cross-model fallback; model_name="auto" picks the fastest healthy model
+    model_fallback_chains: Dict[str, List[str]] = Field(default_factory=lambda: {
+        "gemini-2.5-flash-lite": ["gemini-2.5-flash", "gemini-3.1-flash-lite-preview"],
+        "gemini-2.5-flash": ["gemini-2.5-flash-lite", "gemini-3-flash-preview"],
+    })
+    # Share of "auto" requests that try a model other than the fastest, to keep measuring them
+    model_router_explore_rate: float = Field(default=0.05)
     
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 @lru_cache
 def get_settings() -> Settings:
     """Remains cached to avoid redundant .env reads."""
+    bootstrap = worker_bootstrap()
+    if bootstrap is not None:
+        # A serve.py worker: the supervisor already loaded and validated the settings once
+        return Settings(**bootstrap["settings"])
     return Settings() 
 
 # --- 2. Error Handling ---
 
-class ErrorData(TypedDict):
-    public_message:str
-    status_code:int
-    is_retryable:bool
-    raw_info:str
-    internal_message:str
-    
-
 class LLMServiceError(Exception):
     def __init__(self, *, internal_message: str, public_message: str, status_code: int, raw_response: str, is_retryable:bool):
         self.internal_message = internal_message
@@ -53,99 +234,500 @@ class LLMServiceError(Exception):
         self.is_retryable = is_retryable
         super().__init__(internal_message)
 
+    def to_error_data(self) -> ErrorData:
+        return {
+            "public_message": self.public_message,
+            "status_code": self.status_code,
+            "is_retryable": self.is_retryable,
+            "raw_info": self.raw_response,
+            "internal_message": self.internal_message,
+        }
+
+
+class LocalRateLimitError(LLMServiceError):
+    """A request shed by our own limiter; retrying it immediately would only add pressure."""
+
+
+class ClientDisconnectedError(LLMServiceError):
+    """The client left before the answer was ready; the upstream call was cancelled."""
+
+
+class BudgetExceededError(LLMServiceError):
+    """The client's token budget for the current window is spent; checked before any upstream call."""
+
+async def _close_stream(stream: Any) -> None:
+    """Closes an upstream stream that nobody is going to read."""
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        try:
+            await aclose()
+        except Exception as e:
+            logger.warning(f"Failed to close discarded stream: {e}")
+
 # --- 3. The Modernized LLM Service ---
 
 class LLMService:
-    def __init__(self, api_key: str, default_model: str):
-        # We initialize the Client once per service instance
-        self.client = genai.Client(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        default_model: str,
+        response_cache: Optional[ResponseCache] = None,
+        stream_cache: Optional[StreamCache] = None,
+        stream_cache_replay_paced: bool = False,
+        stream_fanout_queue_size: int = 256,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_engine: Optional[RetryEngine] = None,
+        model_fallback_chains: Optional[Dict[str, List[str]]] = None,
+        model_router_explore_rate: float = 0.05,
+        model_registry: Optional[ModelRegistry] = None,
+        history_compactor: Optional[HistoryCompactor] = None,
+        history_summary_model: Optional[str] = None,
+        session_store: Optional[SessionStore] = None,
+        context_cache_min_tokens: Optional[int] = None,
+        context_cache_ttl: int = 3600,
+        client: Optional[Any] = None,
+        client_pool: Optional[ClientPool] = None,
+        complete_flight: Optional[SingleFlight] = None,
+        scheduler: Optional[UpstreamScheduler] = None,
+        disconnect_poll_interval: float = 0.5,
+        resumable_streams: Optional[ResumableStreams] = None,
+        embedding_model: str = "gemini-embedding-001",
+        embedding_store: Optional[EmbeddingStore] = None,
+        embedding_max_batch: int = 100,
+        embedding_batch_linger: float = 0.005,
+        embedding_max_input_tokens: int = 2048,
+        usage_meter: Optional[UsageMeter] = None,
+        token_budgets: Optional[TokenBudgets] = None
+    ):
+        # We initialize the Client once per service instance (one per key when pooling)
+        if client_pool is None:
+            client_pool = ClientPool([PooledKey("key-0", client or genai.Client(api_key=api_key), rate_limiter)])
+        self.client_pool = client_pool
+        self.client = client_pool.primary.client
         self.default_model = default_model
+        self.response_cache = response_cache
+        self.stream_cache = stream_cache
+        self.stream_cache_replay_paced = stream_cache_replay_paced
+        self.complete_flight = complete_flight or SingleFlight()
+        self.scheduler = scheduler
+        self.cancellations = CancellationTracker()
+        self.disconnect_poll_interval = disconnect_poll_interval
+        self.resumable_streams = resumable_streams
+        self.embedding_model = embedding_model
+        self.embedding_store = embedding_store
+        self.embedding_max_input_tokens = embedding_max_input_tokens
+        self.embedding_batcher = EmbeddingBatcher(
+            self._embed_batch,
+            embedding_max_batch,
+            embedding_batch_linger,
+            # A client error for the whole call is usually one bad text among other requests' texts
+            split_on=lambda e: 400 <= getattr(e, "status_code", 0) < 500 and e.status_code != 429
+        )
+        self.usage_meter = usage_meter or UsageMeter()
+        self.token_budgets = token_budgets
+        self.stream_fanout = StreamFanout(max_queue_size=stream_fanout_queue_size)
+        self.retry_engine = retry_engine
+        self.model_registry = model_registry or ModelRegistry()
+        self.model_router = ModelRouter(
+            default_model,
+            fallback_chains=model_fallback_chains,
+            model_ids=self.model_registry.model_ids,
+            is_available=self._model_is_available,
+            explore_rate=model_router_explore_rate
+        )
+        self.history_compactor = history_compactor
+        self.history_summary_model = history_summary_model or default_model
+        self.session_store = session_store
+        # None disables Gemini context caching for sessions
+        self.context_cache_min_tokens = context_cache_min_tokens
+        self.context_cache_ttl = context_cache_ttl
         logger.info(f"LLMService initialized with default model: {default_model}")
 
 
     @staticmethod
     def extract_error_details(raw_error_val: Any) -> ErrorData:
+        """Classifies a provider exception; one we already classified passes through untouched."""
+        if isinstance(raw_error_val, LLMServiceError):
+            return raw_error_val.to_error_data()
+        return classify_error(raw_error_val)
 
-        raw_error_str= str(raw_error_val)
 
-        # Default: Assume a generic server-side issue
-        errorData:ErrorData = {
-            "public_message":"An AI provider error occurred.",
-            "status_code":500,
-            "is_retryable":True,
-            "raw_info":raw_error_str,
-            "internal_message":raw_error_str
-        }
-        
-        try:
-            # \{.*\} means "Find the first { and match everything until the last }"
-            match = re.search(r"\{.*\}", raw_error_str, re.DOTALL)
+    # --- Methods ---
 
-            if match:
-                dict_str = match.group(0)                
+    async def get_complete(
+        self, 
+        prompt: str,
+        **kwargs
+    ) -> str:
+        """Full response implementation."""
+        session = await self._load_session(kwargs.get("session_id"))
+        history = session.turns if session is not None else kwargs.get("history")
+        contents = self._prepare_contents(prompt, history = history)
+        requested_model = kwargs.get("model_name") or self.default_model
+        temperature = kwargs.get("temperature")
+        output = self.output_options(kwargs)
+        request_key = make_cache_key(contents, requested_model, temperature, output)
+        # `tenant` is who pays (budgets, usage); `consumer` who queues (fair share), defaulting to the tenant
+        tenant = kwargs.get("tenant")
+        slot = (kwargs.get("consumer") or tenant, kwargs.get("priority", Priority.standard))
+        endpoint = kwargs.get("endpoint", "/complete")
+        # Filled in for the caller: the tokens this request used upstream, or where it was served from
+        usage = kwargs["usage"] if kwargs.get("usage") is not None else {}
+        started = time.monotonic()
 
-                # We use literal_eval because the SDK uses single quotes '
-                error_dict = ast.literal_eval(dict_str)
+        async def _record_upstream(model: str, upstream_usage: Dict[str, Any]) -> None:
+            usage.update(upstream_usage, model=model)
+            await self._record_usage(model, tenant, endpoint, upstream_usage)
 
-                nested_msg = error_dict.get('error', {}).get('message', "")
-                lowercase_msg = nested_msg.lower()
+        result = None
+        reserved = 0
+        try:
+            if self.response_cache is not None:
+                result = await self.response_cache.get(request_key)
 
-                if any(word in lowercase_msg for word in ["temperature", "invalid", "400"]):
-                    errorData["public_message"] = nested_msg.split(':')[-1].strip()
-                    errorData["status_code"] = 400
-                    errorData["is_retryable"] = False
+            if result is None:
+                reserved = await self._reserve_budget(tenant, contents)
+                config = types.GenerateContentConfig(temperature = temperature, **output)
 
-                elif "tier" in lowercase_msg or "limit: 0" in lowercase_msg:
-                    errorData["public_message"] = "The selected model is unavailable on this account tier."
-                    errorData["status_code"] = 429
-                    errorData["is_retryable"] = False
+                generate = lambda: self._generate_complete(
+                    request_key, requested_model, contents, config, session, slot, on_usage=_record_upstream, tenant=tenant
+                )
+                # Identical concurrent requests share a single upstream call, except on a session:
+                # each request appends its own answer, so a shared one would be stored twice
+                result = await self._unless_disconnected(
+                    generate() if session is not None else self.complete_flight.do(request_key, generate),
+                    kwargs.get("is_disconnected"),
+                    requested_model
+                )
+                if not usage:
+                    usage.update(empty_usage("shared"))
+            else:
+                usage.update(empty_usage("cache"))
+        finally:
+            await self._finish_request(usage.get("model", requested_model), tenant, endpoint, started, reserved)
 
-                elif any(word in lowercase_msg for word in ["quota", "limit", "429"]):
-                    errorData["public_message"] = "Rate limit reached. Please wait a moment."
-                    errorData["status_code"] = 429
-                    errorData["is_retryable"] = True
-                else:
-                    if nested_msg:
-                        errorData["public_message"] = nested_msg
+        if session is not None:
+            await self._append_session_turns(session, prompt, result, requested_model)
 
-                return errorData
+        return result
 
-        except Exception as e:
-            logger.error(f"Surgical parsing failed, falling back to 500: {e}")
-            pass
+    @staticmethod
+    def output_options(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """GenerateContentConfig fields for JSON mode / a response schema; empty for plain text."""
+        schema = kwargs.get("response_schema")
+        if schema is None and kwargs.get("response_format") != "json":
+            return {}
+        options: Dict[str, Any] = {"response_mime_type": "application/json"}
+        if schema is not None:
+            options["response_json_schema"] = schema
+        return options
 
-        return errorData
+    @staticmethod
+    def parse_structured(text: str, schema: Optional[Dict[str, Any]] = None) -> Any:
+        """JSON-mode output parsed and validated; a 502 when it is empty, malformed or off-schema."""
+        try:
+            return parse_document(text, schema)
+        except StructuredOutputError as e:
+            raise LLMServiceError(
+                public_message = "The model returned malformed structured output.",
+                internal_message = f"{e} {e.errors}",
+                status_code = 502,
+                raw_response = text[:1000],
+                is_retryable = True
+            )
 
+    async def _unless_disconnected(self, awaitable, is_disconnected, requested_model: str) -> Any:
+        """Awaits `awaitable`, cancelling it (and the upstream call once nobody else shares it) if the client leaves."""
+        if is_disconnected is None:
+            return await awaitable
 
-    # --- Methods ---
+        try:
+            return await run_until_disconnect(
+                awaitable, is_disconnected, self.cancellations, requested_model, self.disconnect_poll_interval
+            )
+        except ClientDisconnected as e:
+            raise ClientDisconnectedError(
+                public_message = "The client closed the request.",
+                internal_message = str(e),
+                status_code = 499,
+                raw_response = str(e),
+                is_retryable = False
+            )
 
-    async def get_complete(
-        self, 
-        prompt: str,
-        **kwargs
+    async def _generate_complete(
+        self,
+        request_key: str,
+        requested_model: str,
+        contents: list,
+        config,
+        session: Optional[Session] = None,
+        slot: tuple = (None, Priority.standard),
+        on_usage = None,
+        tenant: Optional[str] = None
     ) -> str:
-        """Full response implementation."""
-        contents = self._prepare_contents(prompt, history = kwargs.get("history"))
-        config = types.GenerateContentConfig(temperature = kwargs.get("temperature"))
+        """The actual upstream call behind get_complete, with retries and model fallback."""
+        contents, config, models = await self._prepare_upstream(contents, config, requested_model, session, (tenant, slot))
+
+        async def _call_model(model: str):
+            # The slot is held across retries so a retrying request doesn't requeue behind everyone
+            ticket = await self._schedule(model, *slot)
+            try:
+                return await self._run_with_retries(
+                    model, lambda: self._attempt_complete(model, contents, config), operation="complete", bounded=False
+                )
+            finally:
+                if ticket is not None:
+                    ticket.release()
+
+        target_model, response, started = await self._with_fallback(requested_model, _call_model, models=models)
+        self.model_router.record_success(target_model, latency=time.monotonic() - started)
+        if on_usage is not None:
+            await on_usage(target_model, usage_from_metadata(getattr(response, "usage_metadata", None)))
+
+        if config.response_mime_type == "application/json":
+            # Empty or malformed structured output is reported, never cached, and not retried automatically
+            LLMService.parse_structured(response.text or "", config.response_json_schema)
+        elif not response.text:
+            return "No response generated."
+
+        # Only real answers are cached, never the empty-response placeholder
+        if self.response_cache is not None:
+            await self.response_cache.set(request_key, response.text)
+
+        return response.text
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Live counters of the service's internal layers, for monitoring."""
+        return {
+            "response_cache": self.response_cache.stats() if self.response_cache else None,
+            "stream_cache": self.stream_cache.stats() if self.stream_cache else None,
+            "complete_flight": self.complete_flight.stats(),
+            "stream_fanout": self.stream_fanout.stats(),
+            "client_pool": self.client_pool.snapshot(),
+            "scheduler": self.scheduler.snapshot() if self.scheduler else None,
+            "cancellations": self.cancellations.stats(),
+            "resumable_streams": self.resumable_streams.stats() if self.resumable_streams else None,
+            "usage": self.usage_meter.stats(),
+            "token_budgets": self.token_budgets.stats() if self.token_budgets else None,
+            "embeddings": {
+                "batcher": self.embedding_batcher.stats(),
+                "store": self.embedding_store.stats() if self.embedding_store else None,
+            },
+            "retry_engine": self.retry_engine.snapshot() if self.retry_engine else None,
+            "model_router": self.model_router.snapshot(),
+            "model_registry": self.model_registry.status(),
+            "history_compactor": self.history_compactor.stats() if self.history_compactor else None,
+            "sessions": self.session_store.stats() if self.session_store else None,
+        }
+
+    async def _attempt_complete(self, target_model: str, contents: list, config) -> Any:
+        """A single upstream generate_content attempt."""
+        with (await self._admit(target_model, contents, config)) as lease:
+            started = time.perf_counter()
+            try:
+                with start_span("gemini.generate_content", model=target_model, key=lease.key.name):
+                    response = await lease.key.client.aio.models.generate_content(
+                        model= target_model,
+                        contents=contents,
+                        config=config
+                    )
+            except Exception as e: 
+                raise self._upstream_error(target_model, e, lease.key)
+            finally:
+                UPSTREAM_DURATION.labels(target_model, "generate_content").observe(time.perf_counter() - started)
+
+            self._record_outcome(target_model, key=lease.key)
+            return response
+
+    async def _with_fallback(
+        self,
+        requested_model: str,
+        call_model,
+        streaming: bool = False,
+        models: Optional[List[str]] = None
+    ) -> tuple:
+        """
+            Tries `call_model(model)` along the router's candidates (or the pinned `models`)
+            until one succeeds. Returns (model, result, started) where `started` is when
+            that model was tried.
+        """
+        candidates = models or self.model_router.candidates(requested_model, streaming=streaming)
+        last_error: Optional[LLMServiceError] = None
+
+        for target_model in candidates:
+            started = time.monotonic()
+            try:
+                result = await call_model(target_model)
+            except LocalRateLimitError:
+                # Shed by our own limiter or scheduler: says nothing about the model, and moving on would bypass fair queuing
+                raise
+            except LLMServiceError as e:
+                self.model_router.record_error(target_model)
+                if not self.model_router.should_fall_back(e):
+                    raise
+                last_error = e
+                logger.warning(f"Model {target_model} unavailable ({e.status_code}), trying next candidate")
+                continue
+
+            if target_model != candidates[0]:
+                self.model_router.fallbacks += 1
+            return target_model, result, started
+
+        raise last_error
+
+    def _model_is_available(self, model: str) -> bool:
+        """A model is skipped by the router while it fails pings, its circuit is open or every key is saturated."""
+        if not self.model_registry.is_available(model):
+            return False
+        if self.retry_engine is not None and self.retry_engine.breaker(model).is_open():
+            return False
+        if self.client_pool.is_saturated(model):
+            return False
+        return True
+
+    async def _admit(self, target_model: str, contents: list, config=None) -> Lease:
+        """
+            Picks an API key and waits for its local RPM/TPM budget, or sheds the request
+            with a 429 before any upstream call. Cached contents belong to the primary key's project.
+        """
+        key = self.client_pool.pick(target_model, pinned=getattr(config, "cached_content", None) is not None)
+        limiter = key.rate_limiter.for_model(target_model) if key.rate_limiter is not None else None
+        if limiter is None:
+            return Lease(key)
 
         try:
-            response = await self.client.aio.models.generate_content(
-                model= kwargs.get("model_name") or self.default_model,
-                contents=contents,
-                config=config
+            await limiter.acquire(estimate_tokens(contents))
+            return Lease(key)
+        except RateLimitExceeded as e:
+            logger.warning(str(e))
+            raise LocalRateLimitError(
+                public_message = "Rate limit reached. Please wait a moment.",
+                internal_message = str(e),
+                status_code = 429,
+                raw_response = e.reason,
+                is_retryable = True
             )
-            return response.text or "No response generated." 
-        except Exception as e: 
-            error_data = LLMService.extract_error_details(e)
-            logger.exception(f"LLM error has been captured: {error_data}")
 
+    async def _schedule(self, target_model: str, tenant: Optional[str], priority: Priority) -> Optional[Ticket]:
+        """Waits for an upstream slot on `target_model`, or sheds the request with a 429/503."""
+        if self.scheduler is None:
+            return None
+
+        try:
+            return await self.scheduler.acquire(target_model, tenant, priority)
+        except SchedulerRejected as e:
+            raise LocalRateLimitError(
+                public_message = "Too many requests from this client. Please wait a moment." if e.status_code == 429
+                    else "The service is busy. Please try again shortly.",
+                internal_message = str(e),
+                status_code = e.status_code,
+                raw_response = e.reason,
+                is_retryable = True
+            )
+
+    async def _run_with_retries(self, target_model: str, attempt_fn, discard=None, operation: str = "call", bounded: bool = True) -> Any:
+        """
+            Runs an upstream attempt under the retry engine. Streams pass `discard`
+            so the stream opened by a losing hedged attempt gets closed; full completions
+            pass `bounded=False` so a long answer isn't cut off by the retry deadline.
+        """
+        if self.retry_engine is None:
+            return await attempt_fn()
+
+        try:
+            return await self.retry_engine.run(
+                target_model,
+                attempt_fn,
+                is_retryable=lambda e: getattr(e, "is_retryable", False) and not isinstance(e, LocalRateLimitError),
+                hedge=True,
+                discard=discard,
+                operation=operation,
+                bounded=bounded
+            )
+        except CircuitOpenError as e:
             raise LLMServiceError(
-                public_message = error_data["public_message"],
-                internal_message = error_data["internal_message"],
-                status_code = error_data["status_code"],
-                raw_response = error_data["raw_info"],
-                is_retryable = error_data["is_retryable"]
-            )  
+                public_message = "The selected model is temporarily unavailable. Please try again shortly.",
+                internal_message = str(e),
+                status_code = 503,
+                raw_response = str(e),
+                is_retryable = True
+            )
+        except DeadlineExceededError as e:
+            raise LLMServiceError(
+                public_message = "The AI provider took too long to respond.",
+                internal_message = str(e),
+                status_code = 504,
+                raw_response = str(e),
+                is_retryable = True
+            )
+
+    async def _reserve_budget(self, tenant: Optional[str], contents: list) -> int:
+        """Holds the prompt's estimated tokens against the client's budget, or refuses the request with a 429."""
+        if self.token_budgets is None:
+            return 0
+
+        try:
+            return await self.token_budgets.reserve(tenant, estimate_tokens(contents))
+        except BudgetExceeded as e:
+            logger.warning(str(e))
+            raise BudgetExceededError(
+                public_message = f"Token budget exhausted for this client. It resets in {int(e.retry_after // 60) + 1} minutes.",
+                internal_message = str(e),
+                status_code = 429,
+                raw_response = f"used={e.used:.0f} limit={e.limit}",
+                is_retryable = False
+            )
+
+    async def _record_usage(self, model: str, tenant: Optional[str], endpoint: str, usage: Dict[str, Any]) -> None:
+        """Charges what an upstream call used to the request that made it."""
+        self.usage_meter.record_tokens(model, tenant, endpoint, usage)
+        if self.token_budgets is not None:
+            await self.token_budgets.spend(tenant, usage.get("total_tokens", 0))
+
+    async def _finish_request(self, model: str, tenant: Optional[str], endpoint: str, started: float, reserved: int) -> None:
+        self.usage_meter.record_request(model, tenant, endpoint, time.monotonic() - started)
+        if self.token_budgets is not None:
+            await self.token_budgets.release(tenant, reserved)
+
+    def _upstream_error(self, target_model: str, e: Exception, key: PooledKey) -> LLMServiceError:
+        """Classifies a provider exception, feeds it back to the limiter/key pool and wraps it."""
+        error_data = LLMService.extract_error_details(e)
+        self._record_outcome(target_model, error_data, key)
+        if error_data["status_code"] == 429 and error_data["is_retryable"]:
+            # Expected under load and handled by the limiter: no traceback per throttled call
+            logger.warning(f"Rate limited by {target_model}: {error_data['internal_message'][:200]}")
+        else:
+            logger.exception(f"LLM error has been captured: {error_data}")
+
+        is_retryable = error_data["is_retryable"]
+        if error_data["status_code"] == 429 and not is_retryable and self.client_pool.has_ready_key(target_model, exclude=key):
+            # A tier block is per project: another key may well have access
+            is_retryable = True
+
+        return LLMServiceError(
+            public_message = error_data["public_message"],
+            internal_message = error_data["internal_message"],
+            status_code = error_data["status_code"],
+            raw_response = error_data["raw_info"],
+            is_retryable = is_retryable
+        )
+
+    def _record_outcome(self, target_model: str, error_data: Optional[ErrorData] = None, key: Optional[PooledKey] = None) -> None:
+        """Feeds upstream results back into the metrics, the key pool and the AIMD limiter."""
+        if error_data is not None:
+            UPSTREAM_ERRORS.labels(target_model, error_data["status_code"]).inc()
+            if key is not None:
+                self.client_pool.report_error(key, target_model, error_data["status_code"], error_data["is_retryable"])
+
+        limiter = key.rate_limiter.for_model(target_model) if key is not None and key.rate_limiter is not None else None
+        if limiter is None:
+            return
+
+        if error_data is None:
+            limiter.on_success()
+        elif error_data["status_code"] == 429 and error_data["is_retryable"]:
+            # Tier errors (non-retryable 429s) say nothing about our sending rate
+            limiter.on_rate_limited()
 
 
     async def get_stream(
@@ -154,36 +736,179 @@ class LLMService:
         **kwargs
     ) -> AsyncGenerator[str, None]:
         """Standard chunk streaming."""
-        contents = self._prepare_contents(prompt, kwargs.get("history"))
-        target_model = kwargs.get("model_name") or self.default_model
-        config = types.GenerateContentConfig(temperature=kwargs.get("temperature"))
-
-        init_stream = await self.client.aio.models.generate_content_stream(
-            model=target_model,
-            contents=contents,
-            config=config
-        )
+        session = await self._load_session(kwargs.get("session_id"))
+        history = session.turns if session is not None else kwargs.get("history")
+        contents = self._prepare_contents(prompt, history)
+        requested_model = kwargs.get("model_name") or self.default_model
+        temperature = kwargs.get("temperature")
+        output = self.output_options(kwargs)
+        config = types.GenerateContentConfig(temperature=temperature, **output)
+        request_key = make_cache_key(contents, requested_model, temperature, output)
+        tenant, priority = kwargs.get("tenant"), kwargs.get("priority", Priority.interactive)
+        # Fair queuing identity; budgets and usage stay on the tenant
+        consumer = kwargs.get("consumer") or tenant
+        endpoint = kwargs.get("endpoint", "/stream")
+        # Filled in by the time the stream ends (e.g. for a final SSE "usage" event)
+        usage = kwargs["usage"] if kwargs.get("usage") is not None else {}
+        request_started = time.monotonic()
+
+        async def _record_upstream(model: str, upstream_usage: Dict[str, Any]) -> None:
+            usage.update(upstream_usage, model=model)
+            await self._record_usage(model, tenant, endpoint, upstream_usage)
 
-        async def _generator():
+        stream = None
+        source = "shared"
+        if self.stream_cache is not None:
+            recorded = await self.stream_cache.get(request_key)
+            if recorded is not None:
+                paced = kwargs.get("replay_paced", self.stream_cache_replay_paced)
+                stream = StreamCache.replay(recorded, paced=paced)
+                source = "cache"
+        reserved = await self._reserve_budget(tenant, contents) if stream is None else 0
+
+        async def _open_upstream():
+            upstream_contents, upstream_config, models = await self._prepare_upstream(
+                contents, config, requested_model, session, (tenant, (consumer, priority))
+            )
+            async def _open_model(model: str) -> tuple:
+                # The slot stays taken until the stream ends, not just while it opens
+                ticket = await self._schedule(model, consumer, priority)
+                try:
+                    # Only the open step is retried: once chunks were sent, a retry would duplicate them
+                    init_stream = await self._run_with_retries(
+                        model,
+                        lambda: self._attempt_open_stream(model, upstream_contents, upstream_config),
+                        discard=_close_stream,
+                        operation="stream_open"
+                    )
+                except BaseException:
+                    if ticket is not None:
+                        ticket.release()
+                    raise
+                return init_stream, ticket
+
+            target_model, (init_stream, ticket), started = await self._with_fallback(
+                requested_model, _open_model, streaming=True, models=models
+            )
+            usage.update(empty_usage("upstream"))
+            text_stream = self._iter_stream_text(init_stream, target_model, started, ticket, on_usage=_record_upstream)
+            if self.stream_cache is not None:
+                text_stream = self.stream_cache.record(request_key, text_stream)
+            return text_stream
 
+        if stream is None:
+            # Identical concurrent streams are fanned out from one upstream stream (not on a session, as above)
             try:
-                async for chunk in init_stream:
-                    if chunk.text:
-                        yield chunk.text
-            except Exception as e:
+                if session is not None:
+                    stream = await _open_upstream()
+                else:
+                    stream = await self.stream_fanout.subscribe(request_key, _open_upstream)
+            except BaseException:
+                await self._finish_request(requested_model, tenant, endpoint, request_started, reserved)
+                raise
+        stream = self._account_stream(stream, usage, source, requested_model, tenant, endpoint, request_started, reserved)
 
-                error_data = LLMService.extract_error_details(e)
-                logger.exception(f"LLM error has been captured: {error_data}")
+        if session is not None:
+            stream = self._record_session_stream(stream, session, prompt, requested_model)
 
-                raise LLMServiceError(
-                    public_message = error_data["public_message"],
-                    internal_message = error_data["internal_message"],
-                    status_code = error_data["status_code"],
-                    raw_response = error_data["raw_info"],
-                    is_retryable = error_data["is_retryable"]
+        is_disconnected = kwargs.get("is_disconnected")
+        if is_disconnected is not None:
+            # Closing this subscriber stops the upstream stream once no other subscriber reads it
+            stream = cancel_on_disconnect(
+                stream, is_disconnected, self.cancellations, requested_model, self.disconnect_poll_interval
+            )
+
+        return stream
+
+    async def _record_session_stream(
+        self,
+        stream: AsyncGenerator[str, None],
+        session: Session,
+        prompt: str,
+        requested_model: str
+    ) -> AsyncGenerator[str, None]:
+        """Appends the exchange to the session once the stream completed cleanly."""
+        parts = []
+        async for text in stream:
+            parts.append(text)
+            yield text
+        await self._append_session_turns(session, prompt, "".join(parts), requested_model)
+
+    async def _account_stream(
+        self,
+        stream: AsyncGenerator[str, None],
+        usage: Dict[str, Any],
+        source: str,
+        requested_model: str,
+        tenant: Optional[str],
+        endpoint: str,
+        started: float,
+        reserved: int
+    ) -> AsyncGenerator[str, None]:
+        """Counts the request once its stream ends; the upstream stream charges its own tokens."""
+        try:
+            async for text in stream:
+                yield text
+        finally:
+            if not usage:
+                usage.update(empty_usage(source))
+            await self._finish_request(usage.get("model", requested_model), tenant, endpoint, started, reserved)
+
+    async def _attempt_open_stream(self, target_model: str, contents: list, config) -> Any:
+        """A single upstream generate_content_stream open attempt; the key stays leased until the stream ends."""
+        lease = await self._admit(target_model, contents, config)
+        started = time.perf_counter()
+        try:
+            with start_span("gemini.generate_content_stream.open", model=target_model, key=lease.key.name):
+                init_stream = await lease.key.client.aio.models.generate_content_stream(
+                    model=target_model,
+                    contents=contents,
+                    config=config
                 )
+        except Exception as e:
+            lease.release()
+            raise self._upstream_error(target_model, e, lease.key)
+        except BaseException:
+            lease.release()
+            raise
+        finally:
+            UPSTREAM_DURATION.labels(target_model, "generate_content_stream_open").observe(time.perf_counter() - started)
 
-        return _generator()
+        self._record_outcome(target_model, key=lease.key)
+        return LeasedStream(init_stream, lease)
+
+    async def _iter_stream_text(
+        self,
+        init_stream,
+        target_model: str,
+        started: float,
+        ticket: Optional[Ticket] = None,
+        on_usage = None
+    ) -> AsyncGenerator[str, None]:
+        """Yields the text of each upstream chunk, wrapping provider errors."""
+        ttft = None
+        metadata = None
+        try:
+            async for chunk in init_stream:
+                # Counts so far; the last chunk carries the totals
+                metadata = getattr(chunk, "usage_metadata", None) or metadata
+                if chunk.text:
+                    if ttft is None:
+                        ttft = time.monotonic() - started
+                    yield chunk.text
+        except Exception as e:
+            self.model_router.record_error(target_model)
+            raise self._upstream_error(target_model, e, init_stream.lease.key)
+        finally:
+            # Gives the key, the scheduler slot and the connection back even if nobody read to the end
+            if ticket is not None:
+                ticket.release()
+            await _close_stream(init_stream)
+            # Charged even when the stream was cut short: the tokens were generated all the same
+            if on_usage is not None:
+                await on_usage(target_model, usage_from_metadata(metadata))
+
+        self.model_router.record_success(target_model, latency=time.monotonic() - started, ttft=ttft)
         
 
     async def get_raw_sse_stream(
@@ -192,12 +917,15 @@ class LLMService:
         **kwargs
     ) -> AsyncGenerator[str, None]:
         """SSE formatted streaming."""
+        generator = None
         try:
             generator = await self.get_stream(prompt, **kwargs)
             async for text in generator:
                 yield text #There is already a utility that formats SSE responses
+        except LLMServiceError:
+            # Already classified (and logged) by the upstream call
+            raise
         except Exception as e:
-            logger.exception(f"***Error: {e}")
             error_data = LLMService.extract_error_details(e)
             logger.exception(f"LLM error has been captured: {error_data}")
 
@@ -210,14 +938,280 @@ class LLMService:
             )
         
             # yield f"event: sse_error\n data:{error_payload}\n\n"
+        finally:
+            # Closed right away rather than whenever it gets collected, so upstream stops now
+            if generator is not None:
+                await generator.aclose()
+
+    async def get_structured_stream(
+        self,
+        prompt: str,
+        **kwargs
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+            JSON-mode streaming, parsed while it is generated: "field" events as members of the
+            root complete (checked against their part of the schema, else "invalid"), "partial"
+            snapshots of the document, spaced out as it grows, then "done" with the validated document
+            or "error" if the output can't be parsed.
+        """
+        stream = await self.get_stream(prompt, **{**kwargs, "response_format": "json"})
+        parser = IncrementalJSONParser(kwargs.get("response_schema"))
+        try:
+            async for text in stream:
+                for event in parser.feed(text):
+                    yield event
+            yield parser.finish()
+        except StructuredOutputError as e:
+            logger.warning(f"Structured stream failed to parse: {e} {e.errors}")
+            yield {"type": "error", "message": str(e), "errors": e.errors}
+        finally:
+            await stream.aclose()
+
+    async def get_embeddings(
+        self,
+        texts: List[str],
+        model: Optional[str] = None,
+        dimensions: int = 768,
+        task_type: Optional[str] = None
+    ) -> tuple:
+        """
+            Little-endian float32 rows for `texts`, in order, and how many came from the cache.
+            Cached rows are memoryviews of the mapped cache file; the rest come back from
+            upstream in batches shared with concurrent requests.
+        """
+        # Checked before batching: a bad text would otherwise fail everyone else's texts in the same upstream call
+        for i, text in enumerate(texts):
+            problem = None
+            if not text.strip():
+                problem = "is empty"
+            elif estimate_tokens([{"parts": [{"text": text}]}]) > self.embedding_max_input_tokens:
+                problem = f"exceeds the {self.embedding_max_input_tokens}-token input limit"
+            if problem is not None:
+                raise LLMServiceError(
+                    public_message = f"Text {i} {problem}.",
+                    internal_message = f"Embedding input {i} {problem} ({len(text)} characters)",
+                    status_code = 400,
+                    raw_response = text[:200],
+                    is_retryable = False
+                )
+
+        space: EmbeddingSpace = (model or self.embedding_model, dimensions, task_type)
+        rows: List[Any] = self.embedding_store.get_many(space, texts) if self.embedding_store else [None] * len(texts)
+        missing = [i for i, row in enumerate(rows) if row is None]
+
+        if missing:
+            vectors = await self.embedding_batcher.embed(space, [texts[i] for i in missing])
+            for i, vector in zip(missing, vectors):
+                rows[i] = vector
+
+        return rows, len(texts) - len(missing)
+
+    async def _embed_batch(self, space: EmbeddingSpace, texts: List[str]) -> List[bytes]:
+        """One upstream embed_content call for a micro-batch; results are packed and written to the cache."""
+        model, dimensions, task_type = space
+        config = types.EmbedContentConfig(output_dimensionality=dimensions, task_type=task_type)
+
+        # No model fallback: vectors of different models are not comparable
+        ticket = await self._schedule(model, None, Priority.standard)
+        try:
+            response = await self._run_with_retries(model, lambda: self._attempt_embed(model, texts, config), operation="embed")
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+        vectors = [pack_vector(e.values) for e in response.embeddings]
+        if len(vectors) != len(texts) or any(len(v) != dimensions * 4 for v in vectors):
+            raise LLMServiceError(
+                public_message = "The embedding model returned an unexpected response.",
+                internal_message = f"Expected {len(texts)} vectors of {dimensions} dimensions from {model}",
+                status_code = 502,
+                raw_response = f"{len(vectors)} vectors",
+                is_retryable = False
+            )
+
+        if self.embedding_store is not None:
+            self.embedding_store.put_many(space, texts, vectors)
+        return vectors
+
+    async def _attempt_embed(self, target_model: str, texts: List[str], config) -> Any:
+        """A single upstream embed_content attempt."""
+        contents = [{"parts": [{"text": text}]} for text in texts]
+        with (await self._admit(target_model, contents, config)) as lease:
+            started = time.perf_counter()
+            try:
+                with start_span("gemini.embed_content", model=target_model, key=lease.key.name, texts=len(texts)):
+                    response = await lease.key.client.aio.models.embed_content(
+                        model=target_model,
+                        contents=texts,
+                        config=config
+                    )
+            except Exception as e:
+                raise self._upstream_error(target_model, e, lease.key)
+            finally:
+                UPSTREAM_DURATION.labels(target_model, "embed_content").observe(time.perf_counter() - started)
+
+            self._record_outcome(target_model, key=lease.key)
+            return response
+
+    def _resolve_model(self, requested_model: str) -> str:
+        """A concrete model for per-model settings when the request says "auto"."""
+        return self.default_model if requested_model == AUTO_MODEL else requested_model
+
+    async def _compact_contents(self, contents: list, requested_model: str, requester: tuple) -> list:
+        """Fits long conversations into the model's token budget before they are sent."""
+        if self.history_compactor is None:
+            return contents
+        return await self.history_compactor.compact(contents, self._resolve_model(requested_model), requester)
+
+    async def _prepare_upstream(
+        self,
+        contents: list,
+        config,
+        requested_model: str,
+        session: Optional[Session],
+        requester: tuple = (None, (None, Priority.standard))
+    ) -> tuple:
+        """
+            Returns (contents, config, pinned_models). A session with a live context cache
+            only sends the turns after the cached prefix, pinned to the cache's model;
+            everything else goes through history compaction.
+        """
+        if session is not None:
+            cache_model = session.cache_model if requested_model == AUTO_MODEL else requested_model
+            cache_name = session.cached_context(cache_model) if cache_model else None
+            if cache_name:
+                suffix = contents[session.cached_turns:]
+                return suffix, config.model_copy(update={"cached_content": cache_name}), [cache_model]
+
+        return await self._compact_contents(contents, requested_model, requester), config, None
+
+    # --- Sessions ---
+
+    async def _load_session(self, session_id: Optional[str]) -> Optional[Session]:
+        if not session_id:
+            return None
+
+        if self.session_store is None:
+            raise LLMServiceError(
+                public_message = "Sessions are not enabled on this server.",
+                internal_message = "session_id sent but no session store is configured",
+                status_code = 400,
+                raw_response = session_id,
+                is_retryable = False
+            )
+
+        try:
+            return await self.session_store.get(session_id)
+        except SessionNotFound:
+            raise LLMServiceError(
+                public_message = "Session not found or expired.",
+                internal_message = f"Unknown session {session_id}",
+                status_code = 404,
+                raw_response = session_id,
+                is_retryable = False
+            )
+
+    async def _append_session_turns(self, session: Session, prompt: str, answer: str, requested_model: str) -> None:
+        await self.session_store.append(session, [
+            HistoryItem(role="user", text=prompt),
+            HistoryItem(role="model", text=answer),
+        ])
+
+        if self.context_cache_min_tokens is not None:
+            # Caching the prefix takes an upstream round trip; the reply must not wait for it
+            refresh = asyncio.create_task(self._refresh_context_cache(session, self._resolve_model(requested_model)))
+            _CACHE_REFRESHES.add(refresh)
+            refresh.add_done_callback(_CACHE_REFRESHES.discard)
+
+    async def _refresh_context_cache(self, session: Session, model: str) -> None:
+        """
+            Creates a Gemini cached content for the session's stable prefix (every turn so far)
+            once it is large enough, and re-creates it when enough new turns piled up after it.
+        """
+        has_cache = session.cached_context(model) is not None
+        uncached = self._prepare_contents_from_turns(session.turns[session.cached_turns if has_cache else 0:])
+        if sum(estimate_item_tokens(item) for item in uncached) < self.context_cache_min_tokens:
+            return
+
+        # One refresh per session at a time, across requests and workers
+        if not await self.session_store.claim_cache_refresh(session, hold=CONTEXT_CACHE_CLAIM_SECONDS):
+            return
+        try:
+            turns_to_cache = len(session.turns)
+            cached = await self.client.aio.caches.create(
+                model=model,
+                config=types.CreateCachedContentConfig(
+                    contents=self._prepare_contents_from_turns(session.turns[:turns_to_cache]),
+                    ttl=f"{self.context_cache_ttl}s"
+                )
+            )
+            previous = session.cache_name
+            session.cache_name = cached.name
+            session.cache_model = model
+            session.cached_turns = turns_to_cache
+            session.cache_expires_at = time.time() + self.context_cache_ttl
+            await self.session_store.save_cache_state(session)
+            logger.info(f"Context cache {cached.name} covers {turns_to_cache} turns of session {session.id}")
+
+            if previous:
+                await self.client.aio.caches.delete(name=previous)
+        except Exception as e:
+            logger.warning(f"Context caching failed for session {session.id}: {e}")
+        finally:
+            await self.session_store.release_cache_refresh(session)
+
+    async def _summarize_history(
+        self,
+        previous_summary: Optional[str],
+        turns: list,
+        requester: Optional[tuple] = None
+    ) -> str:
+        """
+            Folds `turns` into the running summary of a conversation with a cheap model,
+            as an upstream call of the request that needed it: `requester` is (tenant, slot).
+        """
+        transcript = "\n".join(
+            f"{item['role']}: {part.get('text', '')}"
+            for item in turns
+            for part in item.get("parts", [])
+        )
+        instructions = (
+            "Summarize the conversation below so it can replace the original turns as context. "
+            "Keep names, facts, decisions, open questions and the user's preferences. Be concise."
+        )
+        if previous_summary:
+            instructions += f"\n\nSummary of what came before:\n{previous_summary}"
+
+        contents = [{"role": "user", "parts": [{"text": f"{instructions}\n\nConversation:\n{transcript}"}]}]
+        model = self.history_summary_model
+        config = types.GenerateContentConfig(temperature=0.2, max_output_tokens=self.history_compactor.summary_max_tokens)
+        tenant, slot = requester or (None, (None, Priority.standard))
+
+        ticket = await self._schedule(model, *slot)
+        try:
+            response = await self._run_with_retries(
+                model, lambda: self._attempt_complete(model, contents, config), operation="summary"
+            )
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+        await self._record_usage(model, tenant, "history_summary", usage_from_metadata(getattr(response, "usage_metadata", None)))
+        if not response.text:
+            raise ValueError("Empty history summary")
+        return response.text
 
     def _prepare_contents(self, prompt: str, history: Optional[List[HistoryItem]]) -> list:
         contents = []
         if history:
-            contents.extend({"role": item.role, "parts": [{"text": item.text}]} for item in history)
+            contents.extend(self._prepare_contents_from_turns(history))
         contents.append({"role": "user", "parts": [{"text": prompt}]})
         return contents
 
+    @staticmethod
+    def _prepare_contents_from_turns(turns: List[HistoryItem]) -> list:
+        return [{"role": item.role, "parts": [{"text": item.text}]} for item in turns]
+
 
     """This is going to be used as some sort of checkup to update the list of available models. 
         It could run every often and then update the list, and save it to DB"""    
@@ -243,6 +1237,49 @@ class LLMService:
             return None
     
 
+    async def check_model(self, model_id: str) -> Optional[bool]:
+        """
+            Background availability probe for the model registry: True when the model answers,
+            False when our key can't use it (permission, not found, tier), None when the ping
+            failed for a reason that may pass (quota, timeout, server error).
+        """
+        try:
+            await self.client.aio.models.generate_content(
+                model=model_id,
+                contents="ping",
+                config={"max_output_tokens": 1, "candidate_count": 1}
+            )
+            return True
+        except Exception as e:
+            error_data = classify_error(e)
+            if error_data["is_retryable"]:
+                logger.info(f"Model {model_id} ping inconclusive ({error_data['status_code']}): {e!r}")
+                return None
+            logger.warning(f"Model {model_id} rejected ping ({error_data['status_code']}): {e}")
+            return False
+
+    async def warm_up(self, connections_per_key: int, timeout: float) -> Dict[str, int]:
+        """
+            Opens `connections_per_key` upstream connections per key (DNS, TCP, TLS) with
+            concurrent metadata calls, which cost no quota. Returns the successes per key.
+        """
+        async def _open(client: Any) -> bool:
+            try:
+                await client.aio.models.get(model=self.default_model)
+                return True
+            except Exception as e:
+                logger.warning(f"Warm-up call failed: {e}")
+                return False
+
+        async def _warm(key: PooledKey) -> int:
+            # Concurrent so that HTTP/1.1 opens one connection per call (HTTP/2 multiplexes onto the first)
+            results = await asyncio.gather(*(_open(key.client) for _ in range(connections_per_key)))
+            return sum(results)
+
+        keys = self.client_pool.keys
+        counts = await asyncio.wait_for(asyncio.gather(*(_warm(key) for key in keys)), timeout)
+        return {key.name: count for key, count in zip(keys, counts)}
+
     async def get_available_models(self) -> Dict[str, Any]:
         """Retrives a list of available models to be consumed by a user"""
 
@@ -306,8 +1343,152 @@ def get_llm_service() -> LLMService:
     is only created once, using the cached settings.
     """
     settings = get_settings()
-    return LLMService(
+    # Set only in serve.py workers: caches, buckets and single-flight slots live in the coordinator
+    shared = shared_state_client()
+    bootstrap = worker_bootstrap()
+
+    if shared is not None and settings.response_cache_backend == "memory":
+        cache_backend = SharedCacheBackend(shared)
+    else:
+        cache_backend = build_cache_backend(
+            settings.response_cache_backend,
+            settings.redis_url,
+            settings.response_cache_max_bytes,
+            settings.response_cache_max_entries,
+        )
+    response_cache = ResponseCache(cache_backend, ttl=settings.response_cache_ttl)
+    stream_cache = None
+    if settings.stream_cache_enabled:
+        stream_cache = StreamCache(
+            cache_backend,
+            ttl=settings.response_cache_ttl,
+            record_timing=settings.stream_cache_record_timing
+        )
+    api_keys = [settings.gemini_api_key.get_secret_value()]
+    for extra_key in settings.gemini_api_keys:
+        if extra_key.get_secret_value() not in api_keys:
+            api_keys.append(extra_key.get_secret_value())
+
+    if settings.llm_backend == "fake":
+        from benchmarks.fake_genai import FakeGenaiClient
+        logger.warning("Using the fake Gemini backend; responses are synthetic.")
+
+    def _client_for(api_key: str):
+        if settings.llm_backend == "fake":
+            return FakeGenaiClient.from_env()
+        return build_genai_client(
+            api_key,
+            max_connections=settings.http_max_connections,
+            max_keepalive=settings.http_max_keepalive,
+            keepalive_expiry=settings.http_keepalive_expiry,
+            http2=settings.http2_enabled
+        )
+
+    # Every key is its own project with its own quota, so each gets its own limiter
+    client_pool = ClientPool(
+        [
+            PooledKey(
+                f"key-{i}",
+                _client_for(api_key),
+                RateLimiter(
+                    default_rpm=settings.rate_limit_default_rpm,
+                    default_tpm=settings.rate_limit_default_tpm,
+                    model_budgets=settings.rate_limit_model_budgets,
+                    max_wait=settings.rate_limit_max_wait,
+                    max_queue=settings.rate_limit_max_queue,
+                    burst_seconds=settings.rate_limit_burst_seconds,
+                    limiter_factory=partial(SharedModelRateLimiter, shared, f"key-{i}") if shared is not None else None
+                )
+            )
+            for i, api_key in enumerate(api_keys)
+        ],
+        rate_limited_cooldown=settings.key_rate_limited_cooldown,
+        tier_blocked_cooldown=settings.key_tier_blocked_cooldown
+    )
+
+    token_budgets = None
+    if settings.token_budget_default is not None or settings.token_budget_clients:
+        budget_options = {
+            "default_limit": settings.token_budget_default,
+            "client_limits": settings.token_budget_clients,
+            "window": settings.token_budget_window,
+        }
+        # Under serve.py a client's budget is counted once for all workers
+        token_budgets = SharedTokenBudgets(shared, **budget_options) if shared is not None else TokenBudgets(**budget_options)
+
+    llm_service = LLMService(
         api_key=settings.gemini_api_key.get_secret_value(), 
-        default_model=settings.gemini_model
+        client_pool=client_pool,
+        default_model=settings.gemini_model,
+        response_cache=response_cache,
+        stream_cache=stream_cache,
+        stream_cache_replay_paced=settings.stream_cache_replay_paced,
+        stream_fanout_queue_size=settings.stream_fanout_queue_size,
+        model_fallback_chains=settings.model_fallback_chains,
+        model_router_explore_rate=settings.model_router_explore_rate,
+        model_registry=ModelRegistry(
+            refresh_interval=settings.models_refresh_interval,
+            reload_check_interval=settings.models_reload_check_interval,
+            max_ping_failures=settings.models_max_ping_failures,
+            coordinator=shared,
+            bootstrap=bootstrap["models"] if bootstrap is not None else None
+        ),
+        complete_flight=SharedSingleFlight(shared, ttl=settings.shared_flight_ttl) if shared is not None else None,
+        retry_engine=RetryEngine(
+            RetryPolicy(
+                max_attempts=settings.retry_max_attempts,
+                base_delay=settings.retry_base_delay,
+                max_delay=settings.retry_max_delay,
+                deadline=settings.retry_deadline
+            ),
+            failure_threshold=settings.breaker_failure_threshold,
+            reset_timeout=settings.breaker_reset_timeout,
+            hedge_enabled=settings.hedge_enabled,
+            hedge_quantile=settings.hedge_quantile,
+            hedge_min_delay=settings.hedge_min_delay
+        ),
+        history_summary_model=settings.history_summary_model,
+        session_store=build_session_store(
+            # Per-process memory would lose sessions between workers
+            "sqlite" if shared is not None else settings.session_backend,
+            settings.session_sqlite_path,
+            settings.session_max_sessions,
+            settings.session_ttl
+        ),
+        context_cache_min_tokens=settings.context_cache_min_tokens if settings.context_cache_enabled else None,
+        context_cache_ttl=settings.context_cache_ttl,
+        scheduler=UpstreamScheduler(
+            default_concurrency=settings.scheduler_default_concurrency,
+            model_concurrency=settings.scheduler_model_concurrency,
+            max_queue=settings.scheduler_max_queue,
+            max_queue_per_tenant=settings.scheduler_max_queue_per_tenant,
+            max_wait=settings.scheduler_max_wait,
+            tenant_weights=settings.scheduler_tenant_weights
+        ) if settings.scheduler_enabled else None,
+        disconnect_poll_interval=settings.disconnect_poll_interval,
+        resumable_streams=ResumableStreams(
+            ttl=settings.resumable_stream_ttl,
+            max_streams=settings.resumable_max_streams,
+            max_chars_per_stream=settings.resumable_stream_max_chars,
+            detach_grace=settings.resumable_detach_grace,
+            poll_interval=settings.disconnect_poll_interval
+        ) if settings.resumable_streams_enabled else None,
+        embedding_model=settings.embedding_model,
+        embedding_store=EmbeddingStore(settings.embedding_cache_dir) if settings.embedding_cache_enabled else None,
+        embedding_max_batch=settings.embedding_max_batch,
+        embedding_batch_linger=settings.embedding_batch_linger,
+        embedding_max_input_tokens=settings.embedding_max_input_tokens,
+        usage_meter=UsageMeter(settings.usage_log_path or None, flush_interval=settings.usage_flush_interval),
+        token_budgets=token_budgets
     )
+    if settings.history_compaction_enabled:
+        llm_service.history_compactor = HistoryCompactor(
+            llm_service._summarize_history,
+            default_budget=settings.history_token_budget,
+            model_budgets=settings.history_model_budgets,
+            keep_recent_turns=settings.history_keep_recent_turns,
+            summary_block=settings.history_summary_block,
+            summary_max_tokens=settings.history_summary_max_tokens
+        )
+    return llm_service
 
@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional, Set
+
+from google.genai import types
+
+from LLMService import LLMService, LLMServiceError
+from models import QueryRequest
+from scheduler import Priority
+from usage import TOKEN_FIELDS, empty_usage, usage_from_metadata
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _public_error(e: Exception) -> Dict[str, Any]:
+    """Only the public fields of the ErrorData: provider text stays in the logs, as with the app's error handlers."""
+    error_data = e.to_error_data() if isinstance(e, LLMServiceError) else LLMService.extract_error_details(e)
+    logger.warning(f"Batch request failed: {error_data['internal_message'][:200]}")
+    return {
+        "public_message": error_data["public_message"],
+        "status_code": error_data["status_code"],
+        "is_retryable": error_data["is_retryable"],
+    }
+
+
+def _error_item(index: int, e: Exception) -> Dict[str, Any]:
+    """Per-item failure, so one bad record never fails the batch."""
+    return {"index": index, "error": _public_error(e)}
+
+
+async def run_online_batch(
+    llm_service: LLMService,
+    requests: List[QueryRequest],
+    concurrency: int,
+    tenant: Optional[str] = None,
+    consumer: Optional[str] = None
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+        Fans the requests out through get_complete with at most `concurrency` in flight
+        and yields `{"index", "text"}` / `{"index", "error"}` items in completion order.
+        A fixed worker pool keeps memory flat even for thousands of records.
+        Items queue for upstream slots in the batch class, behind interactive traffic.
+    """
+    pending: asyncio.Queue = asyncio.Queue()
+    for index, request_data in enumerate(requests):
+        pending.put_nowait((index, request_data))
+
+    # Bounded so a slow reader applies backpressure instead of buffering the whole batch
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def _worker():
+        while True:
+            try:
+                index, request_data = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            settings = {
+                k: v
+                for k, v in {
+                    "temperature": request_data.temperature,
+                    "history": request_data.history,
+                    "model_name": request_data.model_name,
+                    "session_id": request_data.session_id,
+                    "response_format": request_data.response_format,
+                    "response_schema": request_data.response_schema,
+                }.items()
+                if v is not None
+            }
+            try:
+                text = await llm_service.get_complete(
+                    request_data.prompt, tenant=tenant, consumer=consumer, priority=Priority.batch, endpoint="/batch", **settings
+                )
+                await results.put({"index": index, "text": text})
+            except Exception as e:
+                await results.put(_error_item(index, e))
+
+    workers = [asyncio.create_task(_worker()) for _ in range(max(1, min(concurrency, len(requests))))]
+
+    async def _close_when_done():
+        await asyncio.gather(*workers, return_exceptions=True)
+        await results.put(_DONE)
+
+    closer = asyncio.create_task(_close_when_done())
+
+    try:
+        while True:
+            item = await results.get()
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        # The client went away: stop issuing upstream calls for the rest of the batch
+        for task in workers + [closer]:
+            task.cancel()
+
+
+# Batch jobs followed in the background until they end; referenced here so they aren't garbage collected
+_FOLLOWERS: Set[asyncio.Task] = set()
+
+# Jobs are named after the account (API key hash or address) that submitted them, so only it can read their results
+_OWNER_PREFIX = "llm-api-"
+
+_TERMINAL_STATES = (
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+)
+
+
+async def submit_gemini_batch(
+    llm_service: LLMService,
+    requests: List[QueryRequest],
+    tenant: Optional[str] = None,
+    poll_interval: float = 30.0
+) -> List[Dict[str, Any]]:
+    """
+        Submits the requests to Gemini's batch API (one job per model, inlined requests)
+        and returns right away with one `{"job_id", "model", "indexes"}` entry per job;
+        results are fetched with get_gemini_batch. Much cheaper per token, but a job can
+        take hours, so its token usage is charged by a background follower when it ends.
+    """
+    if any(request_data.session_id for request_data in requests):
+        # A job's answers arrive long after the request: there is no turn to append them to
+        raise LLMServiceError(
+            public_message = "Sessions are not supported in gemini_batch mode; send the history instead.",
+            internal_message = "session_id sent in a gemini_batch request",
+            status_code = 400,
+            raw_response = "",
+            is_retryable = False
+        )
+
+    by_model: Dict[str, List[int]] = {}
+    for index, request_data in enumerate(requests):
+        model = llm_service._resolve_model(request_data.model_name or llm_service.default_model)
+        by_model.setdefault(model, []).append(index)
+
+    prepared = []
+    for model, indexes in by_model.items():
+        inlined = [
+            {
+                "contents": llm_service._prepare_contents(requests[i].prompt, requests[i].history),
+                "config": {
+                    "temperature": requests[i].temperature,
+                    **LLMService.output_options(requests[i].model_dump(include={"response_format", "response_schema"}))
+                },
+            }
+            for i in indexes
+        ]
+        prepared.append((model, indexes, inlined))
+
+    # Every job's budget is held before any is submitted: over budget refuses the whole batch, like a single request
+    reservations: List[int] = []
+    try:
+        for _, _, inlined in prepared:
+            reservations.append(
+                await llm_service._reserve_budget(tenant, [item for request in inlined for item in request["contents"]])
+            )
+    except LLMServiceError:
+        if llm_service.token_budgets is not None:
+            for reserved in reservations:
+                await llm_service.token_budgets.release(tenant, reserved)
+        raise
+
+    jobs = []
+    for (model, indexes, inlined), reserved in zip(prepared, reservations):
+        entry: Dict[str, Any] = {"model": model, "indexes": indexes}
+        try:
+            job = await llm_service.client.aio.batches.create(
+                model=model, src=inlined, config={"display_name": _owner_name(tenant)}
+            )
+        except Exception as e:
+            if llm_service.token_budgets is not None:
+                await llm_service.token_budgets.release(tenant, reserved)
+            entry["error"] = _public_error(e)
+            jobs.append(entry)
+            continue
+
+        logger.info(f"Submitted batch job {job.name} with {len(inlined)} requests for {model}")
+        entry["job_id"] = job.name.split("/")[-1]
+        jobs.append(entry)
+
+        follower = asyncio.create_task(_follow_job(llm_service, job.name, model, tenant, len(indexes), reserved, poll_interval))
+        _FOLLOWERS.add(follower)
+        follower.add_done_callback(_FOLLOWERS.discard)
+
+    return jobs
+
+
+async def _follow_job(
+    llm_service: LLMService,
+    name: str,
+    model: str,
+    tenant: Optional[str],
+    count: int,
+    reserved: int,
+    poll_interval: float
+) -> None:
+    """Polls a submitted job until it ends, then charges what it used and releases its budget hold."""
+    started = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(poll_interval)
+            try:
+                job = await llm_service.client.aio.batches.get(name=name)
+            except Exception as e:
+                logger.warning(f"Polling batch job {name} failed, will retry: {e}")
+                continue
+            if job.state in _TERMINAL_STATES:
+                break
+
+        responses = job.dest.inlined_responses if job.state == types.JobState.JOB_STATE_SUCCEEDED and job.dest else []
+        usage = empty_usage("upstream")
+        for inlined_response in responses or []:
+            if inlined_response.response is not None:
+                item_usage = usage_from_metadata(getattr(inlined_response.response, "usage_metadata", None))
+                for field in TOKEN_FIELDS:
+                    usage[field] += item_usage[field]
+        await llm_service._record_usage(model, tenant, "/batch", usage)
+        logger.info(f"Batch job {name} ended in state {job.state} using {usage['total_tokens']} tokens")
+    finally:
+        seconds = time.monotonic() - started
+        for _ in range(count):
+            llm_service.usage_meter.record_request(model, tenant, "/batch", seconds)
+        if llm_service.token_budgets is not None:
+            await llm_service.token_budgets.release(tenant, reserved)
+
+
+def _owner_name(tenant: Optional[str]) -> str:
+    """The job's display name: a hash of the submitting account, which may be an address."""
+    return _OWNER_PREFIX + hashlib.sha256((tenant or "").encode("utf-8")).hexdigest()[:24]
+
+
+def _job_not_found(job_id: str) -> LLMServiceError:
+    return LLMServiceError(
+        public_message = "Batch job not found.",
+        internal_message = f"Batch job {job_id} not found or submitted by another account",
+        status_code = 404,
+        raw_response = job_id,
+        is_retryable = False
+    )
+
+
+async def get_gemini_batch(llm_service: LLMService, job_id: str, tenant: Optional[str] = None) -> Dict[str, Any]:
+    """
+        State of a job submitted by `tenant` and, once it succeeded, one `{"index", "text"}` /
+        `{"index", "error"}` item per request, where `index` is the position in the
+        job's `indexes` returned at submission. Anyone else's job is a 404.
+    """
+    try:
+        job = await llm_service.client.aio.batches.get(name=f"batches/{job_id}")
+    except Exception as e:
+        error_data = LLMService.extract_error_details(e)
+        raise LLMServiceError(
+            public_message = error_data["public_message"],
+            internal_message = error_data["internal_message"],
+            status_code = error_data["status_code"],
+            raw_response = error_data["raw_info"],
+            is_retryable = error_data["is_retryable"]
+        )
+    if getattr(job, "display_name", None) != _owner_name(tenant):
+        # Same answer as for a job that doesn't exist: job ids are not a way to probe other accounts
+        raise _job_not_found(job_id)
+
+    state = getattr(job.state, "name", str(job.state))
+    status: Dict[str, Any] = {"job_id": job_id, "state": state, "done": job.state in _TERMINAL_STATES}
+
+    if job.state == types.JobState.JOB_STATE_SUCCEEDED:
+        results = []
+        for i, inlined_response in enumerate(job.dest.inlined_responses):
+            if inlined_response.error is not None:
+                results.append(_error_item(i, RuntimeError(str(inlined_response.error))))
+            else:
+                results.append({"index": i, "text": inlined_response.response.text or "No response generated."})
+        status["results"] = results
+    elif status["done"]:
+        status["error"] = {"public_message": f"The batch job ended in state {state}.", "status_code": 502, "is_retryable": False}
+    return status
@@ -0,0 +1,121 @@
+"""
+Cost of classifying provider errors during an error flood: the structured-attribute path,
+repeated string-only messages (memoized), oversized payloads and already-classified errors,
+each against the previous regex + literal_eval classifier.
+
+    python -m benchmarks.error_classification --errors 50000 --output benchmarks/results/errors.json
+"""
+import argparse
+import ast
+import json
+import re
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from benchmarks.fake_genai import FakeAPIError
+from error_classifier import classification_cache_info, classify_error
+
+try:
+    from LLMService import LLMService, LLMServiceError
+except ImportError:
+    # google-genai not installed: the pass-through scenario is skipped
+    LLMService = None
+
+
+class _StringOnlyError(Exception):
+    """An error that only carries the SDK's text, as raised by older SDKs and transports."""
+
+
+def legacy_extract_error_details(raw_error_val: Any) -> Dict[str, Any]:
+    """The classifier this benchmark replaced, kept verbatim as the baseline."""
+    raw_error_str = str(raw_error_val)
+    error_data = {
+        "public_message": "An AI provider error occurred.",
+        "status_code": 500,
+        "is_retryable": True,
+        "raw_info": raw_error_str,
+        "internal_message": raw_error_str,
+    }
+    match = re.search(r"\{.*\}", raw_error_str, re.DOTALL)
+    if match:
+        error_dict = ast.literal_eval(match.group(0))
+        nested_msg = error_dict.get('error', {}).get('message', "")
+        lowercase_msg = nested_msg.lower()
+        if any(word in lowercase_msg for word in ["temperature", "invalid", "400"]):
+            error_data.update(public_message=nested_msg.split(':')[-1].strip(), status_code=400, is_retryable=False)
+        elif "tier" in lowercase_msg or "limit: 0" in lowercase_msg:
+            error_data.update(public_message="The selected model is unavailable on this account tier.", status_code=429, is_retryable=False)
+        elif any(word in lowercase_msg for word in ["quota", "limit", "429"]):
+            error_data.update(public_message="Rate limit reached. Please wait a moment.", status_code=429, is_retryable=True)
+        elif nested_msg:
+            error_data["public_message"] = nested_msg
+    return error_data
+
+
+def _scenarios(count: int) -> Dict[str, List[BaseException]]:
+    quota = "Resource has been exhausted (e.g. check quota)."
+    structured = [FakeAPIError(429, "RESOURCE_EXHAUSTED", quota) for _ in range(count)]
+    # A flood repeats a handful of distinct texts (one per model/quota combination)
+    repeated = [_StringOnlyError(str(FakeAPIError(429, "RESOURCE_EXHAUSTED", f"{quota} model-{i % 8}"))) for i in range(count)]
+    # Provider bodies with long details lists: the old regex scanned and evaluated all of it
+    details = [{"@type": "type.googleapis.com/google.rpc.QuotaFailure", "violations": [{"quotaId": f"q{i}"} for i in range(200)]}]
+    body = {"error": {"code": 503, "message": "The model is overloaded.", "status": "UNAVAILABLE", "details": details}}
+    huge = f"503 UNAVAILABLE. {body}"
+    oversized = [_StringOnlyError(huge) for _ in range(max(1, count // 10))]
+    return {"structured_429": structured, "repeated_text_429": repeated, "oversized_payload": oversized}
+
+
+def _time(classify: Callable[[Any], Any], errors: List[BaseException], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for error in errors:
+            classify(error)
+        best = min(best, time.perf_counter() - started)
+    return best * 1e9 / len(errors)
+
+
+def run(count: int, repeat: int) -> Dict[str, Any]:
+    report: Dict[str, Any] = {"errors": count, "repeat": repeat, "results": {}}
+    new_classify = LLMService.extract_error_details if LLMService is not None else classify_error
+
+    for name, errors in _scenarios(count).items():
+        # Status codes may legitimately differ (the old parser reported every 5xx as 500); retry decisions must not
+        agree = all(new_classify(e)["is_retryable"] == legacy_extract_error_details(e)["is_retryable"] for e in errors[:50])
+        legacy_ns = _time(legacy_extract_error_details, errors, repeat)
+        new_ns = _time(new_classify, errors, repeat)
+        report["results"][name] = {
+            "legacy_ns": round(legacy_ns, 1),
+            "new_ns": round(new_ns, 1),
+            "speedup": round(legacy_ns / new_ns, 2) if new_ns else None,
+            "same_retry_decision": agree,
+        }
+
+    if LLMService is not None:
+        classified = [
+            LLMServiceError(internal_message="429", public_message="Rate limit reached. Please wait a moment.",
+                            status_code=429, raw_response="429", is_retryable=True)
+            for _ in range(count)
+        ]
+        report["results"]["already_classified"] = {"new_ns": round(_time(new_classify, classified, repeat), 1)}
+
+    report["text_cache"] = classification_cache_info()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--errors", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    report = run(args.errors, args.repeat)
+    for name, row in report["results"].items():
+        legacy = f"legacy {row['legacy_ns']:>9} ns  " if "legacy_ns" in row else " " * 25
+        print(f"{name:<20} {legacy}new {row['new_ns']:>8} ns  x{row.get('speedup', '-')}  same={row.get('same_retry_decision', '-')}")
+    print(f"text cache: {report['text_cache']}")
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(json.dumps(report, indent=2))
@@ -0,0 +1,172 @@
+"""
+Local stand-in for `genai.Client` so the service can be load-tested without spending quota.
+
+Enable it with LLM_BACKEND=fake (GEMINI_API_KEY can be any value) and tune it with
+FAKE_GENAI_CONFIG, a JSON object such as:
+
+    {"first_token_latency": 0.3, "chunk_delay": 0.02, "chunk_count": 20, "chunk_size": 12,
+     "error_rate": 0.01, "rate_limit_rate": 0.02,
+     "models": {"gemini-2.5-pro": {"first_token_latency": 1.2, "chunk_delay": 0.05}}}
+"""
+import asyncio
+import json
+import os
+import random
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+DEFAULT_BEHAVIOUR = {
+    "first_token_latency": 0.3,   # seconds before the first chunk / the complete answer
+    "chunk_delay": 0.02,          # seconds between chunks
+    "chunk_count": 20,
+    "chunk_size": 12,             # characters per chunk
+    "error_rate": 0.0,            # fraction of calls failing with a 500
+    "rate_limit_rate": 0.0,       # fraction of calls failing with a retryable 429
+    "jitter": 0.1,                # +/- fraction applied to every delay
+}
+
+
+class FakeAPIError(Exception):
+    """Mimics google.genai.errors.APIError: structured fields plus the SDK's message format."""
+
+    def __init__(self, code: int, status: str, message: str):
+        self.code = code
+        self.status = status
+        self.message = message
+        self.details = {"error": {"code": code, "message": message, "status": status}}
+        super().__init__(f"{code} {status}. {self.details}")
+
+
+def _usage(prompt_chars: int, output_chars: int) -> SimpleNamespace:
+    return SimpleNamespace(
+        prompt_token_count=prompt_chars // 4 + 1,
+        candidates_token_count=output_chars // 4 + 1,
+        cached_content_token_count=0,
+        total_token_count=(prompt_chars + output_chars) // 4 + 2,
+    )
+
+
+def _json_mode(config: Any) -> bool:
+    return getattr(config, "response_mime_type", None) == "application/json"
+
+
+def _prompt_chars(contents: Any) -> int:
+    if isinstance(contents, str):
+        return len(contents)
+    return sum(len(part.get("text", "")) for item in contents for part in item.get("parts", []))
+
+
+class _FakeModels:
+    def __init__(self, client: "FakeGenaiClient"):
+        self._client = client
+
+    async def generate_content(self, model: str, contents: Any, config: Any = None) -> SimpleNamespace:
+        behaviour = self._client.behaviour_for(model)
+        self._client.maybe_fail(behaviour)
+        await asyncio.sleep(self._client.jittered(behaviour, "first_token_latency"))
+        text = self._client.answer_text(behaviour, config)
+        self._client.calls += 1
+        return SimpleNamespace(text=text, usage_metadata=_usage(_prompt_chars(contents), len(text)))
+
+    async def generate_content_stream(self, model: str, contents: Any, config: Any = None):
+        behaviour = self._client.behaviour_for(model)
+        self._client.maybe_fail(behaviour)
+        self._client.calls += 1
+        prompt_chars = _prompt_chars(contents)
+        # JSON mode: one document cut into chunk_count pieces, as a constrained model would stream it
+        document = self._client.answer_text(behaviour, config) if _json_mode(config) else None
+
+        async def _chunks():
+            await asyncio.sleep(self._client.jittered(behaviour, "first_token_latency"))
+            sent = 0
+            for i in range(behaviour["chunk_count"]):
+                if i:
+                    await asyncio.sleep(self._client.jittered(behaviour, "chunk_delay"))
+                if document is None:
+                    text = self._client.chunk_text(behaviour, i)
+                else:
+                    size = -(-len(document) // behaviour["chunk_count"])
+                    text = document[i * size:(i + 1) * size]
+                sent += len(text)
+                last = i == behaviour["chunk_count"] - 1
+                yield SimpleNamespace(text=text, usage_metadata=_usage(prompt_chars, sent) if last else None)
+
+        return _chunks()
+
+    async def list(self) -> List[SimpleNamespace]:
+        return [
+            SimpleNamespace(name=f"models/{model_id}", display_name=model_id, supported_actions=["generateContent"])
+            for model_id in self._client.known_models()
+        ]
+
+    async def get(self, model: str) -> SimpleNamespace:
+        # A metadata call: network latency only, never rate-limited
+        await asyncio.sleep(self._client.jittered(self._client.behaviour_for(model), "first_token_latency") / 10)
+        return SimpleNamespace(name=f"models/{model}", display_name=model, supported_actions=["generateContent"])
+
+    async def embed_content(self, model: str, contents: Any, config: Any = None) -> SimpleNamespace:
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        behaviour = self._client.behaviour_for(model)
+        await asyncio.sleep(self._client.jittered(behaviour, "first_token_latency") / 4)
+        dimensions = getattr(config, "output_dimensionality", None) or 768
+        embeddings = []
+        for text in texts:
+            rng = random.Random(text)
+            embeddings.append(SimpleNamespace(values=[rng.uniform(-1, 1) for _ in range(dimensions)]))
+        return SimpleNamespace(embeddings=embeddings)
+
+
+class _FakeCaches:
+    def __init__(self):
+        self._count = 0
+
+    async def create(self, model: str, config: Any = None) -> SimpleNamespace:
+        self._count += 1
+        return SimpleNamespace(name=f"cachedContents/fake-{self._count}", model=model)
+
+    async def delete(self, name: str) -> None:
+        return None
+
+
+class FakeGenaiClient:
+    """Drop-in for the parts of genai.Client that LLMService uses (client.aio.*)."""
+
+    def __init__(self, behaviour: Optional[Dict[str, Any]] = None, seed: Optional[int] = None):
+        behaviour = dict(behaviour or {})
+        self.model_behaviour: Dict[str, Dict[str, Any]] = behaviour.pop("models", {})
+        self.behaviour = {**DEFAULT_BEHAVIOUR, **behaviour}
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.aio = SimpleNamespace(models=_FakeModels(self), caches=_FakeCaches())
+
+    @classmethod
+    def from_env(cls) -> "FakeGenaiClient":
+        raw = os.environ.get("FAKE_GENAI_CONFIG")
+        return cls(json.loads(raw) if raw else None)
+
+    def behaviour_for(self, model: str) -> Dict[str, Any]:
+        return {**self.behaviour, **self.model_behaviour.get(model, {})}
+
+    def known_models(self) -> List[str]:
+        return sorted({"gemini-2.5-flash-lite", "gemini-2.5-flash", *self.model_behaviour})
+
+    def jittered(self, behaviour: Dict[str, Any], key: str) -> float:
+        base = behaviour[key]
+        return max(0.0, base * (1 + self.random.uniform(-behaviour["jitter"], behaviour["jitter"])))
+
+    def maybe_fail(self, behaviour: Dict[str, Any]) -> None:
+        roll = self.random.random()
+        if roll < behaviour["rate_limit_rate"]:
+            raise FakeAPIError(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+        if roll < behaviour["rate_limit_rate"] + behaviour["error_rate"]:
+            raise FakeAPIError(500, "INTERNAL", "An internal error has occurred.")
+
+    def chunk_text(self, behaviour: Dict[str, Any], index: int) -> str:
+        word = f"tok{index} "
+        return (word * (behaviour["chunk_size"] // len(word) + 1))[:behaviour["chunk_size"]]
+
+    def answer_text(self, behaviour: Dict[str, Any], config: Any = None) -> str:
+        text = "".join(self.chunk_text(behaviour, i) for i in range(behaviour["chunk_count"]))
+        if _json_mode(config):
+            return json.dumps({"answer": text, "words": text.split(), "chunks": behaviour["chunk_count"]})
+        return text
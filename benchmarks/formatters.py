@@ -0,0 +1,95 @@
+"""
+Per-chunk CPU cost of the stream formatter engines, plus a byte-for-byte comparison of their output.
+
+    python -m benchmarks.formatters --chunks 200000 --output benchmarks/results/formatters.json
+"""
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from stream_formatters import STREAM_FORMATTER_ENGINES, orjson
+
+# Typical model output: plain ASCII, accented/CJK/emoji text, and markdown with quotes/newlines to escape
+CORPUS = {
+    "ascii": ["The quick brown fox ", "jumps over the lazy dog. ", "Streaming tokens arrive in small pieces"],
+    "unicode": ["Café crème, ", "naïve résumé — ", "東京の天気は晴れです。", "Done 🚀✨ "],
+    "escapes": ['He said "hi"\n', "```python\nprint('x')\n```\n", "C:\\path\\to\\file\t|"],
+}
+
+
+async def _chunks(texts: List[str], count: int):
+    for i in range(count):
+        yield texts[i % len(texts)]
+
+
+async def _collect(formatter, texts: List[str], count: int, **kwargs) -> List[bytes]:
+    out = []
+    async for frame in formatter(_chunks(texts, count), **kwargs):
+        out.append(frame.encode("utf-8") if isinstance(frame, str) else bytes(frame))
+    return out
+
+
+async def _time(formatter, texts: List[str], count: int) -> float:
+    started = time.process_time()
+    async for _ in formatter(_chunks(texts, count)):
+        pass
+    return time.process_time() - started
+
+
+async def run(chunks: int, repeat: int) -> Dict[str, Any]:
+    report: Dict[str, Any] = {"chunks": chunks, "repeat": repeat, "orjson": orjson is not None, "results": {}}
+
+    for kind in ("json", "sse"):
+        for corpus_name, texts in CORPUS.items():
+            classic = STREAM_FORMATTER_ENGINES["classic"][kind]
+            fast = STREAM_FORMATTER_ENGINES["fast"][kind]
+
+            identical = await _collect(classic, texts, 1000) == await _collect(fast, texts, 1000)
+            # Resumable streams add ids/offsets; those frames must match too
+            identical = identical and (
+                await _collect(classic, texts, 1000, stream_id="Zx9_-q", start=7)
+                == await _collect(fast, texts, 1000, stream_id="Zx9_-q", start=7)
+            )
+            if kind == "sse":
+                # And so must the trailing usage event
+                usage = {"prompt_tokens": 12, "output_tokens": 340, "total_tokens": 352, "source": "upstream"}
+                identical = identical and (
+                    await _collect(classic, texts, 10, usage=usage) == await _collect(fast, texts, 10, usage=usage)
+                )
+
+            # The empty-generator baseline is subtracted so only framing cost is compared
+            baseline = min([await _time(_passthrough, texts, chunks) for _ in range(repeat)])
+            row = {"identical": identical}
+            for engine, formatter in (("classic", classic), ("fast", fast)):
+                best = min([await _time(formatter, texts, chunks) for _ in range(repeat)])
+                row[f"{engine}_ns_per_chunk"] = round(max(0.0, best - baseline) * 1e9 / chunks, 1)
+            row["speedup"] = round(row["classic_ns_per_chunk"] / row["fast_ns_per_chunk"], 2) if row["fast_ns_per_chunk"] else None
+            report["results"][f"{kind}/{corpus_name}"] = row
+
+    return report
+
+
+async def _passthrough(raw_stream):
+    async for text_chunk in raw_stream:
+        yield text_chunk
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.chunks, args.repeat))
+    for name, row in report["results"].items():
+        print(
+            f"{name:<16} classic {row['classic_ns_per_chunk']:>8} ns  fast {row['fast_ns_per_chunk']:>8} ns  "
+            f"x{row['speedup']}  identical={row['identical']}"
+        )
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        Path(args.output).write_text(json.dumps(report, indent=2))
@@ -0,0 +1,280 @@
+"""
+Offline load test: starts the API against the fake Gemini backend and drives it with concurrent clients.
+
+    python -m benchmarks.load_test --scenario mixed --requests 2000 --concurrency 100
+    python -m benchmarks.load_test --scenario stream --fake-config '{"first_token_latency": 0.5, "rate_limit_rate": 0.05}'
+
+The server runs in its own process so its CPU time and RSS can be read from /proc without
+counting the load generator. Results are printed and written to benchmarks/results/ as JSON
+so runs before and after a change can be diffed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+API_PREFIX = "/api/v1/chat"
+
+# Weights of each request kind per scenario
+SCENARIOS: Dict[str, Dict[str, float]] = {
+    "stream": {"stream": 1.0},
+    "sse": {"sse": 1.0},
+    "complete": {"complete": 1.0},
+    "mixed": {"stream": 0.5, "sse": 0.2, "complete": 0.3},
+}
+
+
+# --- 1. Server process ---
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int, fake_config: Dict[str, Any], extra_env: Dict[str, str]) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "LLM_BACKEND": "fake",
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "fake-key"),
+        "FAKE_GENAI_CONFIG": json.dumps(fake_config),
+        **extra_env,
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT,
+        env=env,
+    )
+
+
+async def wait_until_up(client: httpx.AsyncClient, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{API_PREFIX}/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise RuntimeError("Server did not come up in time")
+
+
+def process_usage(pid: int) -> Optional[Dict[str, float]]:
+    """CPU seconds and RSS of a process from /proc; None where /proc isn't available."""
+    try:
+        fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss_kb = next(
+            int(line.split()[1]) for line in Path(f"/proc/{pid}/status").read_text().splitlines()
+            if line.startswith("VmRSS:")
+        )
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+    return {"cpu_seconds": cpu_seconds, "rss_mb": rss_kb / 1024}
+
+
+# --- 2. Load generation ---
+
+def _prompt(index: int, repeat_ratio: float, rng: random.Random) -> str:
+    # Unique prompts by default so the response/stream caches don't hide upstream behaviour
+    if rng.random() < repeat_ratio:
+        return "Tell me a short story about a lighthouse."
+    return f"Tell me a short story about lighthouse #{index}."
+
+
+async def _one_request(client: httpx.AsyncClient, kind: str, prompt: str, model: Optional[str]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    ttfb = None
+    size = 0
+    body = {"prompt": prompt, **({"model_name": model} if model else {})}
+
+    if kind == "sse":
+        request = client.build_request("GET", f"{API_PREFIX}/stream/sse", params=body)
+    elif kind == "stream":
+        request = client.build_request("POST", f"{API_PREFIX}/stream", json=body, headers={"X-Format": "application/json"})
+    else:
+        request = client.build_request("POST", f"{API_PREFIX}/complete", json=body, headers={"X-Format": "application/json"})
+
+    try:
+        response = await client.send(request, stream=True)
+        try:
+            async for chunk in response.aiter_raw():
+                if ttfb is None and chunk:
+                    ttfb = time.perf_counter() - started
+                size += len(chunk)
+        finally:
+            await response.aclose()
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+
+    return {"kind": kind, "status": status, "ttfb": ttfb, "total": time.perf_counter() - started, "bytes": size}
+
+
+async def run_load(
+    base_url: str,
+    scenario: str,
+    total_requests: int,
+    concurrency: int,
+    repeat_ratio: float,
+    model: Optional[str],
+    seed: int
+) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    kinds, weights = zip(*SCENARIOS[scenario].items())
+    plan = [(rng.choices(kinds, weights)[0], _prompt(i, repeat_ratio, rng)) for i in range(total_requests)]
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in plan:
+        queue.put_nowait(item)
+
+    results: List[Dict[str, Any]] = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120.0, limits=limits) as client:
+
+        async def _worker():
+            while True:
+                try:
+                    kind, prompt = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                results.append(await _one_request(client, kind, prompt, model))
+
+        await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    return results
+
+
+# --- 3. Reporting ---
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def _at(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {"p50": _at(0.50), "p95": _at(0.95), "p99": _at(0.99)}
+
+
+def summarize(results: List[Dict[str, Any]], elapsed: float) -> Dict[str, Any]:
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+    ok = [r for r in results if r["status"] == 200]
+
+    by_kind = {}
+    for kind in sorted({r["kind"] for r in results}):
+        kind_ok = [r for r in ok if r["kind"] == kind]
+        by_kind[kind] = {
+            "requests": sum(1 for r in results if r["kind"] == kind),
+            "ttfb_ms": _percentiles([r["ttfb"] for r in kind_ok if r["ttfb"] is not None]),
+            "total_ms": _percentiles([r["total"] for r in kind_ok]),
+        }
+
+    return {
+        "requests": len(results),
+        "elapsed_seconds": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed else None,
+        "statuses": statuses,
+        "ttfb_ms": _percentiles([r["ttfb"] for r in ok if r["ttfb"] is not None]),
+        "total_ms": _percentiles([r["total"] for r in ok]),
+        "bytes_received": sum(r["bytes"] for r in results),
+        "by_kind": by_kind,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    fake_config = json.loads(args.fake_config) if args.fake_config else {}
+    extra_env = dict(pair.split("=", 1) for pair in args.env)
+    port = args.port or _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    server = start_server(port, fake_config, extra_env)
+    try:
+        async with httpx.AsyncClient(base_url=base_url) as probe:
+            await wait_until_up(probe)
+
+        # Warm-up requests are not part of the report
+        await run_load(base_url, args.scenario, args.warmup, min(args.concurrency, args.warmup or 1), 0.0, args.model, args.seed + 1)
+
+        before = process_usage(server.pid)
+        started = time.perf_counter()
+        results = await run_load(
+            base_url, args.scenario, args.requests, args.concurrency, args.repeat_ratio, args.model, args.seed
+        )
+        elapsed = time.perf_counter() - started
+        after = process_usage(server.pid)
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    report = {
+        "scenario": args.scenario,
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "repeat_ratio": args.repeat_ratio,
+            "model": args.model,
+            "fake_config": fake_config,
+            "env": extra_env,
+        },
+        "results": summarize(results, elapsed),
+    }
+    if before and after:
+        report["results"]["server"] = {
+            "cpu_ms_per_request": round((after["cpu_seconds"] - before["cpu_seconds"]) * 1000 / max(1, len(results)), 3),
+            "rss_mb_start": round(before["rss_mb"], 1),
+            "rss_mb_end": round(after["rss_mb"], 1),
+            "rss_mb_growth": round(after["rss_mb"] - before["rss_mb"], 1),
+        }
+    return report
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="Fraction of requests reusing one prompt (cache hits)")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--fake-config", default=None, help="JSON behaviour for the fake backend, see fake_genai.py")
+    parser.add_argument("--env", action="append", default=[], help="Extra server setting, e.g. --env STREAM_CACHE_ENABLED=false")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Report path (default: benchmarks/results/<scenario>-<time>.json)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{args.scenario}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(json.dumps(report["results"], indent=2))
+    print(f"Report written to {output}")
@@ -0,0 +1,97 @@
+import asyncio
+import time
+from enum import Enum
+from typing import AsyncGenerator, Dict, List, NamedTuple, Optional
+
+
+class FlushPolicyName(str, Enum):
+    immediate = "immediate"
+    balanced = "balanced"
+    throughput = "throughput"
+
+
+class FlushPolicy(NamedTuple):
+    # Flush once this many characters are buffered (characters ~ bytes for typical output)...
+    min_chars: int
+    # ...or once the oldest buffered chunk has waited this long
+    max_delay: float
+
+
+FLUSH_POLICIES: Dict[FlushPolicyName, Optional[FlushPolicy]] = {
+    FlushPolicyName.immediate: None,
+    FlushPolicyName.balanced: FlushPolicy(min_chars=64, max_delay=0.02),
+    FlushPolicyName.throughput: FlushPolicy(min_chars=512, max_delay=0.1),
+}
+
+
+async def coalesce(stream: AsyncGenerator[str, None], policy: Optional[FlushPolicy]) -> AsyncGenerator[str, None]:
+    """
+        Merges tiny text chunks so each HTTP write / SSE event carries more text.
+        The first chunk is always passed through at once so TTFB is unaffected;
+        after that a buffer is flushed on `min_chars` or `max_delay`, whichever comes first.
+    """
+    if policy is None:
+        async for text in stream:
+            yield text
+        return
+
+    buffer: List[str] = []
+    buffered = 0
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+    first = True
+
+    try:
+        while True:
+            if not buffer and pending is None:
+                # Nothing waiting to go out: a plain await, no timer or task needed
+                try:
+                    text = await stream.__anext__()
+                except StopAsyncIteration:
+                    return
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(stream.__anext__())
+                timeout = max(0.0, deadline - time.monotonic()) if buffer else None
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    # Latency window elapsed; keep the read in flight and flush what we have
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered = 0
+                    continue
+                task, pending = pending, None
+                try:
+                    text = task.result()
+                except StopAsyncIteration:
+                    break
+
+            if first:
+                first = False
+                yield text
+                continue
+
+            if not buffer:
+                deadline = time.monotonic() + policy.max_delay
+            buffer.append(text)
+            buffered += len(text)
+            if buffered >= policy.min_chars:
+                yield "".join(buffer)
+                buffer.clear()
+                buffered = 0
+    except Exception:
+        # Deliver what was already generated before surfacing the error
+        if buffer:
+            yield "".join(buffer)
+            buffer.clear()
+        raise
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+
+    if buffer:
+        yield "".join(buffer)
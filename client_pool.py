@@ -0,0 +1,182 @@
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def build_genai_client(
+    api_key: str,
+    max_connections: int = 200,
+    max_keepalive: int = 100,
+    keepalive_expiry: float = 30.0,
+    http2: bool = True
+) -> Any:
+    """A genai.Client whose async HTTP pool is sized for many concurrent streams."""
+    import httpx
+    from google import genai
+    from google.genai import types
+
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("HTTP/2 requested but the h2 package is not installed; using HTTP/1.1")
+            http2 = False
+
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            async_client_args={
+                "limits": httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive,
+                    keepalive_expiry=keepalive_expiry
+                ),
+                "http2": http2,
+            }
+        )
+    )
+
+
+class PooledKey:
+    """One API key/project: its client, its own quota limiter and per-model cooldowns."""
+
+    def __init__(self, name: str, client: Any, rate_limiter: Optional[RateLimiter] = None):
+        self.name = name
+        self.client = client
+        self.rate_limiter = rate_limiter
+        self.in_flight = 0
+        self.requests = 0
+        self.cooldowns: Dict[str, float] = {}
+        self.cooldown_reasons: Dict[str, str] = {}
+
+    def cooldown_until(self, model: str) -> float:
+        return self.cooldowns.get(model, 0.0)
+
+    def headroom(self, model: str) -> float:
+        limiter = self.rate_limiter.for_model(model) if self.rate_limiter is not None else None
+        if limiter is None:
+            return 0.0
+        return limiter.headroom()
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "cooldowns": {
+                model: {"reason": self.cooldown_reasons.get(model), "remaining": round(until - now, 1)}
+                for model, until in self.cooldowns.items()
+                if until > now
+            },
+            "rate_limiter": self.rate_limiter.snapshot() if self.rate_limiter else None,
+        }
+
+
+class Lease:
+    """A key checked out for one upstream call (or one whole stream); release() is idempotent."""
+
+    __slots__ = ("key", "_released")
+
+    def __init__(self, key: PooledKey):
+        self.key = key
+        self._released = False
+        key.in_flight += 1
+        key.requests += 1
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.key.in_flight -= 1
+
+    def __enter__(self) -> "Lease":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class LeasedStream:
+    """Upstream chunk iterator that gives its key back when it ends, fails or is closed."""
+
+    def __init__(self, stream: Any, lease: Lease):
+        self._stream = stream
+        self.lease = lease
+
+    def __aiter__(self) -> "LeasedStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self.lease.release()
+            raise
+
+    async def aclose(self) -> None:
+        self.lease.release()
+        aclose = getattr(self._stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class ClientPool:
+    """
+        Spreads upstream calls over several keys: the key with the most quota headroom
+        and the fewest in-flight calls wins, and a key that Gemini rate-limits or
+        tier-blocks for a model is left out for that model until its cooldown ends.
+    """
+
+    def __init__(self, keys: List[PooledKey], rate_limited_cooldown: float = 10.0, tier_blocked_cooldown: float = 600.0):
+        if not keys:
+            raise ValueError("ClientPool needs at least one key")
+        self.keys = keys
+        self.rate_limited_cooldown = rate_limited_cooldown
+        self.tier_blocked_cooldown = tier_blocked_cooldown
+
+    @property
+    def primary(self) -> PooledKey:
+        # Resources that are scoped to a project (context caches, batch jobs) live on the primary key
+        return self.keys[0]
+
+    def pick(self, model: str, pinned: bool = False) -> PooledKey:
+        if pinned or len(self.keys) == 1:
+            return self.primary
+
+        now = time.monotonic()
+        ready = [k for k in self.keys if k.cooldown_until(model) <= now]
+        if not ready:
+            # Everything is cooling down: the key that recovers first is the best bet
+            return min(self.keys, key=lambda k: k.cooldown_until(model))
+        return max(ready, key=lambda k: (k.headroom(model) - k.in_flight, -k.requests))
+
+    def has_ready_key(self, model: str, exclude: Optional[PooledKey] = None) -> bool:
+        now = time.monotonic()
+        return any(k is not exclude and k.cooldown_until(model) <= now for k in self.keys)
+
+    def report_error(self, key: PooledKey, model: str, status_code: int, is_retryable: bool) -> None:
+        """Takes `key` out of rotation for `model` after a quota or tier error."""
+        if status_code != 429 or len(self.keys) == 1:
+            return
+
+        reason, cooldown = ("rate_limited", self.rate_limited_cooldown) if is_retryable else ("tier_blocked", self.tier_blocked_cooldown)
+        key.cooldowns[model] = time.monotonic() + cooldown
+        key.cooldown_reasons[model] = reason
+        logger.warning(f"API key {key.name} {reason} for {model}; out of rotation for {cooldown:.0f}s")
+
+    def is_saturated(self, model: str) -> bool:
+        """True when no key could take a request for `model` right now."""
+        now = time.monotonic()
+        for key in self.keys:
+            if key.cooldown_until(model) > now:
+                continue
+            limiter = key.rate_limiter.for_model(model) if key.rate_limiter is not None else None
+            if limiter is None or not limiter.is_saturated():
+                return False
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {key.name: key.snapshot() for key in self.keys}
@@ -0,0 +1,289 @@
+import base64
+import hashlib
+import logging
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/x-ndjson")
+# Compressed from the response start, whatever their size, so their headers aren't held back
+STREAMING_TYPES = ("text/event-stream", "application/x-ndjson")
+
+# Raw-content dictionary for Compression Dictionary Transport (Content-Encoding: dcz):
+# the framing every stream repeats, so even the first events compress well
+DEFAULT_DICTIONARY = (
+    b'event: chunk\ndata: {"text": "'
+    b'"}\n\nevent: done\ndata: {}\n\nevent: sse_error\ndata: {"message": "'
+    b'{"text": "'
+    b'"}\n'
+    b'{"detail": {"error": "LLM_PROVIDER_ERROR", "type": "LLMServiceError", "message": "'
+    b' the of and to in is that for it with as on be this are'
+)
+DICTIONARY_MATCH = "/api/v1/chat/*"
+_DCZ_MAGIC = b"\x5e\x2a\x4d\x18\x20\x00\x00\x00"
+
+
+# --- 1. Streaming compressors ---
+# Each one exposes compress(chunk) -> bytes that can be decoded up to that point
+# (sync/block flush), plus finish() for the trailer.
+
+class _GzipEncoder:
+    def __init__(self, level: int):
+        self._c = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.compress(data) + self._c.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._c.flush()
+
+
+class _BrotliEncoder:
+    def __init__(self, quality: int):
+        self._c = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._c.process(data) + self._c.flush()
+
+    def finish(self) -> bytes:
+        return self._c.finish()
+
+
+class _ZstdEncoder:
+    def __init__(self, level: int, dictionary: Optional[Any] = None, prefix: bytes = b""):
+        self._c = zstandard.ZstdCompressor(level=level, dict_data=dictionary).compressobj()
+        self._prefix = prefix
+
+    def compress(self, data: bytes) -> bytes:
+        out = self._c.compress(data) + self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self._prefix:
+            out, self._prefix = self._prefix + out, b""
+        return out
+
+    def finish(self) -> bytes:
+        out = self._c.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+        if self._prefix:
+            out, self._prefix = self._prefix + out, b""
+        return out
+
+
+def available_encodings() -> List[str]:
+    encodings = ["gzip"]
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    accepted: Dict[str, float] = {}
+    for item in header.split(","):
+        token, _, params = item.strip().partition(";")
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token.strip().lower()] = q
+    return accepted
+
+
+# --- 2. ASGI middleware ---
+
+class CompressionMiddleware:
+    """
+        Negotiates zstd/br/gzip from Accept-Encoding without breaking streaming.
+        A complete body smaller than `min_size` goes out as-is; a streamed body is
+        compressed message by message with a sync flush, so each chunk reaches the
+        client as soon as it is produced. Compressed responses get an encoding-suffixed
+        ETag, and every negotiable response carries Vary: Accept-Encoding.
+    """
+
+    def __init__(
+        self,
+        app: Callable,
+        preference: Tuple[str, ...] = ("zstd", "br", "gzip"),
+        min_size: int = 1024,
+        gzip_level: int = 5,
+        brotli_quality: int = 4,
+        zstd_level: int = 3,
+        dictionary: Optional[bytes] = None
+    ):
+        self.app = app
+        supported = set(available_encodings())
+        self.preference = tuple(e for e in preference if e in supported)
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+
+        # Shared dictionary (dcz) needs zstd; the header value is the client's sha-256 of it
+        self._dictionary = None
+        self._dictionary_header = None
+        self._dcz_prefix = b""
+        if dictionary and zstandard is not None:
+            digest = hashlib.sha256(dictionary).digest()
+            self._dictionary = zstandard.ZstdCompressionDict(dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            self._dictionary_header = f":{base64.b64encode(digest).decode('ascii')}:"
+            self._dcz_prefix = _DCZ_MAGIC + digest
+        elif dictionary:
+            logger.warning("Compression dictionary configured but zstandard is not installed; dcz disabled.")
+
+        logger.info(f"Response compression enabled: {', '.join(self.preference) or 'none'}")
+
+    def _choose(self, headers: Dict[bytes, bytes]) -> Optional[str]:
+        accepted = parse_accept_encoding(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if (
+            self._dictionary is not None
+            and accepted.get("dcz", 0) > 0
+            and headers.get(b"available-dictionary", b"").decode("latin-1").strip() == self._dictionary_header
+        ):
+            return "dcz"
+        wildcard = accepted.get("*", 0)
+        for encoding in self.preference:
+            if accepted.get(encoding, wildcard) > 0:
+                return encoding
+        return None
+
+    def _encoder(self, encoding: str):
+        if encoding == "gzip":
+            return _GzipEncoder(self.gzip_level)
+        if encoding == "br":
+            return _BrotliEncoder(self.brotli_quality)
+        if encoding == "dcz":
+            return _ZstdEncoder(self.zstd_level, self._dictionary, self._dcz_prefix)
+        return _ZstdEncoder(self.zstd_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self._choose(dict(scope["headers"]))
+        if encoding is None:
+            await self.app(scope, receive, self._passthrough(send))
+            return
+
+        # The client revalidates the compressed variant's ETag; the app only knows the plain one
+        scope, revalidating = _strip_etag_suffix(scope, encoding)
+
+        start_message = None
+        encoder = None
+        passthrough = False
+
+        async def _start(headers: Dict[bytes, bytes]) -> None:
+            nonlocal encoder
+            encoder = self._encoder(encoding)
+            vary = b"accept-encoding, available-dictionary" if encoding == "dcz" else b"accept-encoding"
+            start_message["headers"] = [
+                (k, v) for k, v in start_message.get("headers", []) if k not in (b"content-length", b"vary", b"etag")
+            ] + [(b"content-encoding", encoding.encode("ascii")), (b"vary", _merge_vary(headers.get(b"vary"), vary))]
+            if b"etag" in headers:
+                start_message["headers"].append((b"etag", _suffix_etag(headers[b"etag"], encoding)))
+            await send(start_message)
+
+        async def _send(message):
+            nonlocal start_message, passthrough
+
+            if message["type"] == "http.response.start":
+                start_message = message
+                headers = dict(message.get("headers", []))
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if b"content-encoding" in headers or message["status"] in (204, 304) or not content_type.startswith(COMPRESSIBLE_TYPES):
+                    passthrough = True
+                    if message["status"] == 304 and revalidating and b"etag" in headers:
+                        # Confirms the variant the client holds, under the ETag it holds it by
+                        message["headers"] = [(k, v) for k, v in message.get("headers", []) if k != b"etag"] + [
+                            (b"etag", _suffix_etag(headers[b"etag"], encoding))
+                        ]
+                    await send(message)
+                elif content_type.startswith(STREAMING_TYPES):
+                    # Streams are always compressed: headers go out now, not with the first token
+                    await _start(headers)
+                return
+
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if encoder is None:
+                headers = dict(start_message.get("headers", []))
+                if not more_body and len(body) < self.min_size:
+                    passthrough = True
+                    start_message["headers"] = [(k, v) for k, v in start_message.get("headers", []) if k != b"vary"] + [
+                        (b"vary", _merge_vary(headers.get(b"vary"), b"accept-encoding"))
+                    ]
+                    await send(start_message)
+                    await send(message)
+                    return
+                await _start(headers)
+
+            out = encoder.compress(body) if body else b""
+            if not more_body:
+                out += encoder.finish()
+            await send({"type": "http.response.body", "body": out, "more_body": more_body})
+
+        await self.app(scope, receive, _send)
+
+    def _passthrough(self, send):
+        """The client accepts no encoding we offer: responses are unchanged, but still marked as negotiated."""
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                headers = dict(message.get("headers", []))
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if b"content-encoding" not in headers and content_type.startswith(COMPRESSIBLE_TYPES):
+                    message["headers"] = [(k, v) for k, v in message.get("headers", []) if k != b"vary"] + [
+                        (b"vary", _merge_vary(headers.get(b"vary"), b"accept-encoding"))
+                    ]
+            await send(message)
+        return _send
+
+
+def _merge_vary(existing: Optional[bytes], value: bytes) -> bytes:
+    if not existing:
+        return value
+    present = {token.strip().lower() for token in existing.split(b",")}
+    missing = [token.strip() for token in value.split(b",") if token.strip().lower() not in present]
+    return b", ".join([existing] + missing)
+
+
+def _suffix_etag(etag: bytes, encoding: str) -> bytes:
+    """A compressed body is a different representation, so it gets its own ETag: "abc" -> "abc-gzip"."""
+    if etag.endswith(b'"'):
+        return etag[:-1] + b"-" + encoding.encode("ascii") + b'"'
+    return etag
+
+
+def _strip_etag_suffix(scope: Dict[str, Any], encoding: str) -> Tuple[Dict[str, Any], bool]:
+    """Maps If-None-Match values of the compressed variant back to the app's ETags; True if any was."""
+    suffix = b"-" + encoding.encode("ascii") + b'"'
+    headers = scope["headers"]
+    stripped = False
+    rewritten = []
+    for key, value in headers:
+        if key == b"if-none-match" and suffix in value:
+            value = value.replace(suffix, b'"')
+            stripped = True
+        rewritten.append((key, value))
+    if not stripped:
+        return scope, False
+    return {**scope, "headers": rewritten}, True
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, Optional, Tuple
+
+from metrics import CANCELLED_REQUESTS, CANCEL_SAVED_SECONDS, CANCEL_SAVED_TOKENS
+
+logger = logging.getLogger(__name__)
+
+DisconnectCheck = Callable[[], Awaitable[bool]]
+
+
+class ClientDisconnected(Exception):
+    """The client went away before its response was ready; the upstream work was cancelled."""
+
+
+# --- 1. Savings estimate ---
+
+class CancellationTracker:
+    """
+        Learns how long and how large a finished response usually is per (model, call)
+        and credits the unread remainder of a cancelled one as saved seconds and tokens
+        (~4 characters per token, as for admission).
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._profiles: Dict[Tuple[str, str], list] = {}
+        self.cancelled = 0
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0.0
+
+    def observe_completed(self, model: str, call: str, chars: int, seconds: float) -> None:
+        profile = self._profiles.get((model, call))
+        if profile is None:
+            self._profiles[(model, call)] = [float(chars), seconds]
+            return
+        profile[0] += self.alpha * (chars - profile[0])
+        profile[1] += self.alpha * (seconds - profile[1])
+
+    def observe_cancelled(self, model: str, call: str, chars: int, seconds: float) -> None:
+        expected_chars, expected_seconds = self._profiles.get((model, call), (0.0, 0.0))
+        saved_seconds = max(0.0, expected_seconds - seconds)
+        saved_tokens = max(0.0, expected_chars - chars) / 4
+
+        self.cancelled += 1
+        self.saved_seconds += saved_seconds
+        self.saved_tokens += saved_tokens
+        CANCELLED_REQUESTS.labels(model, call).inc()
+        CANCEL_SAVED_SECONDS.labels(model, call).inc(saved_seconds)
+        CANCEL_SAVED_TOKENS.labels(model, call).inc(saved_tokens)
+        logger.info(f"Client disconnected from a {call} on {model} after {seconds:.2f}s; upstream cancelled")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cancelled": self.cancelled,
+            "saved_seconds": round(self.saved_seconds, 2),
+            "saved_tokens_estimate": round(self.saved_tokens),
+        }
+
+
+# --- 2. Disconnect polling ---
+
+async def _watch(is_disconnected: DisconnectCheck, poll_interval: float) -> None:
+    """Returns once the client is gone; never returns for a client that stays."""
+    while not await is_disconnected():
+        await asyncio.sleep(poll_interval)
+
+
+async def cancel_on_disconnect(
+    stream: AsyncGenerator[str, None],
+    is_disconnected: DisconnectCheck,
+    tracker: CancellationTracker,
+    model: str,
+    poll_interval: float = 0.5
+) -> AsyncGenerator[str, None]:
+    """
+        Passes `stream` through until the client disconnects, then closes it within
+        `poll_interval` even while upstream is silent. Closing runs the finally blocks
+        down the chain, which give back the key, the scheduler slot and the upstream connection.
+    """
+    started = time.monotonic()
+    chars = 0
+    watcher = asyncio.ensure_future(_watch(is_disconnected, poll_interval))
+    pending: Optional[asyncio.Future] = None
+    outcome: Optional[str] = None
+
+    try:
+        while True:
+            pending = asyncio.ensure_future(stream.__anext__())
+            await asyncio.wait({pending, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if not pending.done():
+                return
+            task, pending = pending, None
+            try:
+                text = task.result()
+            except StopAsyncIteration:
+                outcome = "completed"
+                return
+            except BaseException:
+                outcome = "failed"
+                raise
+            chars += len(text)
+            yield text
+    finally:
+        watcher.cancel()
+        if pending is not None:
+            # Cancelling the read unwinds the generators below it
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        await stream.aclose()
+
+        # Ours or the server's disconnect detection, whichever noticed first
+        elapsed = time.monotonic() - started
+        if outcome == "completed":
+            tracker.observe_completed(model, "stream", chars, elapsed)
+        elif outcome is None:
+            tracker.observe_cancelled(model, "stream", chars, elapsed)
+
+
+async def run_until_disconnect(
+    awaitable: Awaitable[Any],
+    is_disconnected: DisconnectCheck,
+    tracker: CancellationTracker,
+    model: str,
+    poll_interval: float = 0.5
+) -> Any:
+    """Awaits `awaitable`, or cancels it and raises ClientDisconnected once the client is gone."""
+    started = time.monotonic()
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_watch(is_disconnected, poll_interval))
+
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+
+    if not task.cancelled() and task.done():
+        result = task.result()
+        if isinstance(result, str):
+            tracker.observe_completed(model, "complete", len(result), time.monotonic() - started)
+        return result
+
+    # Let the cancellation unwind (closing the upstream call) before answering
+    await asyncio.wait({task})
+    tracker.observe_cancelled(model, "complete", 0, time.monotonic() - started)
+    raise ClientDisconnected(f"Client disconnected while waiting for {model}")
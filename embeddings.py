@@ -0,0 +1,272 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import mmap
+import os
+import re
+import sys
+from array import array
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking (Windows): one worker per cache directory
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Vectors are stored and sent as little-endian float32, whatever the host byte order
+_SWAP = sys.byteorder != "little"
+_DIGEST_SIZE = 16
+
+# (model, dimensions, task_type): vectors from different models/sizes/tasks never mix
+EmbeddingSpace = Tuple[str, int, Optional[str]]
+
+
+def text_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=_DIGEST_SIZE).digest()
+
+
+def pack_vector(values: List[float]) -> bytes:
+    packed = array("f", values)
+    if _SWAP:
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def vector_floats(row: Any) -> List[float]:
+    """A stored row as Python floats, for JSON responses."""
+    values = array("f")
+    values.frombytes(row)
+    if _SWAP:
+        values.byteswap()
+    return values.tolist()
+
+
+def vector_base64(row: Any) -> str:
+    # b64encode reads the mapped bytes in place
+    return base64.b64encode(row).decode("ascii")
+
+
+# --- 1. On-disk vector cache ---
+
+class VectorFile:
+    """
+        One embedding space on disk: `<name>.f32` holds fixed-size float32 rows and
+        `<name>.idx` the text digest of each row, in the same order. Both only ever grow.
+        Rows are read through a shared memory map, so a hit is a slice of the page cache.
+    """
+
+    def __init__(self, base: Path, dimensions: int):
+        self.dimensions = dimensions
+        self.row_bytes = dimensions * 4
+        self.data_path = base.with_suffix(".f32")
+        self.index_path = base.with_suffix(".idx")
+        self.data_path.touch(exist_ok=True)
+        self.index_path.touch(exist_ok=True)
+
+        self._rows: Dict[bytes, int] = {}
+        self._indexed = 0
+        self._map: Optional[mmap.mmap] = None
+        self._mapped_rows = 0
+        self._refresh()
+
+    def __len__(self) -> int:
+        return self._indexed
+
+    def _complete_rows(self) -> int:
+        """Rows present in both files; a writer that crashed between the two leaves a partial tail behind."""
+        return min(os.path.getsize(self.index_path) // _DIGEST_SIZE, os.path.getsize(self.data_path) // self.row_bytes)
+
+    def _refresh(self) -> None:
+        """Picks up rows appended since the last look, including those of other workers."""
+        rows = self._complete_rows()
+        if rows <= self._indexed:
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._indexed * _DIGEST_SIZE)
+            digests = f.read((rows - self._indexed) * _DIGEST_SIZE)
+        for i in range(0, len(digests), _DIGEST_SIZE):
+            self._rows.setdefault(digests[i:i + _DIGEST_SIZE], self._indexed + i // _DIGEST_SIZE)
+        self._indexed = rows
+
+    def _row(self, row: int) -> memoryview:
+        if row >= self._mapped_rows:
+            # Slices of the old map keep it alive until their readers are done
+            with open(self.data_path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._mapped_rows = len(self._map) // self.row_bytes
+        start = row * self.row_bytes
+        return memoryview(self._map)[start:start + self.row_bytes]
+
+    def get_many(self, digests: List[bytes]) -> List[Optional[memoryview]]:
+        rows = [self._rows.get(d) for d in digests]
+        if None in rows:
+            self._refresh()
+            rows = [self._rows.get(d) for d in digests]
+        return [self._row(r) if r is not None else None for r in rows]
+
+    def put_many(self, items: List[Tuple[bytes, bytes]]) -> None:
+        """Appends (digest, packed vector) pairs that aren't stored yet."""
+        with open(self.index_path, "r+b") as index, open(self.data_path, "r+b") as data:
+            if fcntl is not None:
+                fcntl.flock(index.fileno(), fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                # Rows are written at the committed count, which also overwrites any partial tail
+                row = self._complete_rows()
+                for digest, vector in items:
+                    if digest in self._rows or len(vector) != self.row_bytes:
+                        continue
+                    os.pwrite(data.fileno(), vector, row * self.row_bytes)
+                    os.pwrite(index.fileno(), digest, row * _DIGEST_SIZE)
+                    self._rows[digest] = row
+                    row += 1
+                self._indexed = row
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index.fileno(), fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """Content-hash-keyed vector cache in `directory`, one VectorFile per embedding space."""
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._files: Dict[EmbeddingSpace, VectorFile] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, space: EmbeddingSpace) -> VectorFile:
+        vector_file = self._files.get(space)
+        if vector_file is None:
+            model, dimensions, task_type = space
+            name = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{model}-{dimensions}-{task_type or 'default'}")
+            vector_file = VectorFile(self.directory / name, dimensions)
+            self._files[space] = vector_file
+        return vector_file
+
+    def get_many(self, space: EmbeddingSpace, texts: List[str]) -> List[Optional[memoryview]]:
+        rows = self._file(space).get_many([text_digest(t) for t in texts])
+        hits = sum(1 for r in rows if r is not None)
+        self.hits += hits
+        self.misses += len(rows) - hits
+        return rows
+
+    def put_many(self, space: EmbeddingSpace, texts: List[str], vectors: List[bytes]) -> None:
+        self._file(space).put_many([(text_digest(t), v) for t, v in zip(texts, vectors)])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "spaces": {f"{m}/{d}/{t or 'default'}": len(f) for (m, d, t), f in self._files.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# --- 2. Micro-batching ---
+
+class EmbeddingBatcher:
+    """
+        Collects texts from concurrent requests into one upstream call per embedding
+        space: a batch goes out when it reaches `max_batch` texts or `linger` seconds
+        after its first text. A text already on its way upstream is not sent twice.
+        When `split_on(error)` says the whole call was refused because of its input,
+        the texts are retried one by one, so only the caller of a bad text sees its error.
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[EmbeddingSpace, List[str]], Awaitable[List[bytes]]],
+        max_batch: int = 100,
+        linger: float = 0.005,
+        split_on: Optional[Callable[[Exception], bool]] = None
+    ):
+        self.embed_batch = embed_batch
+        self.max_batch = max_batch
+        self.linger = linger
+        self.split_on = split_on or (lambda _error: False)
+        self._pending: Dict[EmbeddingSpace, Dict[str, asyncio.Future]] = {}
+        self._timers: Dict[EmbeddingSpace, asyncio.TimerHandle] = {}
+        self._in_flight: Dict[Tuple[EmbeddingSpace, str], asyncio.Future] = {}
+        self.batches = 0
+        self.texts = 0
+        self.shared = 0
+        self.splits = 0
+
+    async def embed(self, space: EmbeddingSpace, texts: List[str]) -> List[bytes]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            future = self._in_flight.get((space, text))
+            if future is not None:
+                self.shared += 1
+            else:
+                future = loop.create_future()
+                self._in_flight[(space, text)] = future
+                pending = self._pending.setdefault(space, {})
+                pending[text] = future
+                if len(pending) >= self.max_batch:
+                    self._flush(space)
+                elif space not in self._timers:
+                    self._timers[space] = loop.call_later(self.linger, self._flush, space)
+            futures.append(future)
+        # Shielded: a caller that gives up must not cancel texts other requests are waiting for
+        return list(await asyncio.shield(asyncio.gather(*futures)))
+
+    def _flush(self, space: EmbeddingSpace) -> None:
+        timer = self._timers.pop(space, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(space, None)
+        if batch:
+            self.batches += 1
+            self.texts += len(batch)
+            asyncio.ensure_future(self._run(space, batch))
+
+    async def _run(self, space: EmbeddingSpace, batch: Dict[str, asyncio.Future]) -> None:
+        texts = list(batch)
+        try:
+            try:
+                vectors = await self.embed_batch(space, texts)
+            except Exception as e:
+                if len(texts) == 1 or not self.split_on(e):
+                    raise
+                self.splits += 1
+                logger.warning(f"Embedding batch of {len(texts)} refused ({e}); retrying its texts one by one")
+                results = await asyncio.gather(*(self.embed_batch(space, [text]) for text in texts), return_exceptions=True)
+                for text, result in zip(texts, results):
+                    if isinstance(result, asyncio.CancelledError):
+                        batch[text].cancel()
+                    elif isinstance(result, BaseException):
+                        batch[text].set_exception(result)
+                    else:
+                        batch[text].set_result(result[0])
+                return
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+        except BaseException:
+            for future in batch.values():
+                future.cancel()
+            raise
+        else:
+            for text, vector in zip(texts, vectors):
+                batch[text].set_result(vector)
+        finally:
+            for text in texts:
+                self._in_flight.pop((space, text), None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "avg_batch": round(self.texts / self.batches, 2) if self.batches else None,
+            "shared": self.shared,
+            "splits": self.splits,
+            "pending": sum(len(p) for p in self._pending.values()),
+        }
@@ -0,0 +1,135 @@
+import ast
+import logging
+from functools import lru_cache
+from typing import Any, Optional, Tuple, TypedDict
+
+logger = logging.getLogger(__name__)
+
+# Text fallback only: longer messages are cut here before any parsing
+MAX_MESSAGE_CHARS = 4096
+DEFAULT_PUBLIC_MESSAGE = "An AI provider error occurred."
+
+# gRPC-style statuses in Gemini error bodies, for errors that carry a status but no code
+_STATUS_CODES = {
+    "INVALID_ARGUMENT": 400,
+    "FAILED_PRECONDITION": 400,
+    "OUT_OF_RANGE": 400,
+    "UNAUTHENTICATED": 401,
+    "PERMISSION_DENIED": 403,
+    "NOT_FOUND": 404,
+    "RESOURCE_EXHAUSTED": 429,
+    "CANCELLED": 499,
+    "INTERNAL": 500,
+    "UNKNOWN": 500,
+    "UNAVAILABLE": 503,
+    "DEADLINE_EXCEEDED": 504,
+}
+
+# (public_message, status_code, is_retryable)
+Classification = Tuple[str, int, bool]
+
+
+class ErrorData(TypedDict):
+    public_message:str
+    status_code:int
+    is_retryable:bool
+    raw_info:str
+    internal_message:str
+
+
+# --- 1. Classification rules ---
+
+def _classify_message(message: str, code: Optional[int]) -> Classification:
+    """
+        The provider message decides first (it is what distinguishes a tier block from a
+        rate limit), then the status code. Without either, a generic retryable 500.
+    """
+    lowercase_msg = message.lower()
+
+    if code == 400 or any(word in lowercase_msg for word in ["temperature", "invalid", "400"]):
+        return message.split(':')[-1].strip() or DEFAULT_PUBLIC_MESSAGE, 400, False
+
+    if "tier" in lowercase_msg or "limit: 0" in lowercase_msg:
+        return "The selected model is unavailable on this account tier.", 429, False
+
+    if code == 429 or any(word in lowercase_msg for word in ["quota", "limit", "429"]):
+        return "Rate limit reached. Please wait a moment.", 429, True
+
+    public_message = message or DEFAULT_PUBLIC_MESSAGE
+    if code in (500, 502, 503, 504):
+        return public_message, code, True
+    if code in (401, 403):
+        # Our credentials, not the caller's: nothing the client can fix or retry
+        return DEFAULT_PUBLIC_MESSAGE, 500, False
+    if code == 404:
+        return public_message, 404, False
+    return public_message, 500, True
+
+
+def _leading_code(text: str) -> Optional[int]:
+    """The SDK formats its errors as "<code> <STATUS>. {...}": the code survives truncation."""
+    head = text[:4]
+    digits = head.split(" ", 1)[0]
+    return int(digits) if digits.isdigit() and len(digits) == 3 else None
+
+
+@lru_cache(maxsize=1024)
+def _classify_text(text: str) -> Tuple[Classification, bool]:
+    """
+        Fallback for exceptions without structured fields: the SDK's `{'error': {...}}`
+        payload is located with find/rfind (no regex backtracking) and parsed once per
+        distinct message. Returns (classification, parsed).
+    """
+    start = text.find("{")
+    end = text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            # The SDK prints the body as a Python dict (single quotes), hence literal_eval
+            error = ast.literal_eval(text[start:end + 1]).get("error", {})
+            code = error.get("code")
+            if not isinstance(code, int):
+                code = _STATUS_CODES.get(error.get("status")) or _leading_code(text)
+            return _classify_message(error.get("message", "") or "", code), True
+        except Exception:
+            pass
+
+    code = _leading_code(text)
+    if code is not None:
+        # Body missing or cut off by the length bound: the status code alone still classifies it
+        return _classify_message("", code), True
+    return (DEFAULT_PUBLIC_MESSAGE, 500, True), False
+
+
+# --- 2. Entry point ---
+
+def classify_error(error: Any) -> ErrorData:
+    """ErrorData for a provider exception: structured SDK attributes first, bounded text parsing otherwise."""
+    raw_error_str = str(error)
+    if len(raw_error_str) > MAX_MESSAGE_CHARS:
+        raw_error_str = raw_error_str[:MAX_MESSAGE_CHARS] + "...[truncated]"
+
+    code = getattr(error, "code", None)
+    status = getattr(error, "status", None)
+    if isinstance(code, int) or isinstance(status, str):
+        # google.genai.errors.APIError (and lookalikes): code, status and message are already parsed
+        if not isinstance(code, int):
+            code = _STATUS_CODES.get(status)
+        message = getattr(error, "message", None) or ""
+        public_message, status_code, is_retryable = _classify_message(str(message), code)
+    else:
+        (public_message, status_code, is_retryable), parsed = _classify_text(raw_error_str)
+        if not parsed:
+            logger.debug(f"Unstructured provider error, using the generic classification: {raw_error_str[:200]}")
+
+    return {
+        "public_message": public_message,
+        "status_code": status_code,
+        "is_retryable": is_retryable,
+        "raw_info": raw_error_str,
+        "internal_message": raw_error_str,
+    }
+
+
+def classification_cache_info() -> dict:
+    info = _classify_text.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize}
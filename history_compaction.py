@@ -0,0 +1,167 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+# (previous summary or None, turns to fold in, requester) -> new summary
+Summarizer = Callable[[Optional[str], List[dict], Any], Awaitable[str]]
+
+
+@lru_cache(maxsize=65536)
+def estimate_text_tokens(text: str) -> int:
+    """
+        Local token estimate (~4 UTF-8 bytes per token). Cached because the same
+        history turns are counted again on every request of a conversation.
+    """
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def estimate_item_tokens(item: dict) -> int:
+    # A few tokens of per-turn framing on top of the text itself
+    return 4 + sum(estimate_text_tokens(part.get("text", "")) for part in item.get("parts", []))
+
+
+def rolling_hashes(items: List[dict]) -> List[str]:
+    """hashes[i] identifies the prefix items[:i + 1]; each step only hashes one turn."""
+    hashes = []
+    previous = b""
+    for item in items:
+        h = hashlib.sha256(previous)
+        h.update(item["role"].encode("utf-8"))
+        h.update(b"\0")
+        for part in item.get("parts", []):
+            h.update(part.get("text", "").encode("utf-8"))
+        previous = h.digest()
+        hashes.append(previous.hex())
+    return hashes
+
+
+class HistoryCompactor:
+    """
+        Keeps prepared contents under a per-model token budget: the most recent
+        turns are sent verbatim and older turns are replaced by a summary.
+        Split points are aligned to `summary_block` turns so one summary serves
+        several consecutive requests, and each new summary extends the previous one.
+    """
+
+    def __init__(
+        self,
+        summarize: Summarizer,
+        default_budget: int = 32_000,
+        model_budgets: Optional[Dict[str, int]] = None,
+        keep_recent_turns: int = 6,
+        summary_block: int = 8,
+        summary_max_tokens: int = 512,
+        max_cached_summaries: int = 4096
+    ):
+        self.summarize = summarize
+        self.default_budget = default_budget
+        self.model_budgets = model_budgets or {}
+        self.keep_recent_turns = keep_recent_turns
+        self.summary_block = summary_block
+        self.summary_max_tokens = summary_max_tokens
+        self.max_cached_summaries = max_cached_summaries
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        self._flight = SingleFlight()
+        self.compactions = 0
+        self.summaries_generated = 0
+        self.summary_cache_hits = 0
+
+    def budget_for(self, model: str) -> int:
+        return self.model_budgets.get(model, self.default_budget)
+
+    async def compact(self, contents: List[dict], model: str, requester: Any = None) -> List[dict]:
+        """
+            `contents` is the output of _prepare_contents; the last item is the new prompt.
+            `requester` is handed to the summarizer, which charges the summary to it.
+        """
+        budget = self.budget_for(model)
+        tokens = [estimate_item_tokens(item) for item in contents]
+        if sum(tokens) <= budget or len(contents) < 2:
+            return contents
+
+        history, prompt = contents[:-1], contents[-1]
+
+        # Walk back from the newest turn while it fits, always keeping a few recent turns
+        keep_budget = budget - self.summary_max_tokens - tokens[-1]
+        keep_from = len(history)
+        used = 0
+        while keep_from > 0:
+            turn_tokens = tokens[keep_from - 1]
+            if len(history) - keep_from >= self.keep_recent_turns and used + turn_tokens > keep_budget:
+                break
+            used += turn_tokens
+            keep_from -= 1
+
+        # Align down to a block boundary so the same summary is reused on the next turns;
+        # the few extra verbatim turns this keeps are the price of not re-summarizing.
+        # Less than a block to fold in: summarize exactly what doesn't fit rather than drop it
+        split = (keep_from // self.summary_block) * self.summary_block or keep_from
+        if split == 0:
+            # Only the turns we always keep, nothing older to fold in
+            return contents
+        self.compactions += 1
+
+        try:
+            summary = await self._summary_for(history, split, requester)
+        except Exception as e:
+            logger.error(f"History summarization failed, truncating instead: {e}")
+            return history[keep_from:] + [prompt]
+
+        summary_item = {"role": "user", "parts": [{"text": SUMMARY_PREFIX + summary}]}
+        return [summary_item] + history[split:] + [prompt]
+
+    async def _summary_for(self, history: List[dict], split: int, requester: Any) -> str:
+        hashes = rolling_hashes(history[:split])
+        key = hashes[split - 1]
+
+        cached = self._get(key)
+        if cached is not None:
+            self.summary_cache_hits += 1
+            return cached
+
+        # Concurrent requests of the same conversation share one summarization
+        return await self._flight.do(key, lambda: self._build_summary(history, hashes, split, requester))
+
+    async def _build_summary(self, history: List[dict], hashes: List[str], split: int, requester: Any) -> str:
+        # Start from the longest already-summarized block prefix, if any
+        base = 0
+        previous = None
+        for boundary in range(split - self.summary_block, 0, -self.summary_block):
+            previous = self._get(hashes[boundary - 1])
+            if previous is not None:
+                base = boundary
+                break
+
+        summary = await self.summarize(previous, history[base:split], requester)
+        self.summaries_generated += 1
+        self._put(hashes[split - 1], summary)
+        return summary
+
+    def _get(self, key: str) -> Optional[str]:
+        summary = self._summaries.get(key)
+        if summary is not None:
+            self._summaries.move_to_end(key)
+        return summary
+
+    def _put(self, key: str, summary: str) -> None:
+        self._summaries[key] = summary
+        self._summaries.move_to_end(key)
+        while len(self._summaries) > self.max_cached_summaries:
+            self._summaries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "compactions": self.compactions,
+            "summaries_generated": self.summaries_generated,
+            "summary_cache_hits": self.summary_cache_hits,
+            "cached_summaries": len(self._summaries),
+            "estimator_cache": estimate_text_tokens.cache_info()._asdict(),
+        }
@@ -0,0 +1,340 @@
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+# The JSON Schema subset enforced locally: type, enum, properties, required,
+# additionalProperties (false only), items. Gemini constrains decoding with the full
+# schema; this only catches what slips through (truncation, unsupported keywords).
+_TYPE_CHECKS = {
+    "object": lambda v: isinstance(v, dict),
+    "array": lambda v: isinstance(v, list),
+    "string": lambda v: isinstance(v, str),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "null": lambda v: v is None,
+}
+
+_STRING_SPECIAL = re.compile(r'["\\]')
+_NUMBER_CHARS = frozenset("+-0123456789.eE")
+_LITERALS = {"true": True, "false": False, "null": None}
+
+
+class StructuredOutputError(Exception):
+    """The model's output is not a JSON document matching the requested schema."""
+
+    def __init__(self, message: str, errors: Optional[List[str]] = None):
+        self.errors = errors or []
+        super().__init__(message)
+
+
+# --- 1. Schema validation ---
+
+def validate(value: Any, schema: Optional[Dict[str, Any]], path: str = "$") -> List[str]:
+    """Violations of `schema` by `value`, as "path: problem" strings (empty when valid)."""
+    if not schema:
+        return []
+
+    errors: List[str] = []
+    expected = schema.get("type")
+    if expected is not None:
+        types = expected if isinstance(expected, list) else [expected]
+        if not any(_TYPE_CHECKS.get(t, lambda v: True)(value) for t in types):
+            return [f"{path}: expected {expected}, got {type(value).__name__}"]
+
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {value!r} is not one of {schema['enum']}")
+
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{path}: missing required property {name!r}")
+        for name, item in value.items():
+            if name in properties:
+                errors.extend(validate(item, properties[name], f"{path}.{name}"))
+            elif schema.get("additionalProperties") is False:
+                errors.append(f"{path}: unexpected property {name!r}")
+    elif isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for i, item in enumerate(value):
+            errors.extend(validate(item, schema["items"], f"{path}[{i}]"))
+
+    return errors
+
+
+def subschema(schema: Optional[Dict[str, Any]], key: Any) -> Optional[Dict[str, Any]]:
+    """The schema for member `key` (property name or array index) of a value described by `schema`."""
+    if not schema:
+        return None
+    if isinstance(key, int):
+        items = schema.get("items")
+        return items if isinstance(items, dict) else None
+    return schema.get("properties", {}).get(key)
+
+
+def parse_document(text: str, schema: Optional[Dict[str, Any]] = None) -> Any:
+    """A complete response: parsed and validated, or StructuredOutputError."""
+    try:
+        value = json.loads(text)
+    except ValueError as e:
+        raise StructuredOutputError(f"Model output is not valid JSON: {e}")
+    errors = validate(value, schema)
+    if errors:
+        raise StructuredOutputError("Model output does not match the response schema", errors)
+    return value
+
+
+# --- 2. Incremental parser ---
+
+class _Frame:
+    __slots__ = ("container", "key", "state")
+
+    def __init__(self, container: Any):
+        self.container = container
+        # Object: the key being filled; array: the index of the next element
+        self.key: Any = None if isinstance(container, dict) else 0
+        # "key" | "colon" | "value" | "comma"
+        self.state = "key" if isinstance(container, dict) else "value"
+
+
+class IncrementalJSONParser:
+    """
+        Parses one JSON document as text chunks arrive, in a single pass over the input.
+        Containers are built in place, so after every chunk the document so far can be
+        snapshotted; each member of the root that completes is reported with its path.
+        A "partial" snapshot is only emitted once the input has grown by `partial_growth`
+        since the last one: each snapshot repeats the whole document so far, so one per
+        chunk would add up to quadratic output, while geometric spacing keeps the total
+        within a few times the document's size.
+    """
+
+    def __init__(self, schema: Optional[Dict[str, Any]] = None, partial_growth: float = 0.25):
+        self.schema = schema
+        self.partial_growth = partial_growth
+        self._consumed = 0
+        self._partial_at = 0
+        self.root: Any = None
+        self.done = False
+        self._stack: List[_Frame] = []
+        # In-progress scalar: ("string", raw parts, is_key) | ("number", chars) | ("literal", chars)
+        self._token: Optional[tuple] = None
+        self._escaped = False
+        self._completed: List[tuple] = []
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        """Consumes a chunk; returns the events it produced (completed fields, then maybe a partial snapshot)."""
+        i, n = 0, len(text)
+        self._consumed += n
+        while i < n:
+            if self._token is not None and self._token[0] == "string":
+                i = self._scan_string(text, i)
+                continue
+
+            ch = text[i]
+            if self._token is not None:
+                kind, chars = self._token
+                if (kind == "number" and ch in _NUMBER_CHARS) or (kind == "literal" and ch.isalpha()):
+                    chars.append(ch)
+                    i += 1
+                    continue
+                self._token = None
+                self._complete_scalar(kind, "".join(chars))
+                continue
+
+            if ch in " \t\r\n":
+                i += 1
+                continue
+            if self.done:
+                raise StructuredOutputError(f"Unexpected data after the JSON document: {text[i:i + 20]!r}")
+
+            frame = self._stack[-1] if self._stack else None
+            state = frame.state if frame is not None else "value"
+
+            if ch == '"' and state in ("key", "value"):
+                self._token = ("string", [], state == "key")
+                self._escaped = False
+            elif state == "key" and ch == "}" and not frame.container:
+                self._close(frame)
+            elif state == "colon" and ch == ":":
+                frame.state = "value"
+            elif state == "comma" and ch == ",":
+                frame.state = "key" if isinstance(frame.container, dict) else "value"
+            elif state == "comma" and ch == ("}" if isinstance(frame.container, dict) else "]"):
+                self._close(frame)
+            elif state == "value" and ch == "]" and frame is not None and isinstance(frame.container, list) and not frame.container:
+                self._close(frame)
+            elif state == "value" and ch in "{[":
+                container: Any = {} if ch == "{" else []
+                self._attach(container)
+                self._stack.append(_Frame(container))
+            elif state == "value" and (ch in _NUMBER_CHARS):
+                self._token = ("number", [ch])
+            elif state == "value" and ch.isalpha():
+                self._token = ("literal", [ch])
+            else:
+                raise StructuredOutputError(f"Unexpected {ch!r} in JSON output at {self._where()}")
+            i += 1
+
+        events = [self._field_event(path, value) for path, value in self._completed]
+        self._completed.clear()
+        if self.root is not None and not self.done and self._consumed - self._partial_at >= self._partial_at * self.partial_growth:
+            self._partial_at = self._consumed
+            events.append({"type": "partial", "value": self.snapshot()})
+        return events
+
+    def finish(self) -> Dict[str, Any]:
+        """End of output: the final document, validated against the schema."""
+        if self._token is not None and self._token[0] != "string":
+            kind, chars = self._token
+            self._token = None
+            self._complete_scalar(kind, "".join(chars))
+        if not self.done:
+            raise StructuredOutputError(f"Model output ended inside the JSON document at {self._where()}")
+        errors = validate(self.root, self.schema)
+        if errors:
+            raise StructuredOutputError("Model output does not match the response schema", errors)
+        return {"type": "done", "value": self.root}
+
+    def path(self) -> List[Any]:
+        return [frame.key for frame in self._stack]
+
+    def _where(self) -> str:
+        return _format_path(self.path())
+
+    def snapshot(self) -> Any:
+        """
+            The document so far, including the text of a string still being generated.
+            Only the open containers (the current path) are copied; closed ones can't change
+            any more, so consecutive snapshots share them and a snapshot's cost doesn't grow
+            with the length of the document. Treat snapshots as read-only.
+        """
+        if not self._stack:
+            return self.root
+
+        copies = [frame.container.copy() for frame in self._stack]
+        for parent, child, frame in zip(copies, copies[1:], self._stack):
+            # An open child is the member being filled: the current key, or the last element
+            if isinstance(parent, dict):
+                parent[frame.key] = child
+            else:
+                parent[-1] = child
+
+        token = self._token
+        if token is not None and token[0] == "string" and not token[2]:
+            frame = self._stack[-1]
+            partial = _decode_partial("".join(token[1]))
+            if isinstance(copies[-1], dict):
+                copies[-1][frame.key] = partial
+            else:
+                copies[-1].append(partial)
+        return copies[0]
+
+    # Internals
+
+    def _scan_string(self, text: str, i: int) -> int:
+        parts = self._token[1]
+        if self._escaped:
+            # The escaped character itself (\uXXXX digits are plain characters after it)
+            parts.append(text[i])
+            self._escaped = False
+            return i + 1
+
+        match = _STRING_SPECIAL.search(text, i)
+        if match is None:
+            parts.append(text[i:])
+            return len(text)
+
+        j = match.start()
+        if j > i:
+            parts.append(text[i:j])
+        if text[j] == "\\":
+            parts.append("\\")
+            self._escaped = True
+            return j + 1
+
+        _, parts, is_key = self._token
+        self._token = None
+        raw = "".join(parts)
+        # Without escapes the raw text is the value; json.loads still rejects control characters
+        try:
+            value = json.loads('"' + raw + '"') if "\\" in raw or not raw.isprintable() else raw
+        except ValueError as e:
+            raise StructuredOutputError(f"Invalid string in JSON output at {self._where()}: {e.msg}")
+        if is_key:
+            frame = self._stack[-1]
+            frame.key = value
+            frame.state = "colon"
+        else:
+            self._complete(value)
+        return j + 1
+
+    def _complete_scalar(self, kind: str, raw: str) -> None:
+        if kind == "literal":
+            if raw not in _LITERALS:
+                raise StructuredOutputError(f"Invalid literal {raw!r} in JSON output at {self._where()}")
+            self._complete(_LITERALS[raw])
+            return
+        try:
+            self._complete(int(raw) if raw.isdigit() and (raw == "0" or raw[0] != "0") else json.loads(raw))
+        except ValueError:
+            raise StructuredOutputError(f"Invalid number {raw!r} in JSON output at {self._where()}")
+
+    def _attach(self, value: Any) -> None:
+        if not self._stack:
+            self.root = value
+            return
+        frame = self._stack[-1]
+        if isinstance(frame.container, dict):
+            frame.container[frame.key] = value
+        else:
+            frame.container.append(value)
+
+    def _complete(self, value: Any) -> None:
+        """A scalar finished: attach it and move its parent on."""
+        self._attach(value)
+        self._advance(value)
+
+    def _close(self, frame: _Frame) -> None:
+        self._stack.pop()
+        self._advance(frame.container)
+
+    def _advance(self, value: Any) -> None:
+        if not self._stack:
+            self.done = True
+            return
+        frame = self._stack[-1]
+        if len(self._stack) == 1:
+            self._completed.append(([frame.key], value))
+        if isinstance(frame.container, list):
+            frame.key += 1
+        frame.state = "comma"
+
+    def _field_event(self, path: List[Any], value: Any) -> Dict[str, Any]:
+        errors = validate(value, subschema(self.schema, path[-1]), _format_path(path))
+        if errors:
+            return {"type": "invalid", "path": path, "errors": errors}
+        return {"type": "field", "path": path, "value": value}
+
+
+def _format_path(path: List[Any]) -> str:
+    return "$" + "".join(f"[{p}]" if isinstance(p, int) else f".{p}" for p in path)
+
+
+def _decode_partial(raw: str) -> str:
+    """Decodes the escaped prefix of an unterminated JSON string, dropping a cut-off escape."""
+    cut = raw.rfind("\\")
+    if cut != -1:
+        # Count the backslashes before the last one to know whether it starts an escape
+        head = raw[:cut + 1]
+        run = len(head) - len(head.rstrip("\\"))
+        tail = raw[cut + 1:]
+        if run % 2 == 1 and (not tail or (tail[0] == "u" and len(tail) < 5)):
+            raw = raw[:cut]
+    try:
+        text = json.loads('"' + raw + '"')
+    except ValueError:
+        return ""
+    # The low half of an escaped surrogate pair may not have arrived yet
+    if text and "\ud800" <= text[-1] <= "\udbff":
+        text = text[:-1]
+    return text
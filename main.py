@@ -1,19 +1,58 @@
 # main.py
+# First, so the cold-start timeline includes every import below
+from startup import STARTUP, cancel_warm_up
+from contextlib import asynccontextmanager
+import asyncio
 import logging
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
 
-from LLMService import LLMServiceError
+from LLMService import GENAI_IMPORT_SECONDS, LLMServiceError, get_llm_service, get_settings
+from compression import DEFAULT_DICTIONARY, DICTIONARY_MATCH, CompressionMiddleware
+from metrics import ERRORS, render_metrics
 from routers import chat
 
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    STARTUP.record("imports", STARTUP.elapsed())
+    STARTUP.record("google_genai_import", GENAI_IMPORT_SECONDS)
+
+    # Built here rather than by the first request: settings, clients, caches, the models file
+    with STARTUP.phase("build_service"):
+        llm_service = get_llm_service()
+    with STARTUP.phase("load_models"):
+        # Normally already read while building the registry; a failed read is retried here
+        llm_service.model_registry.reload_if_changed()
+        STARTUP.models_loaded = len(llm_service.model_registry.model_ids())
+
+    # Keep the models list and their availability fresh in the background
+    llm_service.model_registry.start(llm_service.check_model)
+    # Periodically appends token usage to the usage log
+    llm_service.usage_meter.start()
+
+    # Warm-up runs behind /ready so liveness answers (and the worker accepts connections) right away
+    warm_up = None
+    if settings.warmup_enabled:
+        warm_up = asyncio.create_task(
+            STARTUP.warm_up(llm_service, settings.warmup_connections, settings.warmup_timeout)
+        )
+    else:
+        STARTUP.mark_ready()
+    yield
+    await cancel_warm_up(warm_up)
+    await llm_service.model_registry.stop()
+    # Final flush, so the last interval's usage isn't lost
+    await llm_service.usage_meter.stop()
+
 app = FastAPI(
     title = "LLM streaming API", 
-    version = "1.0.0"
+    version = "1.0.0",
+    lifespan = lifespan
 )
 
 #adding middleware
@@ -25,11 +64,46 @@ app.add_middleware(
     allow_headers = ["*"],
 )
 
+settings = get_settings()
+if settings.compression_enabled:
+    # Flushes at every chunk boundary, unlike GZipMiddleware which buffers streams
+    app.add_middleware(
+        CompressionMiddleware,
+        preference=tuple(settings.compression_preference),
+        min_size=settings.compression_min_size,
+        gzip_level=settings.compression_gzip_level,
+        brotli_quality=settings.compression_brotli_quality,
+        zstd_level=settings.compression_zstd_level,
+        dictionary=DEFAULT_DICTIONARY if settings.compression_dictionary_enabled else None
+    )
+
 #Registering chat.py
 app.include_router(chat.router, prefix="/api/v1/chat")
 
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """Readiness probe: 503 until the service is built and its upstream connections are warm"""
+    return JSONResponse(status_code=200 if STARTUP.ready else 503, content=STARTUP.report())
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/compression/dictionary", include_in_schema=False)
+async def compression_dictionary():
+    """Shared dictionary for dcz-capable clients; they advertise it back via Available-Dictionary"""
+    if not settings.compression_dictionary_enabled:
+        return Response(status_code=404)
+    return Response(
+        content=DEFAULT_DICTIONARY,
+        media_type="application/octet-stream",
+        headers={"Use-As-Dictionary": f'match="{DICTIONARY_MATCH}"', "Cache-Control": "public, max-age=86400"}
+    )
+
 @app.exception_handler(LLMServiceError)
 async def llm_error_handler(request: Request, e: LLMServiceError):
+    ERRORS.labels(request.url.path, e.status_code).inc()
     return JSONResponse(
         status_code=e.status_code,
         content = {
@@ -45,6 +119,7 @@ async def llm_error_handler(request: Request, e: LLMServiceError):
 @app.exception_handler(Exception)
 async def universal_exception_handler(request: Request, e: Exception):
     #log the full traceback for the devs
+    ERRORS.labels(request.url.path, 500).inc()
     logger.error(f"Unhandled system crash: {str(e)}", exc_info=True)
     return JSONResponse(
         status_code=500,
@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, AsyncGenerator, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- 1. Minimal Prometheus-compatible registry ---
+# Hand-rolled rather than prometheus_client: a labelled child is resolved once per
+# request/stream and each per-chunk update is a plain attribute increment.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    def __init__(self, kind: str, name: str, documentation: str, label_names: Tuple[str, ...], buckets=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: Any):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if self.kind == "histogram":
+                child = _HistogramChild(self.buckets)
+            elif self.kind == "gauge":
+                child = _GaugeChild()
+            else:
+                child = _CounterChild()
+            self._children[key] = child
+        return child
+
+    def _label_str(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in self._children.items():
+            if self.kind == "histogram":
+                cumulative = 0
+                for bound, count in zip(self.buckets, child.counts):
+                    cumulative += count
+                    le = self._label_str(key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = self._label_str(key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {child.count}")
+                lines.append(f"{self.name}_sum{self._label_str(key)} {child.sum}")
+                lines.append(f"{self.name}_count{self._label_str(key)} {child.count}")
+            else:
+                lines.append(f"{self.name}{self._label_str(key)} {child.value}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def counter(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric("counter", name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> Metric:
+        return self._register(Metric("gauge", name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Metric:
+        return self._register(Metric("histogram", name, documentation, label_names, tuple(buckets)))
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "llm_request_duration_seconds", "End-to-end handler time of non-streaming requests", ("endpoint", "model", "outcome")
+)
+STREAM_TTFB = REGISTRY.histogram(
+    "llm_stream_ttfb_seconds", "Time from request start to the first chunk", ("endpoint", "model")
+)
+STREAM_DURATION = REGISTRY.histogram(
+    "llm_stream_duration_seconds", "Total duration of streaming responses", ("endpoint", "model", "outcome")
+)
+STREAM_CHUNK_RATE = REGISTRY.histogram(
+    "llm_stream_chunks_per_second", "Chunks per second over a whole stream", ("endpoint", "model"), buckets=RATE_BUCKETS
+)
+STREAM_CHUNKS = REGISTRY.counter("llm_stream_chunks_total", "Chunks sent to clients", ("endpoint", "model"))
+UPSTREAM_DURATION = REGISTRY.histogram(
+    "llm_upstream_duration_seconds", "Time spent waiting on Gemini per attempt", ("model", "call")
+)
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "llm_upstream_errors_total", "Upstream failures by classified status code", ("model", "status_code")
+)
+ERRORS = REGISTRY.counter("llm_errors_total", "Errors returned to clients", ("endpoint", "status_code"))
+IN_FLIGHT = REGISTRY.gauge("llm_in_flight_requests", "Requests currently being served", ("endpoint",))
+FORMATTER_SECONDS = REGISTRY.counter(
+    "llm_formatter_seconds_total", "CPU time spent framing chunks in stream formatters", ("formatter",)
+)
+FORMATTER_CHUNKS = REGISTRY.counter("llm_formatter_chunks_total", "Chunks framed by stream formatters", ("formatter",))
+SCHEDULER_ACTIVE = REGISTRY.gauge("llm_scheduler_active", "Upstream slots in use per model", ("model",))
+SCHEDULER_QUEUE_DEPTH = REGISTRY.gauge(
+    "llm_scheduler_queue_depth", "Requests waiting for an upstream slot", ("model", "priority")
+)
+SCHEDULER_WAIT = REGISTRY.histogram(
+    "llm_scheduler_wait_seconds", "Time spent waiting for an upstream slot", ("model", "priority")
+)
+SCHEDULER_SHED = REGISTRY.counter(
+    "llm_scheduler_shed_total", "Requests rejected by the upstream scheduler", ("model", "priority", "reason")
+)
+CANCELLED_REQUESTS = REGISTRY.counter(
+    "llm_cancelled_requests_total", "Upstream calls cancelled because the client disconnected", ("model", "call")
+)
+CANCEL_SAVED_SECONDS = REGISTRY.counter(
+    "llm_cancel_saved_seconds_total", "Estimated upstream generation time saved by cancelling", ("model", "call")
+)
+CANCEL_SAVED_TOKENS = REGISTRY.counter(
+    "llm_cancel_saved_tokens_total", "Estimated output tokens not generated thanks to cancelling", ("model", "call")
+)
+STARTUP_SECONDS = REGISTRY.gauge(
+    "llm_startup_seconds", "Cold-start time of this worker by phase (total = until ready)", ("phase",)
+)
+READY = REGISTRY.gauge("llm_ready", "1 once startup warm-up has finished")
+USAGE_TOKENS = REGISTRY.counter(
+    "llm_usage_tokens_total", "Tokens reported by Gemini, by kind (prompt or output)", ("model", "endpoint", "kind")
+)
+BUDGET_REJECTED = REGISTRY.counter("llm_budget_rejected_total", "Requests refused because the client's token budget is spent")
+
+
+# --- 2. Optional OpenTelemetry ---
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import trace
+
+    _tracer = trace.get_tracer("llm-api")
+except ImportError:
+    otel_context = None
+    _tracer = None
+
+
+@contextmanager
+def start_span(name: str, **attributes: Any) -> Iterator[Any]:
+    """Span around a block of code; a no-op when OpenTelemetry is not installed."""
+    if _tracer is None:
+        yield None
+        return
+
+    with _tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as span:
+        yield span
+
+
+def capture_context() -> Optional[Any]:
+    """Trace context to parent spans that are opened later, e.g. inside a streaming generator."""
+    return otel_context.get_current() if otel_context is not None else None
+
+
+# --- 3. Stream instrumentation ---
+
+async def instrument_stream(
+    stream: AsyncGenerator[str, None],
+    endpoint: str,
+    model: Optional[str],
+    started: float,
+    parent_context: Optional[Any] = None,
+    first_chunk_seen: bool = False
+) -> AsyncGenerator[str, None]:
+    """
+        Wraps a text stream with TTFB, duration, chunk-rate and error metrics plus an
+        optional span. The span is started with an explicit parent instead of being
+        attached, since a generator's context can't be safely attached across yields.
+        `first_chunk_seen` is for callers that already timed the first chunk themselves.
+    """
+    model_label = model or "default"
+    chunks = STREAM_CHUNKS.labels(endpoint, model_label)
+    in_flight = IN_FLIGHT.labels(endpoint)
+    span = _tracer.start_span(f"{endpoint} stream", context=parent_context) if _tracer is not None else None
+
+    count = 0
+    outcome = "error"
+    in_flight.inc()
+    try:
+        async for text in stream:
+            if not first_chunk_seen:
+                first_chunk_seen = True
+                STREAM_TTFB.labels(endpoint, model_label).observe(time.perf_counter() - started)
+            count += 1
+            chunks.value += 1
+            yield text
+        outcome = "ok"
+    except (GeneratorExit, asyncio.CancelledError):
+        # The client went away before the end of the stream
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        ERRORS.labels(endpoint, getattr(e, "status_code", 500)).inc()
+        if span is not None:
+            span.record_exception(e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        in_flight.dec()
+        STREAM_DURATION.labels(endpoint, model_label, outcome).observe(elapsed)
+        if elapsed > 0 and count:
+            STREAM_CHUNK_RATE.labels(endpoint, model_label).observe(count / elapsed)
+        if span is not None:
+            span.set_attribute("llm.chunks", count)
+            span.set_attribute("llm.outcome", outcome)
+            span.end()
+
+
+@contextmanager
+def observe_request(endpoint: str, model: Optional[str]) -> Iterator[None]:
+    """Times a non-streaming request and tracks it in the in-flight gauge (errors are counted by the app handlers)."""
+    in_flight = IN_FLIGHT.labels(endpoint)
+    in_flight.inc()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        in_flight.dec()
+        REQUEST_DURATION.labels(endpoint, model or "default", outcome).observe(time.perf_counter() - started)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
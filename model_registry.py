@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Protocol
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_MODELS_PATH = Path(__file__).parent / "data" / "supported_models.json"
+
+# Virtual entries that are listed but never pinged
+VIRTUAL_MODEL_IDS = {"auto"}
+
+EMPTY_MODELS = {"models": [], "total_count": 0}
+
+AVAILABILITY_DOCUMENT = "models:availability"
+
+
+class RefreshCoordinator(Protocol):
+    """Lets several worker processes share one pinger (see shared_state.SharedStateClient)."""
+
+    async def lead(self, name: str, ttl: float) -> bool: ...
+
+    async def put_document(self, name: str, value: Any) -> None: ...
+
+    async def get_document(self, name: str) -> Any: ...
+
+
+class ModelsSnapshot:
+    """Immutable, pre-serialized view served by GET /models."""
+
+    def __init__(self, payload: Dict[str, Any]):
+        self.payload = payload
+        self.body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest() + '"'
+
+
+class ModelRegistry:
+    """
+        Loads data/supported_models.json once, hot-reloads it when its mtime changes,
+        and keeps model availability fresh in the background with LLMService.check_model.
+        A model is hidden as soon as a ping is refused outright (permission, not found,
+        tier), but only after `max_ping_failures` inconclusive pings (quota, timeout, 5xx)
+        in a row. Readers only ever touch the current in-memory snapshot.
+    """
+
+    def __init__(
+        self,
+        path: Path = SUPPORTED_MODELS_PATH,
+        refresh_interval: float = 300.0,
+        reload_check_interval: float = 5.0,
+        jitter: float = 0.1,
+        ping_batch_size: int = 2,
+        max_ping_failures: int = 3,
+        coordinator: Optional[RefreshCoordinator] = None,
+        bootstrap: Optional[Dict[str, Any]] = None
+    ):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.reload_check_interval = reload_check_interval
+        self.jitter = jitter
+        self.ping_batch_size = ping_batch_size
+        self.max_ping_failures = max_ping_failures
+        self.coordinator = coordinator
+
+        self._models: List[Dict[str, Any]] = []
+        self._mtime: Optional[float] = None
+        # model id -> (available, checked_at, consecutive inconclusive pings); unknown models are assumed available
+        self._availability: Dict[str, tuple] = {}
+        self._snapshot = ModelsSnapshot(EMPTY_MODELS)
+        self._task: Optional[asyncio.Task] = None
+        self.reloads = 0
+
+        if bootstrap is not None:
+            # Already read once by the supervisor; mtime checks still pick up later edits
+            self._load(bootstrap["models"], bootstrap["mtime"])
+        else:
+            self.reload_if_changed()
+
+    # --- Reads (hot path) ---
+
+    def snapshot(self) -> ModelsSnapshot:
+        return self._snapshot
+
+    def model_ids(self) -> List[str]:
+        return [m["id"] for m in self._models if m["id"] not in VIRTUAL_MODEL_IDS]
+
+    def is_available(self, model_id: str) -> bool:
+        state = self._availability.get(model_id)
+        return True if state is None else state[0]
+
+    # --- File loading ---
+
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError as e:
+            logger.error(f"Configuration Error: {e}")
+            return False
+
+        if mtime == self._mtime:
+            return False
+
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            models = list(data.get("models", []))
+        except (json.JSONDecodeError, AttributeError) as e:
+            # Keep serving the last good snapshot while the file is being edited
+            logger.error(f"Configuration Error: {e}")
+            return False
+
+        self._load(models, mtime)
+        return True
+
+    def _load(self, models: List[Dict[str, Any]], mtime: float) -> None:
+        self._mtime = mtime
+        self._models = models
+        self.reloads += 1
+        self._rebuild_snapshot()
+        logger.info(f"Loaded {len(models)} models from {self.path.name}")
+
+    def _rebuild_snapshot(self) -> None:
+        visible = [m for m in self._models if m["id"] in VIRTUAL_MODEL_IDS or self.is_available(m["id"])]
+        self._snapshot = ModelsSnapshot({"total_count": len(visible), "models": visible})
+
+    # --- Background refresh ---
+
+    def start(self, ping: Callable[[str], Awaitable[Optional[bool]]]) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(ping))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, ping) -> None:
+        while True:
+            try:
+                self.reload_if_changed()
+                if self.coordinator is None:
+                    await self.refresh_due(ping)
+                else:
+                    await self._refresh_coordinated(ping)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Model registry refresh failed: {e}")
+
+            delay = self.reload_check_interval * (1 + random.uniform(-self.jitter, self.jitter))
+            await asyncio.sleep(delay)
+
+    async def refresh_due(self, ping) -> None:
+        """Pings a small batch of the models whose availability is the most stale."""
+        now = time.time()
+        due = [
+            model_id for model_id in self.model_ids()
+            if now - self._availability.get(model_id, (True, 0.0))[1] >= self._interval_for(model_id)
+        ]
+        due.sort(key=lambda model_id: self._availability.get(model_id, (True, 0.0))[1])
+
+        for model_id in due[:self.ping_batch_size]:
+            result = await ping(model_id)
+            previous = self.is_available(model_id)
+            failures = 0
+            if result is None:
+                # Inconclusive: keep the last verdict until it has failed several times in a row
+                state = self._availability.get(model_id)
+                failures = (state[2] if state is not None and len(state) > 2 else 0) + 1
+                available = previous and failures < self.max_ping_failures
+            else:
+                available = result
+            self._availability[model_id] = (available, time.time(), failures)
+            if available != previous:
+                logger.info(f"Model {model_id} is now {'available' if available else 'unavailable'}")
+                self._rebuild_snapshot()
+
+    async def _refresh_coordinated(self, ping) -> None:
+        """Only the lease holder pings; every other worker adopts the availability it published."""
+        if await self.coordinator.lead("models-refresh", ttl=self.reload_check_interval * 3):
+            await self.refresh_due(ping)
+            await self.coordinator.put_document(
+                AVAILABILITY_DOCUMENT, {model_id: list(state) for model_id, state in self._availability.items()}
+            )
+            return
+
+        published = await self.coordinator.get_document(AVAILABILITY_DOCUMENT) or {}
+        availability = {model_id: tuple(state) for model_id, state in published.items()}
+        if availability != self._availability:
+            self._availability = availability
+            self._rebuild_snapshot()
+
+    def _interval_for(self, model_id: str) -> float:
+        # Per-model jitter keeps the pings spread out instead of firing in lockstep
+        spread = (hash(model_id) % 1000) / 1000 * 2 - 1
+        return self.refresh_interval * (1 + self.jitter * spread)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "path": str(self.path),
+            "reloads": self.reloads,
+            "refreshing": self._task is not None and not self._task.done(),
+            "availability": {
+                model_id: {"available": state[0], "checked_at": state[1], "failed_pings": state[2] if len(state) > 2 else 0}
+                for model_id, state in self._availability.items()
+            },
+        }
@@ -0,0 +1,126 @@
+import logging
+import math
+import random
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+AUTO_MODEL = "auto"
+
+# Upstream status codes that mean "this model cannot serve right now", as opposed to a bad request.
+# Requests the service sheds itself (local rate limits, scheduler queues) never fall back.
+FALLBACK_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ModelStats:
+    """EWMA of time-to-first-token, total latency and error rate for one model."""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.ttft: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+
+    def _ewma(self, current: Optional[float], sample: float) -> float:
+        return sample if current is None else (1 - self.alpha) * current + self.alpha * sample
+
+    def record_success(self, latency: Optional[float] = None, ttft: Optional[float] = None) -> None:
+        self.requests += 1
+        if latency is not None:
+            self.latency = self._ewma(self.latency, latency)
+        if ttft is not None:
+            self.ttft = self._ewma(self.ttft, ttft)
+        self.error_rate = self._ewma(self.error_rate, 0.0)
+
+    def record_error(self) -> None:
+        self.requests += 1
+        self.error_rate = self._ewma(self.error_rate, 1.0)
+
+    def score(self, streaming: bool) -> float:
+        """Lower is better; models without samples rank after measured ones."""
+        base = self.ttft if streaming else self.latency
+        if base is None:
+            return math.inf
+        return base * (1 + 4 * self.error_rate)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ttft_ewma": round(self.ttft, 4) if self.ttft is not None else None,
+            "latency_ewma": round(self.latency, 4) if self.latency is not None else None,
+            "error_rate_ewma": round(self.error_rate, 4),
+            "requests": self.requests,
+        }
+
+
+class ModelRouter:
+    """
+        Picks the model(s) to try for a request: the requested model followed by
+        its fallback chain, or for "auto" every healthy model, fastest first.
+        A fraction `explore_rate` of "auto" requests tries another model first
+        (unmeasured ones before the rest), so every model keeps getting measured.
+    """
+
+    def __init__(
+        self,
+        default_model: str,
+        fallback_chains: Optional[Dict[str, List[str]]] = None,
+        model_ids: Optional[Callable[[], List[str]]] = None,
+        is_available: Optional[Callable[[str], bool]] = None,
+        explore_rate: float = 0.05
+    ):
+        self.default_model = default_model
+        self.fallback_chains = fallback_chains or {}
+        self.model_ids = model_ids or (lambda: [])
+        self.is_available = is_available or (lambda _model: True)
+        self.explore_rate = explore_rate
+        self._stats: Dict[str, ModelStats] = {}
+        self.fallbacks = 0
+        self.explorations = 0
+
+    def stats(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = ModelStats()
+            self._stats[model] = stats
+        return stats
+
+    def candidates(self, requested: Optional[str], streaming: bool = False) -> List[str]:
+        """Ordered models to try. Unavailable models are skipped unless nothing else is left."""
+        if requested == AUTO_MODEL:
+            # Stable sort: unmeasured models keep the default-first, file order
+            pool = [self.default_model] + [m for m in self.model_ids() if m != self.default_model]
+            chain = sorted(pool, key=lambda m: self.stats(m).score(streaming))
+            if len(chain) > 1 and random.random() < self.explore_rate:
+                chain = self._explore(chain, streaming)
+        else:
+            primary = requested or self.default_model
+            chain = [primary] + [m for m in self.fallback_chains.get(primary, []) if m != primary]
+
+        healthy = [m for m in chain if self.is_available(m)]
+        # Everything looks saturated: still try the chain so the caller gets a real error
+        return healthy or chain
+
+    def _explore(self, chain: List[str], streaming: bool) -> List[str]:
+        """Moves an unmeasured model, or a random non-best one, to the front; the rest stay as fallbacks."""
+        unmeasured = [m for m in chain[1:] if self.stats(m).score(streaming) == math.inf]
+        probe = unmeasured[0] if unmeasured else random.choice(chain[1:])
+        self.explorations += 1
+        return [probe] + [m for m in chain if m != probe]
+
+    def record_success(self, model: str, latency: Optional[float] = None, ttft: Optional[float] = None) -> None:
+        self.stats(model).record_success(latency=latency, ttft=ttft)
+
+    def record_error(self, model: str) -> None:
+        self.stats(model).record_error()
+
+    def should_fall_back(self, error: Exception) -> bool:
+        return getattr(error, "status_code", None) in FALLBACK_STATUS_CODES
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "fallbacks": self.fallbacks,
+            "explorations": self.explorations,
+            "fallback_chains": self.fallback_chains,
+            "models": {model: stats.snapshot() for model, stats in self._stats.items()},
+        }
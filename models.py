@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 
 
@@ -12,4 +12,26 @@ class QueryRequest(BaseModel):
     prompt: str
     temperature: float = 0.7
     history: Optional[List[HistoryItem]] = None
-    model_name: Optional[str] = Field(None, examples=["gemini-2.5-flash-lite"])
\ No newline at end of file
+    model_name: Optional[str] = Field(None, examples=["gemini-2.5-flash-lite", "auto"])
+    # With a session the server keeps the history; `history` is ignored and only the new prompt is sent
+    session_id: Optional[str] = None
+    # JSON mode: the answer is a single JSON document; a JSON Schema also constrains its shape
+    response_format: Literal["text", "json"] = "text"
+    response_schema: Optional[Dict[str, Any]] = None
+
+class BatchRequest(BaseModel):
+    """Batch of complete requests; results stream back as NDJSON in completion order"""
+    requests: List[QueryRequest]
+    concurrency: Optional[int] = Field(None, ge=1)
+    # "gemini_batch" submits to Gemini's batch API: cheaper, but answers with job ids to poll at GET /batch/{job_id}
+    mode: Literal["online", "gemini_batch"] = "online"
+
+class EmbedRequest(BaseModel):
+    """Texts to embed; repeated texts are served from the vector cache"""
+    texts: List[str] = Field(..., min_length=1, max_length=1000)
+    model: Optional[str] = Field(None, examples=["gemini-embedding-001"])
+    dimensions: Optional[int] = Field(None, ge=1, le=3072)
+    # e.g. RETRIEVAL_DOCUMENT / RETRIEVAL_QUERY; vectors of different task types are cached apart
+    task_type: Optional[str] = None
+    # "base64": each vector as base64 of little-endian float32, about a quarter the size of JSON floats
+    encoding: Literal["float", "base64"] = "float"
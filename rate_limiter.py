@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request is shed before any upstream call is made."""
+
+    def __init__(self, model: str, reason: str, retry_after: float):
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Local rate limit for {model}: {reason} (retry after {retry_after:.2f}s)")
+
+
+# --- 1. Per-model limiter ---
+
+class ModelRateLimiter:
+    """
+        Token bucket for requests (RPM) and input tokens (TPM) with an AIMD rate:
+        the effective RPM is halved when Gemini answers 429 and grows back
+        additively on every success, never exceeding the configured budget.
+        The bucket holds `burst_seconds` worth of requests, so short bursts pass unthrottled.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        rpm: int,
+        tpm: int,
+        max_wait: float = 2.0,
+        max_queue: int = 100,
+        burst_seconds: float = 10.0,
+        min_rpm: float = 1.0,
+        increase_rpm: float = 1.0,
+        decrease_factor: float = 0.5,
+        decrease_cooldown: float = 1.0
+    ):
+        if rpm <= 0 or tpm <= 0:
+            raise ValueError(f"Rate limit for {model} must be positive, got rpm={rpm} tpm={tpm}")
+        self.model = model
+        self.max_rpm = float(rpm)
+        self.tpm = float(tpm)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.burst_seconds = burst_seconds
+        self.min_rpm = min(min_rpm, self.max_rpm)
+        self.increase_rpm = increase_rpm
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+
+        self.current_rpm = self.max_rpm
+        self._request_tokens = self._request_capacity()
+        self._input_tokens = self.tpm
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self.upstream_429s = 0
+
+    def _request_capacity(self) -> float:
+        return max(1.0, self.current_rpm / 60.0 * self.burst_seconds)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_tokens = min(self._request_capacity(), self._request_tokens + elapsed * self.current_rpm / 60.0)
+        self._input_tokens = min(self.tpm, self._input_tokens + elapsed * self.tpm / 60.0)
+
+    def _time_until_available(self, cost: float) -> float:
+        request_wait = max(0.0, (1.0 - self._request_tokens) * 60.0 / self.current_rpm)
+        token_wait = max(0.0, (cost - self._input_tokens) * 60.0 / self.tpm)
+        return max(request_wait, token_wait)
+
+    async def acquire(self, estimated_tokens: int = 0) -> None:
+        """Waits for budget for at most `max_wait` seconds, otherwise raises RateLimitExceeded."""
+        # A single huge prompt must still be admissible once the bucket is full
+        cost = min(float(estimated_tokens), self.tpm)
+
+        if self.waiting >= self.max_queue:
+            self.shed += 1
+            raise RateLimitExceeded(self.model, "admission queue is full", self.max_wait)
+
+        wait = self._reserve(cost)
+        if wait > self.max_wait:
+            self.shed += 1
+            raise RateLimitExceeded(self.model, "over budget", wait)
+
+        if wait > 0:
+            # The budget is already taken, so later requests queue behind this one without a lock held while sleeping
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                self._request_tokens += 1.0
+                self._input_tokens += cost
+                raise
+            finally:
+                self.waiting -= 1
+
+        self.admitted += 1
+
+    def _reserve(self, cost: float) -> float:
+        """
+            Takes one request and `cost` input tokens ahead of time, letting the bucket go
+            negative, if they will be available within `max_wait`; returns the wait either way.
+        """
+        self._refill()
+        wait = self._time_until_available(cost)
+        if wait <= self.max_wait:
+            self._request_tokens -= 1.0
+            self._input_tokens -= cost
+        return wait
+
+    def try_take(self, cost: float) -> float:
+        """Takes one request and `cost` input tokens if available (returns 0), otherwise returns the wait."""
+        self._refill()
+        wait = self._time_until_available(cost)
+        if wait <= 0:
+            self._request_tokens -= 1.0
+            self._input_tokens -= cost
+        return wait
+
+    def on_success(self) -> None:
+        """Additive increase."""
+        if self.current_rpm < self.max_rpm:
+            self.current_rpm = min(self.max_rpm, self.current_rpm + self.increase_rpm)
+
+    def on_rate_limited(self) -> None:
+        """Multiplicative decrease, at most once per cooldown so a burst of 429s counts once."""
+        self.upstream_429s += 1
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+
+        self._last_decrease = now
+        self.current_rpm = max(self.min_rpm, self.current_rpm * self.decrease_factor)
+        self._request_tokens = min(self._request_tokens, self._request_capacity())
+        logger.warning(f"Upstream 429 for {self.model}, local rate lowered to {self.current_rpm:.1f} rpm")
+
+    def is_saturated(self) -> bool:
+        """True when a new request would most likely be shed."""
+        self._refill()
+        return self.waiting >= self.max_queue or (self.waiting > 0 and self._request_tokens < 1.0)
+
+    def headroom(self) -> float:
+        """Requests that could be admitted right now, net of those already queued."""
+        self._refill()
+        return self._request_tokens - self.waiting
+
+    def snapshot(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "max_rpm": self.max_rpm,
+            "current_rpm": round(self.current_rpm, 2),
+            "tpm": self.tpm,
+            "available_requests": round(self._request_tokens, 2),
+            "available_input_tokens": round(self._input_tokens),
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "upstream_429s": self.upstream_429s,
+        }
+
+
+# --- 2. Registry of limiters ---
+
+class RateLimiter:
+    """
+        Lazily creates one ModelRateLimiter per model from the configured budgets.
+        Models without an RPM budget (and no default RPM) are not limited locally.
+    """
+
+    def __init__(
+        self,
+        default_rpm: Optional[int],
+        default_tpm: int,
+        model_budgets: Optional[Dict[str, Dict[str, int]]] = None,
+        max_wait: float = 2.0,
+        max_queue: int = 100,
+        burst_seconds: float = 10.0,
+        limiter_factory: Optional[Callable[..., ModelRateLimiter]] = None
+    ):
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self.model_budgets = model_budgets or {}
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.burst_seconds = burst_seconds
+        # e.g. a shared limiter whose bucket lives outside this process
+        self.limiter_factory = limiter_factory or ModelRateLimiter
+        self._limiters: Dict[str, Optional[ModelRateLimiter]] = {}
+
+    def for_model(self, model: str) -> Optional[ModelRateLimiter]:
+        if model in self._limiters:
+            return self._limiters[model]
+
+        budget = self.model_budgets.get(model, {})
+        rpm = budget.get("rpm", self.default_rpm)
+        limiter = None
+        if rpm is not None:
+            limiter = self.limiter_factory(
+                model,
+                rpm=rpm,
+                tpm=budget.get("tpm", self.default_tpm),
+                max_wait=self.max_wait,
+                max_queue=self.max_queue,
+                burst_seconds=self.burst_seconds
+            )
+        self._limiters[model] = limiter
+        return limiter
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {model: limiter.snapshot() for model, limiter in self._limiters.items() if limiter is not None}
+
+
+def estimate_tokens(contents: list) -> int:
+    """Cheap input-token estimate (~4 characters per token) used for TPM admission."""
+    chars = sum(len(part.get("text", "")) for item in contents for part in item.get("parts", []))
+    return chars // 4 + 1
@@ -0,0 +1,259 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Protocol, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- 1. Backends ---
+
+class CacheBackend(Protocol):
+    """Minimal async key/value contract every cache backend must honour."""
+
+    async def get(self, key: str) -> Optional[bytes]: ...
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None: ...
+
+    async def delete(self, key: str) -> None: ...
+
+    def stats(self) -> Dict[str, Any]: ...
+
+
+class InMemoryCacheBackend:
+    """
+        In-process LRU store with a per-entry TTL and a byte budget.
+        Nothing in here awaits, so a hit costs a dict lookup and a move_to_end.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_entries: int = 10_000):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._size = 0
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        if len(value) > self.max_bytes:
+            # A single entry bigger than the whole budget would flush everything else
+            return
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._size += len(value)
+
+        while self._size > self.max_bytes or len(self._entries) > self.max_entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    async def delete(self, key: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self._size -= len(value)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+class RedisCacheBackend:
+    """
+        Redis (or any RESP-compatible stand-in such as a local KeyDB/Valkey) backend.
+        Memory budget and LRU eviction are delegated to the server's
+        `maxmemory` / `allkeys-lru` policy; TTL is set per key with PX.
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("The 'redis' package is required for the redis cache backend") from e
+
+        self.url = url
+        self._redis = redis_asyncio.from_url(url)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            return await self._redis.get(key)
+        except Exception as e:
+            # A cache outage must never take generation down with it
+            logger.warning(f"Redis cache get failed: {e}")
+            return None
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        try:
+            await self._redis.set(key, value, px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Redis cache set failed: {e}")
+
+    async def delete(self, key: str) -> None:
+        try:
+            await self._redis.delete(key)
+        except Exception as e:
+            logger.warning(f"Redis cache delete failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "redis", "url": self.url}
+
+
+# --- 2. Response Cache ---
+
+def make_cache_key(contents: list, model_name: str, temperature: Optional[float], output: Optional[dict] = None) -> str:
+    """Hashes the prepared contents together with the generation parameters."""
+    params = {"contents": contents, "model": model_name, "temperature": temperature}
+    if output:
+        # Only structured requests carry it, so plain-text keys are unchanged
+        params["output"] = output
+    payload = json.dumps(
+        params,
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Exact-match cache for complete responses, sitting in front of generate_content."""
+
+    def __init__(self, backend: CacheBackend, ttl: float = 300.0, namespace: str = "complete"):
+        self.backend = backend
+        self.ttl = ttl
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        """`key` is the request hash from make_cache_key; it is namespaced here."""
+        value = await self.backend.get(f"{self.namespace}:{key}")
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return value.decode("utf-8")
+
+    async def set(self, key: str, text: str) -> None:
+        await self.backend.set(f"{self.namespace}:{key}", text.encode("utf-8"), self.ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "ttl_seconds": self.ttl,
+            **self.backend.stats(),
+        }
+
+
+def build_cache_backend(backend: str, redis_url: Optional[str], max_bytes: int, max_entries: int) -> CacheBackend:
+    """Picks the configured backend, falling back to memory when redis is not usable."""
+    if backend == "redis":
+        if redis_url:
+            try:
+                return RedisCacheBackend(redis_url)
+            except RuntimeError as e:
+                logger.error(f"{e}, falling back to in-memory cache")
+        else:
+            logger.error("REDIS_URL is not set, falling back to in-memory cache")
+
+    return InMemoryCacheBackend(max_bytes=max_bytes, max_entries=max_entries)
+
+
+# --- 3. Stream Cache ---
+
+class StreamCache:
+    """
+        Records the chunk sequence of completed streams so identical requests can be
+        replayed locally. Only streams that ran to completion are ever committed.
+    """
+
+    def __init__(self, backend: CacheBackend, ttl: float = 300.0, record_timing: bool = True, namespace: str = "stream"):
+        self.backend = backend
+        self.ttl = ttl
+        self.record_timing = record_timing
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.commits = 0
+        self.discarded = 0
+
+    async def get(self, key: str) -> Optional[List[Tuple[float, str]]]:
+        value = await self.backend.get(f"{self.namespace}:{key}")
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return [(delay, text) for delay, text in json.loads(value)]
+
+    async def record(self, key: str, stream: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """Passes `stream` through untouched while recording it; commits on clean completion only."""
+        chunks: List[Tuple[float, str]] = []
+        last = time.monotonic()
+        completed = False
+
+        try:
+            async for text in stream:
+                now = time.monotonic()
+                # The first chunk is replayed immediately; only the gaps between chunks matter
+                delay = (now - last) if (chunks and self.record_timing) else 0.0
+                last = now
+                chunks.append((round(delay, 4), text))
+                yield text
+            completed = True
+        finally:
+            if completed and chunks:
+                payload = json.dumps(chunks, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+                await self.backend.set(f"{self.namespace}:{key}", payload, self.ttl)
+                self.commits += 1
+            else:
+                # Errored or abandoned streams are partial and must never be served
+                self.discarded += 1
+
+    @staticmethod
+    async def replay(chunks: List[Tuple[float, str]], paced: bool = False, speed: float = 1.0) -> AsyncGenerator[str, None]:
+        """Yields the recorded chunks, either at full speed or with the original pacing."""
+        for delay, text in chunks:
+            if paced and delay > 0:
+                await asyncio.sleep(delay / speed)
+            yield text
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "commits": self.commits,
+            "discarded": self.discarded,
+            "ttl_seconds": self.ttl,
+            **self.backend.stats(),
+        }
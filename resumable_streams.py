@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import secrets
+import time
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StreamNotResumable(Exception):
+    """The stream is unknown here, expired, or its buffer no longer reaches back to the requested offset."""
+
+
+class ResumableStream:
+    """
+        One generation's chunks, numbered from 0. A background task pumps the upstream
+        text into a bounded buffer; readers follow it from any offset still buffered.
+    """
+
+    def __init__(self, stream_id: str, max_chars: int, detach_grace: float):
+        self.stream_id = stream_id
+        self.max_chars = max_chars
+        self.detach_grace = detach_grace
+        self.chunks: List[str] = []
+        # Offset of chunks[0]; grows when the oldest chunks are dropped to stay under max_chars
+        self.base = 0
+        self.chars = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.abandoned = False
+        self.finished_at: Optional[float] = None
+        self.readers = 0
+        self.detached_at = time.monotonic()
+        self.producer: Optional[asyncio.Task] = None
+        self._changed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    @property
+    def end(self) -> int:
+        return self.base + len(self.chunks)
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.get_running_loop().create_future()
+        changed.set_result(None)
+
+    def _append(self, text: str) -> None:
+        self.chunks.append(text)
+        self.chars += len(text)
+        if self.chars > self.max_chars:
+            drop = 0
+            while self.chars > self.max_chars and drop < len(self.chunks) - 1:
+                self.chars -= len(self.chunks[drop])
+                drop += 1
+            del self.chunks[:drop]
+            self.base += drop
+        self._notify()
+
+    def _finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    async def is_abandoned(self) -> bool:
+        """
+            The disconnect check for the upstream stream: true once nobody has been reading
+            for `detach_grace` seconds, so a client that reconnects in time finds it still running.
+        """
+        if not self.abandoned and self.readers == 0 and time.monotonic() - self.detached_at >= self.detach_grace:
+            self.abandoned = True
+        return self.abandoned
+
+
+class ResumableStreams:
+    """Registry of recent streams for SSE Last-Event-ID and NDJSON offset resumption."""
+
+    def __init__(
+        self,
+        ttl: float = 120.0,
+        max_streams: int = 1000,
+        max_chars_per_stream: int = 256_000,
+        detach_grace: float = 10.0,
+        poll_interval: float = 0.5
+    ):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.max_chars_per_stream = max_chars_per_stream
+        self.detach_grace = detach_grace
+        self.poll_interval = poll_interval
+        self._streams: Dict[str, ResumableStream] = {}
+        self.started = 0
+        self.resumed = 0
+        self.not_resumable = 0
+
+    def create(self) -> ResumableStream:
+        """Registers a new stream; hand its is_abandoned to the upstream call, then start() it."""
+        self._evict()
+        entry = ResumableStream(secrets.token_urlsafe(12), self.max_chars_per_stream, self.detach_grace)
+        self._streams[entry.stream_id] = entry
+        self.started += 1
+        return entry
+
+    def start(self, entry: ResumableStream, source: AsyncGenerator[str, None]) -> None:
+        entry.producer = asyncio.create_task(self._pump(entry, source))
+
+    def discard(self, entry: ResumableStream) -> None:
+        """Drops a stream whose upstream never opened."""
+        self._streams.pop(entry.stream_id, None)
+
+    async def _pump(self, entry: ResumableStream, source: AsyncGenerator[str, None]) -> None:
+        try:
+            async for text in source:
+                entry._append(text)
+        except asyncio.CancelledError:
+            entry._finish(StreamNotResumable("Stream was cancelled"))
+            raise
+        except Exception as e:
+            entry._finish(e)
+            return
+        finally:
+            await source.aclose()
+
+        if entry.abandoned:
+            # The upstream was cut short for lack of readers: what is buffered is not the whole answer
+            self._streams.pop(entry.stream_id, None)
+            entry._finish(StreamNotResumable("Stream was abandoned"))
+        else:
+            entry._finish()
+
+    def open(
+        self,
+        stream_id: str,
+        offset: int = 0,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+    ) -> AsyncGenerator[str, None]:
+        """Chunks of `stream_id` from `offset` on; raises StreamNotResumable right away if that's impossible."""
+        entry = self._streams.get(stream_id)
+        if entry is None or entry.abandoned or offset < entry.base:
+            self.not_resumable += 1
+            raise StreamNotResumable(f"Stream {stream_id} cannot be resumed from offset {offset}")
+
+        if offset > 0:
+            self.resumed += 1
+        return self._read(entry, offset, is_disconnected)
+
+    async def _read(
+        self,
+        entry: ResumableStream,
+        offset: int,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]]
+    ) -> AsyncGenerator[str, None]:
+        entry.readers += 1
+        watcher = asyncio.ensure_future(self._watch(is_disconnected)) if is_disconnected is not None else None
+        try:
+            while True:
+                if offset < entry.base:
+                    # A reader this slow fell out of the buffer window
+                    raise StreamNotResumable(f"Stream {entry.stream_id} reader fell behind the buffer")
+                while offset < entry.end:
+                    text = entry.chunks[offset - entry.base]
+                    offset += 1
+                    yield text
+                if entry.done:
+                    if entry.error is not None:
+                        raise entry.error
+                    return
+
+                waiters = {entry._changed} if watcher is None else {entry._changed, watcher}
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                if watcher is not None and watcher.done():
+                    return
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            entry.readers -= 1
+            if entry.readers == 0:
+                entry.detached_at = time.monotonic()
+
+    async def _watch(self, is_disconnected: Callable[[], Awaitable[bool]]) -> None:
+        while not await is_disconnected():
+            await asyncio.sleep(self.poll_interval)
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for stream_id, entry in list(self._streams.items()):
+            if entry.done and now - entry.finished_at >= self.ttl:
+                del self._streams[stream_id]
+
+        # Over capacity: finished streams go first, oldest first; running ones are never cut off
+        if len(self._streams) >= self.max_streams:
+            finished = sorted((e for e in self._streams.values() if e.done), key=lambda e: e.finished_at)
+            for entry in finished[:len(self._streams) - self.max_streams + 1]:
+                del self._streams[entry.stream_id]
+
+    def stats(self) -> Dict[str, Any]:
+        running = sum(1 for e in self._streams.values() if not e.done)
+        return {
+            "streams": len(self._streams),
+            "running": running,
+            "buffered_chars": sum(e.chars for e in self._streams.values()),
+            "started": self.started,
+            "resumed": self.resumed,
+            "not_resumable": self.not_resumable,
+        }
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[tuple]:
+    """`<stream_id>:<n>` from a Last-Event-ID header as (stream_id, next offset), or None."""
+    if not value:
+        return None
+    stream_id, _, index = value.strip().rpartition(":")
+    if not stream_id or not index.isdigit():
+        return None
+    return stream_id, int(index) + 1
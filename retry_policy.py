@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling upstream while a model's circuit is open."""
+
+    def __init__(self, model: str, retry_after: float):
+        self.model = model
+        self.retry_after = retry_after
+        super().__init__(f"Circuit open for {model} (retry after {retry_after:.1f}s)")
+
+
+class DeadlineExceededError(Exception):
+    """Raised when the per-request deadline budget runs out."""
+
+
+def default_is_retryable(e: BaseException) -> bool:
+    return bool(getattr(e, "is_retryable", False))
+
+
+# --- 1. Backoff ---
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by attempts and a deadline budget."""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.25, max_delay: float = 4.0, deadline: float = 30.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform between 0 and the capped exponential delay."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+# --- 2. Circuit breaker ---
+
+class CircuitBreaker:
+    """
+        closed -> open after `failure_threshold` consecutive failures,
+        open -> half_open after `reset_timeout`, where a single probe decides.
+    """
+
+    def __init__(self, model: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def check(self) -> None:
+        if self.state == "closed":
+            return
+
+        now = time.monotonic()
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - now
+            if remaining > 0:
+                raise CircuitOpenError(self.model, remaining)
+            self.state = "half_open"
+
+        # half_open: let exactly one probe through
+        if self._probe_in_flight:
+            raise CircuitOpenError(self.model, self.reset_timeout)
+        self._probe_in_flight = True
+
+    def is_open(self) -> bool:
+        return self.state == "open" and time.monotonic() < self.opened_at + self.reset_timeout
+
+    def release(self) -> None:
+        """Ends a half-open probe without judging the model either way."""
+        self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        if self.state != "closed":
+            logger.info(f"Circuit closed for {self.model}")
+        self.state = "closed"
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self._probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit opened for {self.model} after {self.consecutive_failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures}
+
+
+# --- 3. Latency tracking for hedging ---
+
+class LatencyTracker:
+    """Rolling window of successful attempt latencies, used to derive the hedge delay."""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self._samples) < 20:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- 4. Engine ---
+
+class RetryEngine:
+    """Runs upstream attempts under a retry policy, a per-model circuit breaker and optional hedging."""
+
+    def __init__(
+        self,
+        policy: RetryPolicy,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        hedge_enabled: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 0.5
+    ):
+        self.policy = policy
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedge_enabled = hedge_enabled
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        # Per (model, operation): opening a stream and a full completion take very different times
+        self._latency: Dict[tuple, LatencyTracker] = {}
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(model, self.failure_threshold, self.reset_timeout)
+            self._breakers[model] = breaker
+        return breaker
+
+    def latency(self, model: str, operation: str = "call") -> LatencyTracker:
+        tracker = self._latency.get((model, operation))
+        if tracker is None:
+            tracker = LatencyTracker()
+            self._latency[(model, operation)] = tracker
+        return tracker
+
+    def hedge_delay(self, model: str, operation: str = "call") -> Optional[float]:
+        """None until there are enough samples for a real quantile: no hedging before then."""
+        p = self.latency(model, operation).quantile(self.hedge_quantile)
+        return max(self.hedge_min_delay, p) if p is not None else None
+
+    async def run(
+        self,
+        model: str,
+        attempt_fn: Callable[[], Awaitable[Any]],
+        is_retryable: Callable[[BaseException], bool] = default_is_retryable,
+        hedge: bool = False,
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+        operation: str = "call",
+        bounded: bool = True
+    ) -> Any:
+        """
+            Calls `attempt_fn` until it succeeds, a non-retryable error is raised,
+            attempts run out or the deadline budget would be exceeded.
+            `discard` releases the result of a hedged attempt that lost the race.
+            With `bounded=False` (full completions, whose duration depends on the answer)
+            an attempt is never cut short; the deadline only stops new retries from starting.
+        """
+        deadline = time.monotonic() + self.policy.deadline
+        breaker = self.breaker(model)
+        attempt = 0
+
+        while True:
+            breaker.check()
+            remaining = deadline - time.monotonic()
+            started = time.monotonic()
+
+            try:
+                if hedge and self.hedge_enabled:
+                    call = self._hedged(model, operation, attempt_fn, discard)
+                else:
+                    call = attempt_fn()
+                result = await (asyncio.wait_for(call, remaining) if bounded else call)
+            except asyncio.TimeoutError:
+                breaker.record_failure()
+                raise DeadlineExceededError(f"Deadline of {self.policy.deadline}s exceeded for {model}")
+            except Exception as e:
+                if not is_retryable(e):
+                    # Client-side or local errors say nothing about the model's health
+                    breaker.release()
+                    raise
+
+                breaker.record_failure()
+                attempt += 1
+                delay = self.policy.backoff(attempt)
+                if attempt >= self.policy.max_attempts or time.monotonic() + delay >= deadline:
+                    raise
+
+                self.retries += 1
+                logger.warning(f"Retrying {model} in {delay:.2f}s (attempt {attempt + 1}): {e}")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled (client gone, hedge loser, last waiter left): a probe must not hold half_open forever
+                breaker.release()
+                raise
+
+            breaker.record_success()
+            self.latency(model, operation).record(time.monotonic() - started)
+            return result
+
+    async def _hedged(self, model: str, operation: str, attempt_fn, discard) -> Any:
+        """Starts a second attempt if the first is slower than the p95 delay; the first to succeed wins."""
+        delay = self.hedge_delay(model, operation)
+        if delay is None:
+            # Without a measured p95, "slow" would be a guess and the duplicate would double the cost
+            return await attempt_fn()
+
+        primary = asyncio.ensure_future(attempt_fn())
+        tasks = [primary]
+        winner: Optional[asyncio.Future] = None
+        error: Optional[BaseException] = None
+
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                winner = primary
+                return primary.result()
+
+            self.hedges += 1
+            secondary = asyncio.ensure_future(attempt_fn())
+            tasks.append(secondary)
+            pending = {primary, secondary}
+
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and winner is None:
+                        winner = task
+                    elif task.exception() is not None:
+                        error = task.exception()
+
+            if winner is None:
+                raise error
+
+            if winner is secondary:
+                self.hedge_wins += 1
+            return winner.result()
+        finally:
+            # Losers are cancelled and awaited, so their cleanup runs now and their errors are observed;
+            # one that finished anyway has its result released
+            losers = [task for task in tasks if task is not winner]
+            for task in losers:
+                task.cancel()
+            await asyncio.gather(*losers, return_exceptions=True)
+            for task in losers:
+                if discard is not None and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "breakers": {model: b.snapshot() for model, b in self._breakers.items()},
+            "hedge_delay": {
+                f"{model}/{operation}": round(delay, 3)
+                for model, operation in self._latency
+                if (delay := self.hedge_delay(model, operation)) is not None
+            },
+        }
+
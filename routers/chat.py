@@ -1,14 +1,23 @@
 from enum import Enum
+import hashlib
 import json
 import logging
-from pathlib import Path
+import time
 from typing import Annotated, Literal, Optional
-from fastapi import APIRouter, Depends, HTTPException, Header, Response
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Depends, HTTPException, Header, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 
-from LLMService import LLMService, get_llm_service, LLMServiceError
-from models import QueryRequest
-from stream_formatters import complete_formatter_json, complete_formatter_text, stream_formatter_json, stream_formatter_text, stream_formatter_sse
+from LLMService import LLMService, get_llm_service, get_settings, LLMServiceError
+from batch import get_gemini_batch, run_online_batch, submit_gemini_batch
+from chunk_coalescer import FLUSH_POLICIES, FlushPolicyName, coalesce
+from embeddings import vector_base64, vector_floats
+from metrics import STREAM_TTFB, capture_context, instrument_stream, observe_request
+from models import BatchRequest, EmbedRequest, QueryRequest
+from resumable_streams import ResumableStreams, StreamNotResumable, parse_last_event_id
+from scheduler import Priority
+from sessions import SessionNotFound
+from usage import usage_headers
+from stream_formatters import complete_formatter_json, complete_formatter_text, orjson, select_stream_formatter
 logger = logging.getLogger(__name__)
 
 router = APIRouter(
@@ -23,25 +32,100 @@ class AcceptHeader(str, Enum):
 
 @router.get("/")
 def health():
-    """API health"""
+    """API liveness (readiness, including warm-up, is GET /ready)"""
     return { "status" : "ok", "message": "LLM API is running and ready."}
 
+@router.get("/stats")
+def stats(llm_service:LLMService = Depends(get_llm_service)):
+    """Live cache/limiter counters for monitoring"""
+    return llm_service.get_stats()
+
+def _flush_policy(name: Optional[FlushPolicyName]):
+    return FLUSH_POLICIES[name or FlushPolicyName(get_settings().stream_flush_policy)]
+
+def _consumer(request: Request) -> Optional[str]:
+    """The API consumer for fair queuing: X-Client-Id, else the account"""
+    return request.headers.get("x-client-id") or _account(request)
+
+def _account(request: Request) -> Optional[str]:
+    """
+        Who pays, for token budgets, usage and batch job ownership: a hash of X-API-Key, else the
+        client address. Never a client-chosen label, or a new X-Client-Id would be a fresh budget.
+    """
+    api_key = request.headers.get("x-api-key")
+    if api_key:
+        # Never keep raw keys in queue state, logs or /stats
+        return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return request.client.host if request.client else None
+
+def _resume_stream(resumable: Optional[ResumableStreams], stream_id: str, offset: int, request: Request):
+    """Follows a buffered (or still running) stream from `offset` instead of generating it again"""
+    try:
+        if resumable is None:
+            raise StreamNotResumable("Resumable streams are disabled")
+        return resumable.open(stream_id, offset, request.is_disconnected)
+    except StreamNotResumable as e:
+        logger.info(str(e))
+        # 410 also makes EventSource stop reconnecting
+        raise HTTPException(
+            status_code=410,
+            detail={"error": "STREAM_NOT_RESUMABLE", "message": "This stream can no longer be resumed. Please send the request again."}
+        )
+
 @router.get("/stream/sse")
 async def query_stream_sse(
     prompt: str,
+    request: Request,
     temperature:float=0.7,
     model_name:Optional[str]="gemini-2.5-flash-lite",
+    session_id:Optional[str]=None,
+    x_flush_policy: Annotated[Optional[FlushPolicyName], Header(alias="X-Flush-Policy")] = None,
+    # Sent by EventSource when it reconnects: resume after that event instead of regenerating
+    last_event_id: Annotated[Optional[str], Header(alias="Last-Event-ID")] = None,
     llm_service:LLMService = Depends(get_llm_service)
 ):
-    """This endpoint handles sse GET requests - no history due to GET string length limitations"""
+    """This endpoint handles sse GET requests - history can't fit in a GET string, use a session_id instead"""
+
+    formatter = select_stream_formatter("sse", "/stream/sse")
+    resumable = llm_service.resumable_streams
+    started = time.perf_counter()
+
+    resume = parse_last_event_id(last_event_id)
+    if resume is not None:
+        stream_id, offset = resume
+        raw_stream = _resume_stream(resumable, stream_id, offset, request)
+        raw_stream = instrument_stream(raw_stream, "/stream/sse", model_name, started, capture_context())
+        return StreamingResponse(formatter(raw_stream, stream_id=stream_id, start=offset), media_type="text/event-stream")
 
     settings = { 
         k:v 
-        for k,v in {"temperature":temperature, "model_name":model_name}.items() 
+        for k,v in {"temperature":temperature, "model_name":model_name, "session_id":session_id}.items() 
         if v is not None
     }        
-    raw_stream = llm_service.get_raw_sse_stream(prompt, **settings)
-    return StreamingResponse(stream_formatter_sse(raw_stream), media_type="text/event-stream")
+    entry = resumable.create() if resumable is not None else None
+    # Filled in when the upstream stream ends, in time for the final "usage" event
+    usage = {}
+    raw_stream = llm_service.get_raw_sse_stream(
+        prompt,
+        tenant=_account(request),
+        consumer=_consumer(request),
+        priority=Priority.interactive,
+        # A resumable stream outlives its first connection by the detach grace period
+        is_disconnected=entry.is_abandoned if entry is not None else request.is_disconnected,
+        endpoint="/stream/sse",
+        usage=usage,
+        **settings
+    )
+    raw_stream = coalesce(raw_stream, _flush_policy(x_flush_policy))
+    if entry is not None:
+        # Chunks are numbered after coalescing, so offsets match the events actually sent
+        resumable.start(entry, raw_stream)
+        raw_stream = resumable.open(entry.stream_id, 0, request.is_disconnected)
+    raw_stream = instrument_stream(raw_stream, "/stream/sse", model_name, started, capture_context())
+    return StreamingResponse(
+        formatter(raw_stream, stream_id=entry.stream_id if entry is not None else None, usage=usage),
+        media_type="text/event-stream"
+    )
 
     
 COMPLETE_FORMATTERS = { 
@@ -52,6 +136,7 @@ COMPLETE_FORMATTERS = {
 @router.post("/complete")
 async def query_complete(
     request_data:QueryRequest,
+    request: Request,
     # I switeched form accept to x_format so that swagger doesn't override the selection picked. 
     # I discovered swagger's internal logic always picks 'application/json' for document purposes
     #### The client MUST send 'X-Format' in the request header. ###
@@ -70,39 +155,63 @@ async def query_complete(
         {
             "temperature":request_data.temperature, 
             "history":request_data.history, 
-            "model_name":request_data.model_name
+            "model_name":request_data.model_name,
+            "session_id":request_data.session_id,
+            "response_format":request_data.response_format,
+            "response_schema":request_data.response_schema
         }.items()
         if v is not None 
     }
    
-    result = await llm_service.get_complete(
-        request_data.prompt, 
-        **settings
-    )
+    usage = {}
+    with observe_request("/complete", request_data.model_name):
+        result = await llm_service.get_complete(
+            request_data.prompt, 
+            tenant=_account(request),
+            consumer=_consumer(request),
+            priority=Priority.standard,
+            is_disconnected=request.is_disconnected,
+            endpoint="/complete",
+            usage=usage,
+            **settings
+        )
 
     body = formatter(result)
 
+    if isinstance(body, dict) and LLMService.output_options(settings):
+        # Clients get an object, not a string; anything that doesn't validate is a 502, never a crash here
+        body["data"] = LLMService.parse_structured(result, settings.get("response_schema"))
+
+    headers = usage_headers(usage)
     if isinstance(body, dict):
-            return body # FastAPI auto-converts dict to JSON response
+            return JSONResponse(content=body, headers=headers)
             
-    return Response(content=body, media_type=media_type)
+    return Response(content=body, media_type=media_type, headers=headers)
 
 
     
-FORMATTERS = {
-    "text": (stream_formatter_text, "text/plain"),
-    "json": (stream_formatter_json, "application/x-ndjson"),
+STREAM_MEDIA_TYPES = {
+    "text": "text/plain",
+    "json": "application/x-ndjson",
 }
 
 
 @router.post("/stream")
 async def query_stream(
     request_data:QueryRequest,
+    request: Request,
     # I switeched form accept to x_format so that swagger doesn't override the selection picked. 
     # I discovered swagger's internal logic always picks 'application/json' for document purposes
     #### The client MUST send 'X-Format' in the request header. ###
     #format_key:Literal["text", "json"] = "json",
     x_format: Annotated[AcceptHeader, Header(alias="X-Format")] = AcceptHeader.json, # FastAPI extracts 'Accept' header here
+    # Merges tiny upstream chunks into fewer writes; the first chunk is always sent right away
+    x_flush_policy: Annotated[Optional[FlushPolicyName], Header(alias="X-Flush-Policy")] = None,
+    # NDJSON only: resume the stream from X-Stream-Id at the first line not yet received
+    stream_id: Optional[str] = None,
+    offset: int = 0,
+    # NDJSON only: end with a {"type": "usage"} line. Opt-in, as every other line carries "text"
+    include_usage: bool = False,
     llm_service:LLMService = Depends(get_llm_service)
 ):
     """This end point responds in stream in the form of text/plain or application/json format"""
@@ -110,55 +219,251 @@ async def query_stream(
     is_json = (x_format == AcceptHeader.json)
     format_key = "json" if is_json else "text"
 
-    formatter, media_type = FORMATTERS[format_key]
+    formatter = select_stream_formatter(format_key, "/stream")
+    media_type = STREAM_MEDIA_TYPES[format_key]
     settings = {
         k:v
         for k,v in {
             "temperature":request_data.temperature, 
             "history":request_data.history,
-            "model_name":request_data.model_name
+            "model_name":request_data.model_name,
+            "session_id":request_data.session_id,
+            "response_format":request_data.response_format,
+            "response_schema":request_data.response_schema
         }.items()
         if v is not None
     }
 
-    gen_obj = await llm_service.get_stream(
-        request_data.prompt,
-        **settings            
-    )
+    started = time.perf_counter()
+    # Plain text has no offsets to resume from
+    resumable = llm_service.resumable_streams if is_json else None
+
+    # Filled in when the upstream stream ends, in time for the final NDJSON usage line
+    usage = {}
+    if stream_id is not None:
+        gen_obj = _resume_stream(resumable, stream_id, offset, request)
+    else:
+        offset = 0
+        entry = resumable.create() if resumable is not None else None
+        try:
+            gen_obj = await llm_service.get_stream(
+                request_data.prompt,
+                tenant=_account(request),
+                consumer=_consumer(request),
+                priority=Priority.interactive,
+                # A resumable stream outlives its first connection by the detach grace period
+                is_disconnected=entry.is_abandoned if entry is not None else request.is_disconnected,
+                endpoint="/stream",
+                usage=usage,
+                **settings            
+            )
+        except BaseException:
+            if entry is not None:
+                resumable.discard(entry)
+            raise
+        gen_obj = coalesce(gen_obj, _flush_policy(x_flush_policy))
+        if entry is not None:
+            # Chunks are numbered after coalescing, so offsets match the lines actually sent
+            resumable.start(entry, gen_obj)
+            stream_id = entry.stream_id
+            gen_obj = resumable.open(stream_id, 0, request.is_disconnected)
 
     try:
         # We use __anext__() to manually grab the first chunk
         first_chunk = await gen_obj.__anext__()
     except StopAsyncIteration:
         first_chunk = "" # Handle empty responses gracefully
+    STREAM_TTFB.labels("/stream", request_data.model_name or "default").observe(time.perf_counter() - started)
 
 
     async def combined_gen():
-        if first_chunk:
-            yield first_chunk
-        async for chunk in gen_obj:
-            yield chunk
+        try:
+            if first_chunk:
+                yield first_chunk
+            async for chunk in gen_obj:
+                yield chunk
+        finally:
+            # Propagates a client disconnect down to the upstream stream immediately
+            await gen_obj.aclose()
 
+    stream = instrument_stream(
+        combined_gen(), "/stream", request_data.model_name, started, capture_context(), first_chunk_seen=True
+    )
     return StreamingResponse(
-        formatter(combined_gen()), 
-        media_type=media_type
+        formatter(stream, stream_id=stream_id, start=offset, usage=usage if include_usage else None), 
+        media_type=media_type,
+        headers={"X-Stream-Id": stream_id} if stream_id is not None else None
     )
     
 
     
-@router.get('/models')
-async def get_models():   
-    # Locate the file relative to this python file 
-    file_path = Path(__file__).parent.parent / "data" / "supported_models.json"
+@router.post("/stream/json")
+async def query_stream_json(
+    request_data:QueryRequest,
+    request: Request,
+    llm_service:LLMService = Depends(get_llm_service)
+):
+    """JSON-mode stream parsed as it is generated: NDJSON "field", "partial", then "done" (or "error") events"""
+    settings = {
+        k:v
+        for k,v in {
+            "temperature":request_data.temperature, 
+            "history":request_data.history,
+            "model_name":request_data.model_name,
+            "session_id":request_data.session_id,
+            "response_schema":request_data.response_schema
+        }.items()
+        if v is not None
+    }
+
+    started = time.perf_counter()
+    usage = {}
+    events = llm_service.get_structured_stream(
+        request_data.prompt,
+        tenant=_account(request),
+        consumer=_consumer(request),
+        priority=Priority.interactive,
+        is_disconnected=request.is_disconnected,
+        endpoint="/stream/json",
+        usage=usage,
+        **settings
+    )
+
     try:
-        with open(file_path, "r") as f:
-        # This converts the JSON text directly into a Python list/dict
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        logger.error(f"Configuration Error: {e}")
-        #Return the 'Safe Shape' so React doesn't break
-        return {"models":[], "total_count":0}
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        return {"models":[], "total_count":0}
-    
+        # Like /stream: an upstream failure before the first event still becomes an HTTP error
+        first_event = await events.__anext__()
+    except StopAsyncIteration:
+        first_event = None
+    STREAM_TTFB.labels("/stream/json", request_data.model_name or "default").observe(time.perf_counter() - started)
+
+    async def ndjson():
+        try:
+            if first_event is not None:
+                yield (json.dumps(first_event, ensure_ascii=False) + "\n").encode("utf-8")
+            async for event in events:
+                yield (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+            if usage:
+                yield (json.dumps({"type": "usage", "usage": usage}, ensure_ascii=False) + "\n").encode("utf-8")
+        except LLMServiceError as e:
+            yield (json.dumps({"type": "error", "message": e.public_message}, ensure_ascii=False) + "\n").encode("utf-8")
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@router.post("/batch")
+async def query_batch(
+    batch_data:BatchRequest,
+    request: Request,
+    llm_service:LLMService = Depends(get_llm_service)
+):
+    """
+        Runs many complete requests with bounded concurrency; one NDJSON line per item, tagged with its index.
+        mode="gemini_batch" answers 202 with the submitted job ids right away; poll GET /batch/{job_id} for results.
+    """
+    settings = get_settings()
+    if len(batch_data.requests) > settings.batch_max_items:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {settings.batch_max_items} requests.")
+
+    if batch_data.mode == "gemini_batch":
+        jobs = await submit_gemini_batch(
+            llm_service, batch_data.requests, tenant=_account(request), poll_interval=settings.batch_poll_interval
+        )
+        return JSONResponse(status_code=202, content={"mode": "gemini_batch", "jobs": jobs})
+
+    concurrency = min(batch_data.concurrency or settings.batch_max_concurrency, settings.batch_max_concurrency)
+    results = run_online_batch(
+        llm_service, batch_data.requests, concurrency, tenant=_account(request), consumer=_consumer(request)
+    )
+
+    async def ndjson():
+        async for item in results:
+            yield (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@router.get("/batch/{job_id}")
+async def query_batch_status(
+    job_id: str,
+    request: Request,
+    llm_service:LLMService = Depends(get_llm_service)
+):
+    """
+        State of a gemini_batch job submitted by this account; once it succeeded, its results
+        with `index` = position in the job's `indexes`
+    """
+    return await get_gemini_batch(llm_service, job_id, tenant=_account(request))
+
+
+@router.post("/embed")
+async def embed(
+    embed_data:EmbedRequest,
+    llm_service:LLMService = Depends(get_llm_service)
+):
+    """Embeddings for a list of texts; concurrent requests share upstream calls and repeated texts hit the vector cache"""
+    settings = get_settings()
+    model = embed_data.model or settings.embedding_model
+    dimensions = embed_data.dimensions or settings.embedding_dimensions
+
+    with observe_request("/embed", model):
+        rows, cached = await llm_service.get_embeddings(embed_data.texts, model, dimensions, embed_data.task_type)
+
+    encode = vector_base64 if embed_data.encoding == "base64" else vector_floats
+    payload = {
+        "model": model,
+        "dimensions": dimensions,
+        "encoding": embed_data.encoding,
+        "cached": cached,
+        "embeddings": [encode(row) for row in rows],
+    }
+    # Serialized directly: FastAPI's encoder would walk every float
+    body = orjson.dumps(payload) if orjson is not None else json.dumps(payload).encode("utf-8")
+    return Response(content=body, media_type="application/json")
+
+
+def _session_store(llm_service: LLMService):
+    if llm_service.session_store is None:
+        raise HTTPException(status_code=404, detail="Sessions are not enabled on this server.")
+    return llm_service.session_store
+
+
+@router.post("/sessions", status_code=201)
+async def create_session(llm_service:LLMService = Depends(get_llm_service)):
+    """Starts a server-side conversation; send its session_id instead of the full history"""
+    session = await _session_store(llm_service).create()
+    return {"session_id": session.id}
+
+
+@router.get("/sessions/{session_id}")
+async def get_session(session_id: str, llm_service:LLMService = Depends(get_llm_service)):
+    try:
+        session = await _session_store(llm_service).get(session_id)
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail="Session not found or expired.")
+    return session.to_dict()
+
+
+@router.delete("/sessions/{session_id}", status_code=204)
+async def delete_session(session_id: str, llm_service:LLMService = Depends(get_llm_service)):
+    await _session_store(llm_service).delete(session_id)
+    return Response(status_code=204)
+
+
+@router.get('/models')
+async def get_models(
+    if_none_match: Annotated[Optional[str], Header(alias="If-None-Match")] = None,
+    llm_service:LLMService = Depends(get_llm_service)
+):   
+    """Served from the in-memory registry snapshot; the file and availability are refreshed in the background"""
+    snapshot = llm_service.model_registry.snapshot()
+    headers = {
+        "ETag": snapshot.etag,
+        "Cache-Control": f"public, max-age={get_settings().models_cache_max_age}",
+    }
+
+    if if_none_match == snapshot.etag:
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
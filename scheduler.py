@@ -0,0 +1,209 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import Any, Dict, List, Optional
+
+from metrics import SCHEDULER_ACTIVE, SCHEDULER_QUEUE_DEPTH, SCHEDULER_SHED, SCHEDULER_WAIT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "anonymous"
+
+
+class Priority(IntEnum):
+    """Lower value is served first."""
+    interactive = 0
+    standard = 1
+    batch = 2
+
+
+class SchedulerRejected(Exception):
+    """A request shed before reaching upstream: 429 for a consumer over its share, 503 when the model is overloaded."""
+
+    def __init__(self, model: str, reason: str, status_code: int):
+        self.model = model
+        self.reason = reason
+        self.status_code = status_code
+        super().__init__(f"Scheduler rejected request for {model}: {reason}")
+
+
+class Ticket:
+    """An upstream slot; release() is idempotent and hands the slot to the next waiter."""
+
+    __slots__ = ("_queue", "_released")
+
+    def __init__(self, queue: "_ModelQueue"):
+        self._queue = queue
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._queue.release()
+
+    async def __aenter__(self) -> "Ticket":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class _ModelQueue:
+    """
+        Bounded concurrency for one model. Waiters are served strictly by priority
+        class and, within a class, by start-time fair queuing across tenants: each
+        request is tagged max(virtual_time, tenant's last tag) + 1/weight, so a
+        tenant with a thousand queued requests can't push everyone else back.
+    """
+
+    def __init__(self, model: str, limit: int):
+        self.model = model
+        self.limit = limit
+        self.active = 0
+        self.heaps: Dict[Priority, List[tuple]] = {p: [] for p in Priority}
+        self.virtual_time: Dict[Priority, float] = {p: 0.0 for p in Priority}
+        self.last_tag: Dict[tuple, float] = {}
+        self.queued_by_tenant: Dict[str, int] = {}
+        self.queued_by_priority: Dict[Priority, int] = {p: 0 for p in Priority}
+        self.queued = 0
+        self._seq = itertools.count()
+        self._active_gauge = SCHEDULER_ACTIVE.labels(model)
+        self._depth = {p: SCHEDULER_QUEUE_DEPTH.labels(model, p.name) for p in Priority}
+
+    def enqueue(self, tenant: str, priority: Priority, weight: float) -> asyncio.Future:
+        tag = max(self.virtual_time[priority], self.last_tag.get((priority, tenant), 0.0)) + 1.0 / weight
+        self.last_tag[(priority, tenant)] = tag
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.heaps[priority], (tag, next(self._seq), tenant, future))
+        self.queued += 1
+        self.queued_by_priority[priority] += 1
+        self.queued_by_tenant[tenant] = self.queued_by_tenant.get(tenant, 0) + 1
+        self._depth[priority].inc()
+        return future
+
+    def abandon(self, future: asyncio.Future, tenant: str, priority: Priority) -> None:
+        """A waiter gave up: it stops counting now, its heap entry is skipped when popped."""
+        future.cancel()
+        self._dequeued(tenant, priority)
+
+    def grant(self) -> None:
+        self.active += 1
+        self._active_gauge.inc()
+
+    def release(self) -> None:
+        self.active -= 1
+        self._active_gauge.dec()
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        for priority in Priority:
+            heap = self.heaps[priority]
+            while heap and self.active < self.limit:
+                tag, _, tenant, future = heapq.heappop(heap)
+                if future.done():
+                    # Abandoned waiter, already uncounted
+                    continue
+                self._dequeued(tenant, priority)
+                self.virtual_time[priority] = tag
+                self.grant()
+                future.set_result(None)
+            if self.active >= self.limit:
+                return
+
+    def _dequeued(self, tenant: str, priority: Priority) -> None:
+        self.queued -= 1
+        self.queued_by_priority[priority] -= 1
+        self._depth[priority].dec()
+        remaining = self.queued_by_tenant.get(tenant, 1) - 1
+        if remaining:
+            self.queued_by_tenant[tenant] = remaining
+        else:
+            self.queued_by_tenant.pop(tenant, None)
+            # An idle tenant starts again from the current virtual time
+            for p in Priority:
+                self.last_tag.pop((p, tenant), None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": {p.name: self.queued_by_priority[p] for p in Priority},
+            "queued_by_tenant": dict(self.queued_by_tenant),
+        }
+
+
+class UpstreamScheduler:
+    """Per-model upstream slots with priority classes and weighted fair queuing per API consumer."""
+
+    def __init__(
+        self,
+        default_concurrency: int = 32,
+        model_concurrency: Optional[Dict[str, int]] = None,
+        max_queue: int = 256,
+        max_queue_per_tenant: int = 32,
+        max_wait: Optional[Dict[str, float]] = None,
+        tenant_weights: Optional[Dict[str, float]] = None
+    ):
+        self.default_concurrency = default_concurrency
+        self.model_concurrency = model_concurrency or {}
+        self.max_queue = max_queue
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.max_wait = {p: (max_wait or {}).get(p.name, 10.0) for p in Priority}
+        self.tenant_weights = tenant_weights or {}
+        self._queues: Dict[str, _ModelQueue] = {}
+
+    def _queue(self, model: str) -> _ModelQueue:
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = _ModelQueue(model, self.model_concurrency.get(model, self.default_concurrency))
+            self._queues[model] = queue
+        return queue
+
+    async def acquire(self, model: str, tenant: Optional[str] = None, priority: Priority = Priority.standard) -> Ticket:
+        """Waits for a slot on `model`, or raises SchedulerRejected as early as the outcome is known."""
+        tenant = tenant or DEFAULT_TENANT
+        queue = self._queue(model)
+        started = time.perf_counter()
+
+        if queue.active < queue.limit and queue.queued == 0:
+            queue.grant()
+            SCHEDULER_WAIT.labels(model, priority.name).observe(0.0)
+            return Ticket(queue)
+
+        if queue.queued >= self.max_queue:
+            self._shed(model, priority, "queue_full")
+            raise SchedulerRejected(model, "upstream queue is full", 503)
+        if queue.queued_by_tenant.get(tenant, 0) >= self.max_queue_per_tenant:
+            self._shed(model, priority, "tenant_queue_full")
+            raise SchedulerRejected(model, f"too many queued requests for consumer {tenant}", 429)
+
+        future = queue.enqueue(tenant, priority, self.tenant_weights.get(tenant, 1.0))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait[priority])
+        except asyncio.TimeoutError:
+            if not future.done():
+                queue.abandon(future, tenant, priority)
+                self._shed(model, priority, "wait_exceeded")
+                raise SchedulerRejected(model, "timed out waiting for an upstream slot", 503)
+            # Granted right at the deadline: keep the slot
+        except asyncio.CancelledError:
+            if future.done():
+                # Granted just as the caller went away: pass the slot on
+                queue.release()
+            else:
+                queue.abandon(future, tenant, priority)
+            raise
+        finally:
+            SCHEDULER_WAIT.labels(model, priority.name).observe(time.perf_counter() - started)
+
+        return Ticket(queue)
+
+    def _shed(self, model: str, priority: Priority, reason: str) -> None:
+        SCHEDULER_SHED.labels(model, priority.name, reason).inc()
+        logger.warning(f"Scheduler shed a {priority.name} request for {model}: {reason}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {model: queue.snapshot() for model, queue in self._queues.items()}
@@ -0,0 +1,76 @@
+"""
+Production entry point: N uvicorn workers sharing one coordinator on this machine.
+
+    python serve.py --workers 8 --host 0.0.0.0 --port 8000
+
+The supervisor loads the settings and data/supported_models.json once, then starts the
+shared-state coordinator (response/stream cache entries, per-key token buckets,
+single-flight slots, the model-ping lease) on a Unix socket before forking the workers.
+Workers find it through LLM_SHARED_STATE_SOCKET, so adding workers neither multiplies
+identical upstream calls nor overshoots a key's quota.
+"""
+import argparse
+import json
+import logging
+import os
+from typing import Any, Dict
+
+import uvicorn
+from pydantic import SecretStr
+
+from LLMService import Settings, get_settings
+from model_registry import SUPPORTED_MODELS_PATH
+from shared_state import SOCKET_ENV, SharedStateServer
+
+logger = logging.getLogger(__name__)
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, SecretStr):
+        return value.get_secret_value()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    return value
+
+
+def build_bootstrap(settings: Settings) -> Dict[str, Any]:
+    mtime = os.stat(SUPPORTED_MODELS_PATH).st_mtime
+    with open(SUPPORTED_MODELS_PATH, "r") as f:
+        models = list(json.load(f).get("models", []))
+
+    return {
+        # By alias, so workers can pass it straight back into Settings(**...)
+        "settings": _plain(settings.model_dump(by_alias=True)),
+        "models": {"models": models, "mtime": mtime},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="Defaults to WORKERS, or one per CPU core")
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+    settings = get_settings()
+    workers = args.workers or settings.workers or os.cpu_count() or 1
+
+    coordinator = SharedStateServer(
+        settings.shared_state_socket,
+        build_bootstrap(settings),
+        cache_max_bytes=settings.response_cache_max_bytes,
+        cache_max_entries=settings.response_cache_max_entries
+    )
+    coordinator.start_in_thread()
+    os.environ[SOCKET_ENV] = settings.shared_state_socket
+
+    logger.info(f"Starting {workers} workers on {args.host}:{args.port}")
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=workers, log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Protocol
+
+from models import HistoryItem
+
+logger = logging.getLogger(__name__)
+
+
+class SessionNotFound(Exception):
+    """Raised for an unknown or expired session id."""
+
+
+class Session:
+    """A server-side conversation: its turns plus the state of its Gemini context cache."""
+
+    def __init__(self, session_id: str, turns: Optional[List[HistoryItem]] = None, updated_at: Optional[float] = None):
+        self.id = session_id
+        self.turns: List[HistoryItem] = turns or []
+        self.updated_at = updated_at or time.time()
+        # Gemini cached-content resource covering turns[:cached_turns] for cache_model
+        self.cache_name: Optional[str] = None
+        self.cache_model: Optional[str] = None
+        self.cached_turns = 0
+        self.cache_expires_at = 0.0
+        # In-memory store only; the SQLite store keeps the claim in the row so all workers see it
+        self.cache_in_progress = False
+
+    def cached_context(self, model: str) -> Optional[str]:
+        """The cached-content name usable for `model` right now, if any."""
+        if self.cache_name and self.cache_model == model and time.time() < self.cache_expires_at - 30:
+            return self.cache_name
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.id,
+            "updated_at": self.updated_at,
+            "history": [{"role": t.role, "text": t.text} for t in self.turns],
+            "context_cache": {"model": self.cache_model, "cached_turns": self.cached_turns} if self.cache_name else None,
+        }
+
+
+def new_session_id() -> str:
+    # Unguessable: the id is the only thing that grants access to a conversation
+    return secrets.token_urlsafe(18)
+
+
+# --- 1. Stores ---
+
+class SessionStore(Protocol):
+    async def create(self) -> Session: ...
+
+    async def get(self, session_id: str) -> Session: ...
+
+    async def append(self, session: Session, turns: List[HistoryItem]) -> None: ...
+
+    async def save_cache_state(self, session: Session) -> None: ...
+
+    async def claim_cache_refresh(self, session: Session, hold: float) -> bool: ...
+
+    async def release_cache_refresh(self, session: Session) -> None: ...
+
+    async def delete(self, session_id: str) -> None: ...
+
+    def stats(self) -> Dict[str, Any]: ...
+
+
+class InMemorySessionStore:
+    """LRU of sessions with an idle TTL."""
+
+    def __init__(self, max_sessions: int = 10_000, ttl: float = 3600.0):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.evictions = 0
+
+    async def create(self) -> Session:
+        session = Session(new_session_id())
+        self._sessions[session.id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+        return session
+
+    async def get(self, session_id: str) -> Session:
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise SessionNotFound(session_id)
+
+        if time.time() - session.updated_at > self.ttl:
+            del self._sessions[session_id]
+            self.evictions += 1
+            raise SessionNotFound(session_id)
+
+        self._sessions.move_to_end(session_id)
+        return session
+
+    async def append(self, session: Session, turns: List[HistoryItem]) -> None:
+        session.turns.extend(turns)
+        session.updated_at = time.time()
+
+    async def save_cache_state(self, session: Session) -> None:
+        # The Session object is the stored state
+        return None
+
+    async def claim_cache_refresh(self, session: Session, hold: float) -> bool:
+        if session.cache_in_progress:
+            return False
+        session.cache_in_progress = True
+        return True
+
+    async def release_cache_refresh(self, session: Session) -> None:
+        session.cache_in_progress = False
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "sessions": len(self._sessions), "evictions": self.evictions}
+
+
+class SQLiteSessionStore:
+    """
+        Append-only on-disk store: each turn is one row, so saving a turn never
+        rewrites the conversation. Queries run in a worker thread to keep the loop free.
+        Expired sessions are pruned every `prune_interval` seconds, on session creation.
+    """
+
+    def __init__(self, path: str, ttl: float = 3600.0, prune_interval: float = 300.0):
+        self.path = path
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        self.pruned = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL,
+                cache_name TEXT,
+                cache_model TEXT,
+                cached_turns INTEGER NOT NULL DEFAULT 0,
+                cache_expires_at REAL NOT NULL DEFAULT 0,
+                cache_claimed_until REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sessions)")}
+        if "cache_claimed_until" not in columns:
+            # Databases created before the claim column existed
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN cache_claimed_until REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+        self._conn.commit()
+
+    def _run(self, fn, *args):
+        def _locked():
+            with self._lock:
+                return fn(*args)
+        return asyncio.to_thread(_locked)
+
+    async def create(self) -> Session:
+        session = Session(new_session_id())
+        prune = session.updated_at - self._last_prune >= self.prune_interval
+        if prune:
+            self._last_prune = session.updated_at
+
+        def _insert():
+            self._conn.execute("INSERT INTO sessions (id, updated_at) VALUES (?, ?)", (session.id, session.updated_at))
+            self._conn.commit()
+            if prune:
+                self._prune(session.updated_at - self.ttl)
+
+        await self._run(_insert)
+        return session
+
+    def _prune(self, cutoff: float) -> None:
+        """Deletes sessions idle since before `cutoff`, with their turns."""
+        self._conn.execute(
+            "DELETE FROM turns WHERE session_id IN (SELECT id FROM sessions WHERE updated_at < ?)", (cutoff,)
+        )
+        deleted = self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,)).rowcount
+        self._conn.commit()
+        if deleted:
+            self.pruned += deleted
+            logger.info(f"Pruned {deleted} expired sessions")
+
+    async def get(self, session_id: str) -> Session:
+        def _load():
+            row = self._conn.execute(
+                "SELECT updated_at, cache_name, cache_model, cached_turns, cache_expires_at FROM sessions WHERE id = ?",
+                (session_id,)
+            ).fetchone()
+            if row is None:
+                return None, []
+            turns = self._conn.execute(
+                "SELECT role, text FROM turns WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+            return row, turns
+
+        row, turns = await self._run(_load)
+        if row is None:
+            raise SessionNotFound(session_id)
+
+        if time.time() - row[0] > self.ttl:
+            await self.delete(session_id)
+            raise SessionNotFound(session_id)
+
+        session = Session(session_id, [HistoryItem(role=role, text=text) for role, text in turns], row[0])
+        session.cache_name, session.cache_model, session.cached_turns, session.cache_expires_at = row[1:]
+        return session
+
+    async def append(self, session: Session, turns: List[HistoryItem]) -> None:
+        """
+            Turns are numbered inside the write transaction, so concurrent turns of one
+            session (from any worker) never collide; `session.turns` is then reloaded
+            so it matches the stored order, including turns other requests added meanwhile.
+        """
+        session.updated_at = time.time()
+
+        def _insert():
+            # IMMEDIATE takes the write lock before reading MAX(seq)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                start = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq), -1) + 1 FROM turns WHERE session_id = ?", (session.id,)
+                ).fetchone()[0]
+                self._conn.executemany(
+                    "INSERT INTO turns (session_id, seq, role, text) VALUES (?, ?, ?, ?)",
+                    [(session.id, start + i, t.role, t.text) for i, t in enumerate(turns)]
+                )
+                self._conn.execute("UPDATE sessions SET updated_at = ? WHERE id = ?", (session.updated_at, session.id))
+                stored = self._conn.execute(
+                    "SELECT role, text FROM turns WHERE session_id = ? ORDER BY seq", (session.id,)
+                ).fetchall()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+            return stored
+
+        stored = await self._run(_insert)
+        session.turns = [HistoryItem(role=role, text=text) for role, text in stored]
+
+    async def save_cache_state(self, session: Session) -> None:
+        def _update():
+            self._conn.execute(
+                "UPDATE sessions SET cache_name = ?, cache_model = ?, cached_turns = ?, cache_expires_at = ? WHERE id = ?",
+                (session.cache_name, session.cache_model, session.cached_turns, session.cache_expires_at, session.id)
+            )
+            self._conn.commit()
+
+        await self._run(_update)
+
+    async def claim_cache_refresh(self, session: Session, hold: float) -> bool:
+        """Lets one worker at a time refresh a session's context cache; the claim lapses after `hold` seconds."""
+        def _claim():
+            now = time.time()
+            claimed = self._conn.execute(
+                "UPDATE sessions SET cache_claimed_until = ? WHERE id = ? AND cache_claimed_until < ?",
+                (now + hold, session.id, now)
+            ).rowcount
+            self._conn.commit()
+            return claimed == 1
+
+        return await self._run(_claim)
+
+    async def release_cache_refresh(self, session: Session) -> None:
+        def _release():
+            self._conn.execute("UPDATE sessions SET cache_claimed_until = 0 WHERE id = ?", (session.id,))
+            self._conn.commit()
+
+        await self._run(_release)
+
+    async def delete(self, session_id: str) -> None:
+        def _delete():
+            self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+        await self._run(_delete)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "path": self.path, "pruned": self.pruned}
+
+
+def build_session_store(backend: str, sqlite_path: str, max_sessions: int, ttl: float) -> SessionStore:
+    if backend == "sqlite":
+        return SQLiteSessionStore(sqlite_path, ttl=ttl)
+    return InMemorySessionStore(max_sessions=max_sessions, ttl=ttl)
@@ -0,0 +1,494 @@
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import os
+import socket
+import stat
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from rate_limiter import ModelRateLimiter, RateLimitExceeded
+from response_cache import InMemoryCacheBackend
+from single_flight import SingleFlight
+from usage import TokenBudgets
+
+logger = logging.getLogger(__name__)
+
+# Set by serve.py in the supervisor; workers inherit it and connect to the coordinator through it
+SOCKET_ENV = "LLM_SHARED_STATE_SOCKET"
+
+
+class SharedStateUnavailable(Exception):
+    """The coordinator could not be reached; callers fall back to per-process behaviour."""
+
+
+# --- 1. Coordinator (runs in the supervisor process) ---
+# Newline-delimited JSON over a Unix socket: {"id", "op", ...} -> {"id", "ok", "result" | "error"}.
+
+def default_socket_path() -> str:
+    """A per-user location for the coordinator socket: the runtime dir, else a private directory in /tmp."""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    base = os.path.join(runtime_dir, "llm-api") if runtime_dir else f"/tmp/llm-api-{os.getuid()}"
+    return os.path.join(base, "shared-state.sock")
+
+
+def _ensure_private_dir(path: str) -> None:
+    """
+        Creates the socket's directory as 0700. An existing one must be ours, or a shared
+        sticky directory like /tmp: anyone else's could swap the socket under us.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid() and not info.st_mode & stat.S_ISVTX:
+        raise RuntimeError(f"Shared state directory {path} belongs to another user")
+
+
+class SharedStateServer:
+    """
+        One per machine: holds the cache entries, token buckets, single-flight
+        slots and leader leases that every worker must agree on, plus the
+        settings/models bootstrap loaded once by the supervisor.
+    """
+
+    def __init__(self, path: str, bootstrap: Dict[str, Any], cache_max_bytes: int, cache_max_entries: int):
+        self.path = path
+        self.bootstrap = bootstrap
+        self.cache = InMemoryCacheBackend(max_bytes=cache_max_bytes, max_entries=cache_max_entries)
+        self.buckets: Dict[str, ModelRateLimiter] = {}
+        self.flights: Dict[str, asyncio.Future] = {}
+        self.leases: Dict[str, tuple] = {}
+        self.documents: Dict[str, Any] = {}
+        # client -> [window start, tokens used]
+        self.budgets: Dict[str, list] = {}
+        self.budget_window = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ready = threading.Event()
+
+    def start_in_thread(self) -> None:
+        """Serves from a daemon thread so the supervisor's main thread stays free for uvicorn."""
+        threading.Thread(target=self._thread_main, name="shared-state", daemon=True).start()
+        if not self._ready.wait(timeout=10):
+            raise RuntimeError("Shared state coordinator failed to start")
+
+    def _thread_main(self) -> None:
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._serve())
+
+    async def _serve(self) -> None:
+        _ensure_private_dir(os.path.dirname(self.path) or ".")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        # The bootstrap carries the API keys: only this user may connect, from the moment the socket exists
+        previous_umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=self.path, limit=16 * 1024 * 1024)
+        finally:
+            os.umask(previous_umask)
+        os.chmod(self.path, 0o600)
+        self._ready.set()
+        logger.info(f"Shared state coordinator listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def _reply(request: Dict[str, Any]) -> None:
+            try:
+                response = {"id": request["id"], "ok": True, "result": await self._dispatch(request)}
+            except Exception as e:
+                response = {"id": request["id"], "ok": False, "error": str(e)}
+            async with write_lock:
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                # Each request gets its own task: a follower parked on a flight must not block the connection
+                task = asyncio.ensure_future(_reply(json.loads(line)))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: Dict[str, Any]) -> Any:
+        op = request["op"]
+
+        if op == "bootstrap":
+            return self.bootstrap
+
+        if op == "cache_get":
+            value = await self.cache.get(request["key"])
+            return base64.b64encode(value).decode("ascii") if value is not None else None
+        if op == "cache_set":
+            await self.cache.set(request["key"], base64.b64decode(request["value"]), request["ttl"])
+            return None
+        if op == "cache_delete":
+            await self.cache.delete(request["key"])
+            return None
+
+        if op == "bucket_take":
+            bucket = self._bucket(request)
+            wait = bucket.try_take(request["cost"])
+            return {"wait": wait, "rpm": bucket.current_rpm, "headroom": bucket.headroom()}
+        if op == "bucket_adjust":
+            bucket = self._bucket(request)
+            bucket.on_success() if request["direction"] == "increase" else bucket.on_rate_limited()
+            return None
+
+        if op == "budget_add":
+            entry = self.budgets.get(request["name"])
+            if request["window"] > self.budget_window:
+                # Clients of previous windows are done with: drop them rather than keep every name ever seen
+                self.budgets = {name: used for name, used in self.budgets.items() if used[0] >= request["window"]}
+                self.budget_window = request["window"]
+            if entry is None or entry[0] != request["window"]:
+                entry = self.budgets[request["name"]] = [request["window"], 0.0]
+            entry[1] = max(0.0, entry[1] + request["amount"])
+            return entry[1]
+
+        if op == "flight_join":
+            return await self._flight_join(request["key"], request["ttl"])
+        if op == "flight_done":
+            future = self.flights.pop(request["key"], None)
+            if future is not None and not future.done():
+                future.set_result(request.get("value"))
+            return None
+
+        if op == "lead":
+            return self._lead(request["name"], request["owner"], request["ttl"])
+        if op == "doc_put":
+            self.documents[request["name"]] = request["value"]
+            return None
+        if op == "doc_get":
+            return self.documents.get(request["name"])
+
+        raise ValueError(f"Unknown op {op!r}")
+
+    def _bucket(self, request: Dict[str, Any]) -> ModelRateLimiter:
+        bucket = self.buckets.get(request["name"])
+        if bucket is None:
+            bucket = ModelRateLimiter(
+                request["name"], rpm=request["rpm"], tpm=request["tpm"], burst_seconds=request.get("burst_seconds", 10.0)
+            )
+            self.buckets[request["name"]] = bucket
+        return bucket
+
+    async def _flight_join(self, key: str, ttl: float) -> Dict[str, Any]:
+        future = self.flights.get(key)
+        if future is None:
+            self.flights[key] = asyncio.get_running_loop().create_future()
+            # A leader that dies never reports back; expire its slot so followers aren't stuck
+            asyncio.get_running_loop().call_later(ttl, self._expire_flight, key, self.flights[key])
+            return {"leader": True}
+
+        try:
+            value = await asyncio.wait_for(asyncio.shield(future), ttl)
+        except asyncio.TimeoutError:
+            value = None
+        return {"leader": False, "value": value}
+
+    def _expire_flight(self, key: str, future: asyncio.Future) -> None:
+        if self.flights.get(key) is future:
+            del self.flights[key]
+        if not future.done():
+            future.set_result(None)
+
+    def _lead(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.monotonic()
+        holder = self.leases.get(name)
+        if holder is None or holder[0] == owner or holder[1] < now:
+            self.leases[name] = (owner, now + ttl)
+            return True
+        return False
+
+
+# --- 2. Worker-side client ---
+
+def fetch_bootstrap(path: str, timeout: float = 10.0) -> Dict[str, Any]:
+    """Blocking one-off call used while settings are being loaded, before any event loop runs."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps({"id": 0, "op": "bootstrap"}).encode("utf-8") + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    response = json.loads(data)
+    if not response.get("ok"):
+        raise RuntimeError(f"Bootstrap failed: {response.get('error')}")
+    return response["result"]
+
+
+@lru_cache
+def worker_bootstrap() -> Optional[Dict[str, Any]]:
+    """Settings and models as loaded by the supervisor, or None outside serve.py workers."""
+    path = os.environ.get(SOCKET_ENV)
+    return fetch_bootstrap(path) if path else None
+
+
+class SharedStateClient:
+    """One multiplexed connection per worker; every call fails fast with SharedStateUnavailable."""
+
+    def __init__(self, path: str, timeout: float = 2.0):
+        self.path = path
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        self._casts = set()
+        self.failures = 0
+
+    async def _connection(self) -> asyncio.StreamWriter:
+        if self._writer is not None and not self._writer.is_closing():
+            return self._writer
+
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=16 * 1024 * 1024)
+                self._reader_task = asyncio.create_task(self._read_loop(reader))
+        return self._writer
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                future = self._pending.pop(response["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(SharedStateUnavailable("connection to the coordinator closed"))
+            self._pending.clear()
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    async def call(self, op: str, timeout: Optional[float] = None, **params: Any) -> Any:
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            writer = await self._connection()
+            writer.write(json.dumps({"id": request_id, "op": op, **params}).encode("utf-8") + b"\n")
+            response = await asyncio.wait_for(future, timeout or self.timeout)
+        except SharedStateUnavailable:
+            self.failures += 1
+            raise
+        except (OSError, asyncio.TimeoutError) as e:
+            self.failures += 1
+            raise SharedStateUnavailable(f"{op} failed: {e}") from e
+        finally:
+            self._pending.pop(request_id, None)
+
+        if not response["ok"]:
+            raise SharedStateUnavailable(response["error"])
+        return response["result"]
+
+    def cast(self, op: str, **params: Any) -> None:
+        """Fire-and-forget call for updates nobody waits on."""
+        async def _send():
+            try:
+                await self.call(op, **params)
+            except SharedStateUnavailable as e:
+                logger.debug(f"Shared state {op} dropped: {e}")
+
+        task = asyncio.ensure_future(_send())
+        self._casts.add(task)
+        task.add_done_callback(self._casts.discard)
+
+    # Coordination used by ModelRegistry: one leader pings, the others read what it published
+
+    async def lead(self, name: str, ttl: float) -> bool:
+        return await self.call("lead", name=name, owner=self.owner, ttl=ttl)
+
+    async def put_document(self, name: str, value: Any) -> None:
+        await self.call("doc_put", name=name, value=value)
+
+    async def get_document(self, name: str) -> Any:
+        return await self.call("doc_get", name=name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"socket": self.path, "connected": self._writer is not None, "failures": self.failures}
+
+
+@lru_cache
+def shared_state_client() -> Optional["SharedStateClient"]:
+    path = os.environ.get(SOCKET_ENV)
+    return SharedStateClient(path) if path else None
+
+
+# --- 3. Shared versions of the per-process building blocks ---
+
+class SharedCacheBackend:
+    """CacheBackend stored in the coordinator, so a response cached by one worker is a hit in all of them."""
+
+    def __init__(self, client: SharedStateClient):
+        self.client = client
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = await self.client.call("cache_get", key=key)
+        except SharedStateUnavailable as e:
+            # A cache outage must never take generation down with it
+            logger.warning(f"Shared cache get failed: {e}")
+            return None
+        return base64.b64decode(value) if value is not None else None
+
+    async def set(self, key: str, value: bytes, ttl: float) -> None:
+        try:
+            await self.client.call("cache_set", key=key, value=base64.b64encode(value).decode("ascii"), ttl=ttl)
+        except SharedStateUnavailable as e:
+            logger.warning(f"Shared cache set failed: {e}")
+
+    async def delete(self, key: str) -> None:
+        try:
+            await self.client.call("cache_delete", key=key)
+        except SharedStateUnavailable as e:
+            logger.warning(f"Shared cache delete failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "shared", **self.client.stats()}
+
+
+class SharedModelRateLimiter(ModelRateLimiter):
+    """
+        Same admission contract as ModelRateLimiter, but the bucket lives in the
+        coordinator so N workers together stay within one key's quota. If the
+        coordinator is unreachable this process falls back to its own bucket.
+    """
+
+    def __init__(self, client: SharedStateClient, scope: str, model: str, **kwargs: Any):
+        super().__init__(model, **kwargs)
+        self.client = client
+        self.bucket_name = f"{scope}:{model}"
+        self._remote_headroom: Optional[float] = None
+
+    async def acquire(self, estimated_tokens: int = 0) -> None:
+        cost = min(float(estimated_tokens), self.tpm)
+
+        if self.waiting >= self.max_queue:
+            self.shed += 1
+            raise RateLimitExceeded(self.model, "admission queue is full", self.max_wait)
+
+        deadline = time.monotonic() + self.max_wait
+        self.waiting += 1
+        try:
+            while True:
+                try:
+                    reply = await self.client.call(
+                        "bucket_take", name=self.bucket_name, rpm=self.max_rpm, tpm=self.tpm,
+                        burst_seconds=self.burst_seconds, cost=cost
+                    )
+                    wait = reply["wait"]
+                    self.current_rpm = reply["rpm"]
+                    self._remote_headroom = reply["headroom"]
+                except SharedStateUnavailable:
+                    wait = self.try_take(cost)
+
+                if wait <= 0:
+                    self.admitted += 1
+                    return
+
+                if time.monotonic() + wait > deadline:
+                    self.shed += 1
+                    raise RateLimitExceeded(self.model, "over budget", wait)
+
+                await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+    def on_success(self) -> None:
+        super().on_success()
+        if self.current_rpm < self.max_rpm:
+            self.client.cast("bucket_adjust", name=self.bucket_name, rpm=self.max_rpm, tpm=self.tpm, direction="increase")
+
+    def on_rate_limited(self) -> None:
+        super().on_rate_limited()
+        self.client.cast("bucket_adjust", name=self.bucket_name, rpm=self.max_rpm, tpm=self.tpm, direction="decrease")
+
+    def is_saturated(self) -> bool:
+        if self._remote_headroom is None:
+            return super().is_saturated()
+        return self.waiting >= self.max_queue or (self.waiting > 0 and self._remote_headroom < 1.0)
+
+    def headroom(self) -> float:
+        if self._remote_headroom is None:
+            return super().headroom()
+        return self._remote_headroom - self.waiting
+
+
+class SharedSingleFlight(SingleFlight):
+    """
+        SingleFlight across workers: callers are first collapsed in-process, then the
+        one local leader joins the coordinator's slot for the key. Only the global
+        leader calls upstream; the others receive its result. If the leader fails
+        or the coordinator is down, followers fall back to their own call.
+    """
+
+    def __init__(self, client: SharedStateClient, ttl: float = 60.0):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.remote_followers = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        return await super().do(key, lambda: self._global(key, fn))
+
+    async def _global(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            # Followers park inside the coordinator, so the call timeout must outlast the slot
+            joined = await self.client.call("flight_join", timeout=self.ttl + 5, key=key, ttl=self.ttl)
+        except SharedStateUnavailable:
+            return await fn()
+
+        if not joined["leader"]:
+            if joined["value"] is not None:
+                self.remote_followers += 1
+                return joined["value"]
+            return await fn()
+
+        value = None
+        try:
+            value = await fn()
+            return value
+        finally:
+            # Only strings travel; anything else (or a failure) sends followers to run their own call
+            self.client.cast("flight_done", key=key, value=value if isinstance(value, str) else None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**super().stats(), "remote_followers": self.remote_followers}
+
+
+class SharedTokenBudgets(TokenBudgets):
+    """Per-client token budgets counted in the coordinator, so a client's budget is not multiplied by the worker count."""
+
+    def __init__(self, client: SharedStateClient, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.client = client
+
+    async def _add(self, client: str, amount: float) -> float:
+        start = self._prune()
+        try:
+            used = await self.client.call("budget_add", name=client, window=start, amount=amount)
+        except SharedStateUnavailable:
+            return await super()._add(client, amount)
+        # Mirrored locally for /stats
+        self._used[client] = [start, used]
+        return used
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- 1. Complete (single value) deduplication ---
+
+class SingleFlight:
+    """
+        Collapses concurrent identical calls onto one upstream future.
+        The upstream call runs in its own task so a caller that goes away
+        does not cancel the work the other callers are waiting on; it is
+        cancelled only once the last of them is gone.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _t: self._calls.pop(key, None))
+        else:
+            self.followers += 1
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            remaining = self._waiters.pop(task) - 1
+            if remaining:
+                self._waiters[task] = remaining
+            elif not task.done():
+                # Every caller went away: stop paying for the upstream call
+                self.abandoned += 1
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "abandoned": self.abandoned,
+        }
+
+
+# --- 2. Stream fan-out ---
+
+_END = object()
+
+
+class _StreamBroadcast:
+    """One upstream stream, replayed to every subscriber that attaches to it."""
+
+    def __init__(self, max_queue_size: int):
+        self.max_queue_size = max_queue_size
+        self.buffer: List[str] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.opened: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.producer: Optional[asyncio.Task] = None
+
+    def attach(self) -> tuple:
+        """
+            Registers a bounded queue and snapshots the chunks buffered so far.
+            Nothing awaits between the two, so no chunk can fall in the gap.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.subscribers.append(queue)
+        return queue, len(self.buffer)
+
+    def detach(self, queue: asyncio.Queue) -> None:
+        if queue in self.subscribers:
+            self.subscribers.remove(queue)
+
+
+class SlowSubscriberError(Exception):
+    """Raised to a subscriber whose queue stayed full for too long."""
+
+
+class StreamFanout:
+    """
+        Shares one `generate_content_stream` between identical concurrent requests.
+        Each subscriber gets a bounded queue; a subscriber that joins late first
+        replays the chunks already produced, then follows the live stream.
+        The producer never waits for a reader: one whose queue is full is dropped.
+    """
+
+    def __init__(self, max_queue_size: int = 256):
+        self.max_queue_size = max_queue_size
+        self._streams: Dict[str, _StreamBroadcast] = {}
+        self.leaders = 0
+        self.followers = 0
+        self.dropped_subscribers = 0
+
+    async def subscribe(
+        self,
+        key: str,
+        opener: Callable[[], Awaitable[AsyncGenerator[str, None]]]
+    ) -> AsyncGenerator[str, None]:
+        """
+            Returns a chunk generator for `key`. Errors raised while opening the
+            upstream stream propagate here, exactly like a direct call would.
+        """
+        broadcast = self._streams.get(key)
+
+        if broadcast is None:
+            self.leaders += 1
+            broadcast = _StreamBroadcast(self.max_queue_size)
+            self._streams[key] = broadcast
+            broadcast.producer = asyncio.create_task(self._produce(key, broadcast, opener))
+        else:
+            self.followers += 1
+
+        queue, replay_upto = broadcast.attach()
+
+        try:
+            await asyncio.shield(broadcast.opened)
+        except BaseException:
+            self._release(key, broadcast, queue)
+            raise
+
+        return self._consume(key, broadcast, queue, replay_upto)
+
+    async def _produce(self, key: str, broadcast: _StreamBroadcast, opener) -> None:
+        stream = None
+        try:
+            try:
+                stream = await opener()
+            except asyncio.CancelledError:
+                broadcast.opened.cancel()
+                raise
+            except Exception as e:
+                broadcast.opened.set_exception(e)
+                # Mark the exception retrieved in case every subscriber already left
+                broadcast.opened.exception()
+                return
+
+            broadcast.opened.set_result(None)
+
+            try:
+                async for chunk in stream:
+                    broadcast.buffer.append(chunk)
+                    self._publish(broadcast, chunk)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._publish(broadcast, e)
+                return
+
+            self._publish(broadcast, _END)
+        finally:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+            # Also when cancelled mid-publish: the upstream connection must not outlive the broadcast
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                try:
+                    await aclose()
+                except Exception as e:
+                    logger.warning(f"Failed to close upstream stream: {e}")
+
+    def _publish(self, broadcast: _StreamBroadcast, item: Any) -> None:
+        for queue in list(broadcast.subscribers):
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                # A full queue is a reader `max_queue_size` chunks behind: waiting for it would stall everyone else
+                self.dropped_subscribers += 1
+                broadcast.detach(queue)
+                logger.warning("Dropping slow stream subscriber")
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(SlowSubscriberError("Stream consumer is too slow"))
+
+    async def _consume(
+        self,
+        key: str,
+        broadcast: _StreamBroadcast,
+        queue: asyncio.Queue,
+        replay_upto: int
+    ) -> AsyncGenerator[str, None]:
+        try:
+            for chunk in broadcast.buffer[:replay_upto]:
+                yield chunk
+
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self._release(key, broadcast, queue)
+
+    def _release(self, key: str, broadcast: _StreamBroadcast, queue: asyncio.Queue) -> None:
+        broadcast.detach(queue)
+        # Nobody is reading any more: stop paying for the upstream stream
+        if not broadcast.subscribers and broadcast.producer and not broadcast.producer.done():
+            broadcast.producer.cancel()
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._streams),
+            "subscribers": sum(len(b.subscribers) for b in self._streams.values()),
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "dropped_subscribers": self.dropped_subscribers,
+        }
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from metrics import READY, STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class StartupState:
+    """
+        Cold-start timeline of this worker, from the first import of main.py to the end
+        of warm-up. /ready stays red until `ready` is set; / (liveness) does not wait for it.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.warm_connections: Dict[str, int] = {}
+        self.models_loaded = 0
+        self.ready = False
+        self.ready_after: Optional[float] = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def record(self, name: str, seconds: float) -> None:
+        self.phases[name] = round(seconds, 4)
+        STARTUP_SECONDS.labels(name).set(seconds)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    async def warm_up(self, llm_service: Any, connections_per_key: int, timeout: float) -> None:
+        """Opens upstream connections before traffic arrives, then flips readiness (also when warm-up fails)."""
+        try:
+            with self.phase("warm_connections"):
+                self.warm_connections = await llm_service.warm_up(connections_per_key, timeout)
+        except Exception as e:
+            # An unreachable upstream shows up in the errors of real requests; it shouldn't keep the worker out of rotation
+            logger.warning(f"Connection warm-up failed, serving cold: {e!r}")
+        self.mark_ready()
+
+    def mark_ready(self) -> None:
+        self.ready = True
+        self.ready_after = round(self.elapsed(), 4)
+        STARTUP_SECONDS.labels("total").set(self.ready_after)
+        READY.labels().set(1)
+        logger.info(f"Ready after {self.ready_after:.2f}s: {self.phases}")
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "ready_after_seconds": self.ready_after,
+            "phases": self.phases,
+            "models_loaded": self.models_loaded,
+            "warm_connections": self.warm_connections,
+        }
+
+
+# Created when main.py is first imported, so the import time of everything after it is counted
+STARTUP = StartupState()
+
+
+async def cancel_warm_up(task: Optional[asyncio.Task]) -> None:
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
@@ -1,10 +1,20 @@
 import json
-from typing import AsyncGenerator
-from venv import logger
+from json.encoder import encode_basestring, encode_basestring_ascii
+import logging
+import time
+from typing import AsyncGenerator, Optional
 
 from fastapi import HTTPException
 
-from LLMService import LLMServiceError
+from LLMService import LLMServiceError, get_settings
+from metrics import FORMATTER_CHUNKS, FORMATTER_SECONDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 def complete_formatter_text(result: str) -> str: 
     return result 
@@ -13,21 +23,38 @@ def complete_formatter_json(result: str) -> dict:
     return {"text": result}
 
 
-async def stream_formatter_json(raw_stream):
+async def stream_formatter_json(
+    raw_stream, stream_id: Optional[str] = None, start: int = 0, usage: Optional[dict] = None
+):
     """
     Takes the raw text stream from LLMService and formats it 
     into line-delimited JSON (NDJSON) and encodes it for HTTP streaming.
+    A resumable stream (`stream_id` set) numbers its lines with an "offset" from `start`.
+    Ends with a {"type": "usage"} line if `usage` was filled in by then.
     """
+    seconds = FORMATTER_SECONDS.labels("json")
+    chunks = FORMATTER_CHUNKS.labels("json")
+    offset = start
     try:
         async for text_chunk in raw_stream:
+            started = time.perf_counter()
         
             data = {"text": text_chunk}
+            if stream_id is not None:
+                data["offset"] = offset
+                offset += 1
             
             # 2. Serialize to a JSON string and add a newline (NDJSON)
             json_string = json.dumps(data, ensure_ascii=False) + "\n"
             
             # Encode the string to bytes for the StreamingResponse
-            yield json_string.encode("utf-8")
+            encoded = json_string.encode("utf-8")
+            seconds.value += time.perf_counter() - started
+            chunks.value += 1
+            yield encoded
+
+        if usage:
+            yield (json.dumps({"type": "usage", "usage": usage}, ensure_ascii=False) + "\n").encode("utf-8")
     except LLMServiceError as e: 
         raise HTTPException( 
             status_code=e.status_code, 
@@ -43,15 +70,23 @@ async def stream_formatter_json(raw_stream):
         yield error_payload.encode("utf-8")
 
 
-async def stream_formatter_text(raw_stream):
+async def stream_formatter_text(
+    raw_stream, stream_id: Optional[str] = None, start: int = 0, usage: Optional[dict] = None
+):
     """
     Takes the raw text stream from LLMService and formats it 
-    into plain text.
+    into plain text. Plain text has nowhere to carry offsets or usage, so `stream_id` and `usage` are ignored.
     """
+    seconds = FORMATTER_SECONDS.labels("text")
+    chunks = FORMATTER_CHUNKS.labels("text")
     try:
         async for text_chunk in raw_stream:
+            started = time.perf_counter()
             # Encode the string to bytes for the StreamingResponse
-            yield text_chunk.encode("utf-8")
+            encoded = text_chunk.encode("utf-8")
+            seconds.value += time.perf_counter() - started
+            chunks.value += 1
+            yield encoded
     except Exception as e:
         logger.error(f"Streaming Error: {e}", exc_info=True)
         message = getattr(e, "public_message", "There was an issue with streaming")
@@ -59,20 +94,40 @@ async def stream_formatter_text(raw_stream):
         yield error_payload.encode("utf-8")
 
     
-async def stream_formatter_sse(raw_stream) -> AsyncGenerator[str, None]:
+async def stream_formatter_sse(
+    raw_stream, stream_id: Optional[str] = None, start: int = 0, usage: Optional[dict] = None
+) -> AsyncGenerator[str, None]:
     """
     Formats an async text stream into SSE events:
         - 'chunk' for incremental text
+        - 'usage' with the request's token counts, if `usage` was filled in by then
         - 'done' when the stream finishes normally
         - 'error' if an exception occurs
+    A resumable stream (`stream_id` set) gives each event an `id: <stream_id>:<n>`,
+    counting from `start`, for EventSource to send back as Last-Event-ID.
     """
+    seconds = FORMATTER_SECONDS.labels("sse")
+    chunks = FORMATTER_CHUNKS.labels("sse")
+    offset = start
     try:
         async for text_chunk in raw_stream:
+            started = time.perf_counter()
             payload = json.dumps({"text":text_chunk})
-            yield f"event: chunk\ndata: {payload}\n\n"
+            event = f"event: chunk\ndata: {payload}\n\n"
+            if stream_id is not None:
+                event = f"id: {stream_id}:{offset}\n" + event
+                offset += 1
+            seconds.value += time.perf_counter() - started
+            chunks.value += 1
+            yield event
+
+        # Not numbered: resuming never replays it
+        if usage:
+            yield f"event: usage\ndata: {json.dumps(usage)}\n\n"
 
         # When the generator finishes normallly
-        yield "event: done\ndata: {}\n\n"
+        done = "event: done\ndata: {}\n\n"
+        yield done if stream_id is None else f"id: {stream_id}:{offset}\n" + done
     
     except Exception as e:
         # Send an error event with a message
@@ -81,3 +136,126 @@ async def stream_formatter_sse(raw_stream) -> AsyncGenerator[str, None]:
         error_payload = json.dumps({"message": message})
         yield f"event: sse_error\ndata: {error_payload}\n\n"
 
+
+# --- Pre-encoded framing engine ---
+# Same bytes on the wire as the formatters above, without the per-chunk dict, JSONEncoder
+# construction (json.dumps builds a new encoder whenever ensure_ascii=False is passed),
+# f-string and re-encode. Each chunk is one C-level escape plus a single join against
+# prefix/suffix bytes built at import time. Frames are fresh bytes objects rather than
+# views of one reused buffer: servers and middleware may hold on to a yielded chunk
+# (queued transport writes, compression) after the generator has moved on.
+
+_NDJSON_PREFIX = b'{"text": '
+_NDJSON_SUFFIX = b'}\n'
+_NDJSON_OFFSET = b', "offset": '
+_SSE_PREFIX = b'event: chunk\ndata: {"text": '
+_SSE_SUFFIX = b'}\n\n'
+_SSE_DONE = b"event: done\ndata: {}\n\n"
+_join = b"".join
+
+
+def _escape_json_utf8(text: str) -> bytes:
+    # json.dumps(..., ensure_ascii=False) escaping, UTF-8 encoded
+    return encode_basestring(text).encode("utf-8")
+
+
+if orjson is not None:
+    def _escape_json_utf8_orjson(text: str) -> bytes:
+        try:
+            # orjson escapes strings exactly like ensure_ascii=False and returns UTF-8 directly
+            return orjson.dumps(text)
+        except TypeError:
+            # Lone surrogates: take the stdlib path so the failure matches the classic formatter
+            return _escape_json_utf8(text)
+
+    _escape_ndjson = _escape_json_utf8_orjson
+else:
+    _escape_ndjson = _escape_json_utf8
+
+
+async def stream_formatter_json_fast(
+    raw_stream, stream_id: Optional[str] = None, start: int = 0, usage: Optional[dict] = None
+):
+    """NDJSON like stream_formatter_json, framed with pre-encoded bytes."""
+    seconds = FORMATTER_SECONDS.labels("json_fast")
+    chunks = FORMATTER_CHUNKS.labels("json_fast")
+    perf_counter = time.perf_counter
+    escape = _escape_ndjson
+    offset = start
+    try:
+        async for text_chunk in raw_stream:
+            started = perf_counter()
+            if stream_id is None:
+                encoded = _join((_NDJSON_PREFIX, escape(text_chunk), _NDJSON_SUFFIX))
+            else:
+                encoded = _join((_NDJSON_PREFIX, escape(text_chunk), _NDJSON_OFFSET, str(offset).encode("ascii"), _NDJSON_SUFFIX))
+                offset += 1
+            seconds.value += perf_counter() - started
+            chunks.value += 1
+            yield encoded
+
+        if usage:
+            yield (json.dumps({"type": "usage", "usage": usage}, ensure_ascii=False) + "\n").encode("utf-8")
+    except LLMServiceError as e:
+        raise HTTPException(
+            status_code=e.status_code,
+            detail = {
+                "error": "LLM_PROVIDER_ERROR",
+                "message": e.public_message
+            }
+        )
+    except Exception as e:
+        logger.error(f"Streaming Error: {e}", exc_info=True)
+        message = getattr(e, "public_message", "There was an issue with streaming")
+        error_payload = json.dumps({"text": message}) + "\n"
+        yield error_payload.encode("utf-8")
+
+
+async def stream_formatter_sse_fast(
+    raw_stream, stream_id: Optional[str] = None, start: int = 0, usage: Optional[dict] = None
+) -> AsyncGenerator[bytes, None]:
+    """SSE like stream_formatter_sse (ASCII-escaped JSON), framed with pre-encoded bytes."""
+    seconds = FORMATTER_SECONDS.labels("sse_fast")
+    chunks = FORMATTER_CHUNKS.labels("sse_fast")
+    perf_counter = time.perf_counter
+    # Built once per stream, like the module-level prefixes
+    id_prefix = b"id: " + stream_id.encode("utf-8") + b":" if stream_id is not None else None
+    offset = start
+    try:
+        async for text_chunk in raw_stream:
+            started = perf_counter()
+            # ASCII-only output, so latin-1 is a straight byte copy
+            if id_prefix is None:
+                event = _join((_SSE_PREFIX, encode_basestring_ascii(text_chunk).encode("latin-1"), _SSE_SUFFIX))
+            else:
+                event = _join((
+                    id_prefix, str(offset).encode("ascii"), b"\n",
+                    _SSE_PREFIX, encode_basestring_ascii(text_chunk).encode("latin-1"), _SSE_SUFFIX
+                ))
+                offset += 1
+            seconds.value += perf_counter() - started
+            chunks.value += 1
+            yield event
+
+        if usage:
+            yield _join((b"event: usage\ndata: ", json.dumps(usage).encode("utf-8"), b"\n\n"))
+        yield _SSE_DONE if id_prefix is None else _join((id_prefix, str(offset).encode("ascii"), b"\n", _SSE_DONE))
+
+    except Exception as e:
+        logger.error(f"Streaming Error: {e}", exc_info=True)
+        message = getattr(e, "public_message", "There was an issue with streaming")
+        error_payload = json.dumps({"message": message})
+        yield f"event: sse_error\ndata: {error_payload}\n\n".encode("utf-8")
+
+
+STREAM_FORMATTER_ENGINES = {
+    "classic": {"json": stream_formatter_json, "text": stream_formatter_text, "sse": stream_formatter_sse},
+    "fast": {"json": stream_formatter_json_fast, "text": stream_formatter_text, "sse": stream_formatter_sse_fast},
+}
+
+
+def select_stream_formatter(kind: str, endpoint: str):
+    """The formatter for `kind` ("json", "text", "sse") using the engine configured for `endpoint`."""
+    settings = get_settings()
+    engine = settings.stream_formatter_endpoint_engines.get(endpoint, settings.stream_formatter_engine)
+    return STREAM_FORMATTER_ENGINES[engine][kind]
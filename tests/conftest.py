@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service is a flat set of top-level modules, imported as such by main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,61 @@
+import asyncio
+
+from history_compaction import SUMMARY_PREFIX, HistoryCompactor
+
+
+def _turns(count: int, words: int = 50) -> list:
+    return [
+        {"role": "user" if i % 2 == 0 else "model", "parts": [{"text": f"turn {i} " + "word " * words}]}
+        for i in range(count)
+    ]
+
+
+def test_short_overflow_is_summarized_not_dropped():
+    async def scenario():
+        folded = []
+
+        async def summarize(previous, turns, requester):
+            folded.append((previous, len(turns), requester))
+            return "summary"
+
+        compactor = HistoryCompactor(summarize, default_budget=250, keep_recent_turns=2, summary_block=8, summary_max_tokens=50)
+        contents = _turns(5) + [{"role": "user", "parts": [{"text": "prompt"}]}]
+        compacted = await compactor.compact(contents, "m", requester=("client", "interactive"))
+
+        assert compacted[0]["parts"][0]["text"] == SUMMARY_PREFIX + "summary"
+        assert compacted[-1] == contents[-1]
+        kept = len(compacted) - 2
+        # Every older turn went into the summary
+        assert folded == [(None, 5 - kept, ("client", "interactive"))]
+
+    asyncio.run(scenario())
+
+
+def test_summaries_are_reused_across_requests():
+    async def scenario():
+        calls = []
+
+        async def summarize(previous, turns, requester):
+            calls.append(len(turns))
+            return "summary"
+
+        compactor = HistoryCompactor(summarize, default_budget=800, keep_recent_turns=2, summary_block=4, summary_max_tokens=50)
+        history = _turns(20)
+        for n in (18, 19):
+            await compactor.compact(history[:n] + [{"role": "user", "parts": [{"text": "prompt"}]}], "m")
+        assert compactor.summaries_generated == len(calls)
+        assert compactor.summary_cache_hits >= 1
+
+    asyncio.run(scenario())
+
+
+def test_history_under_budget_is_untouched():
+    async def scenario():
+        async def summarize(previous, turns, requester):
+            raise AssertionError("no summary expected")
+
+        compactor = HistoryCompactor(summarize, default_budget=10_000)
+        contents = _turns(4)
+        assert await compactor.compact(contents, "m") == contents
+
+    asyncio.run(scenario())
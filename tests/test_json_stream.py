@@ -0,0 +1,96 @@
+import json
+import random
+
+import pytest
+
+from json_stream import IncrementalJSONParser, StructuredOutputError, parse_document, validate
+
+
+def _feed_in_chunks(parser: IncrementalJSONParser, text: str, size: int) -> list:
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return events
+
+
+DOCUMENT = {
+    "title": "Café \"quoted\" \\ 😀",
+    "count": 12,
+    "ratio": -1.5e3,
+    "flags": [True, False, None],
+    "nested": {"empty": {}, "list": [], "deep": [[1, 2], {"k": "v"}]},
+}
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_any_chunking_yields_the_same_document(size):
+    parser = IncrementalJSONParser()
+    _feed_in_chunks(parser, json.dumps(DOCUMENT), size)
+    assert parser.finish() == {"type": "done", "value": DOCUMENT}
+
+
+def test_root_members_are_reported_as_they_complete():
+    schema = {"type": "object", "properties": {"count": {"type": "string"}}}
+    parser = IncrementalJSONParser(schema)
+    events = _feed_in_chunks(parser, json.dumps({"title": "a", "count": 1}), 4)
+
+    fields = [event for event in events if event["type"] != "partial"]
+    assert fields[0] == {"type": "field", "path": ["title"], "value": "a"}
+    assert fields[1]["type"] == "invalid" and fields[1]["path"] == ["count"]
+
+
+def test_partial_snapshots_are_prefixes_of_the_document():
+    text = json.dumps(DOCUMENT)
+    parser = IncrementalJSONParser()
+    for i in range(0, len(text), 3):
+        for event in parser.feed(text[i:i + 3]):
+            if event["type"] == "partial":
+                # A snapshot never contains anything the finished document won't
+                assert isinstance(event["value"], dict)
+                for key in event["value"]:
+                    assert key in DOCUMENT
+
+
+def test_partial_output_stays_linear_in_the_document_size():
+    rng = random.Random(7)
+    document = {"items": [{"id": i, "name": "x" * rng.randint(5, 60)} for i in range(2000)]}
+    text = json.dumps(document)
+    parser = IncrementalJSONParser()
+
+    sent = sum(len(json.dumps(event)) for event in _feed_in_chunks(parser, text, 40))
+    assert sent < 10 * len(text)
+    assert parser.finish()["value"] == document
+
+
+def test_raw_control_character_is_a_structured_error():
+    parser = IncrementalJSONParser()
+    with pytest.raises(StructuredOutputError):
+        parser.feed('{"a":"\x01"}')
+
+
+@pytest.mark.parametrize("text", ['{"a" 1}', '{"a": tru}', '[1,,2]', '{"a": 01x}', '{} {}'])
+def test_malformed_output_is_a_structured_error(text):
+    parser = IncrementalJSONParser()
+    with pytest.raises(StructuredOutputError):
+        parser.feed(text)
+        parser.finish()
+
+
+def test_truncated_output_fails_at_finish():
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": [1, 2')
+    with pytest.raises(StructuredOutputError):
+        parser.finish()
+
+
+def test_schema_validation():
+    schema = {
+        "type": "object",
+        "required": ["name"],
+        "additionalProperties": False,
+        "properties": {"name": {"type": "string"}, "tags": {"type": "array", "items": {"enum": ["a", "b"]}}},
+    }
+    assert validate({"name": "x", "tags": ["a"]}, schema) == []
+    assert len(validate({"tags": ["c"], "extra": 1}, schema)) == 3
+    with pytest.raises(StructuredOutputError):
+        parse_document('{"name": 1}', schema)
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from resumable_streams import ResumableStreams, StreamNotResumable, parse_last_event_id
+
+
+async def _source(chunks, gate: asyncio.Event = None):
+    for chunk in chunks:
+        if gate is not None:
+            await gate.wait()
+        yield chunk
+        await asyncio.sleep(0)
+
+
+def test_resume_from_an_offset_replays_the_rest():
+    async def scenario():
+        streams = ResumableStreams()
+        entry = streams.create()
+        streams.start(entry, _source(["a", "b", "c", "d"]))
+
+        assert [chunk async for chunk in streams.open(entry.stream_id, 0)] == ["a", "b", "c", "d"]
+        assert [chunk async for chunk in streams.open(entry.stream_id, 2)] == ["c", "d"]
+        assert streams.stats()["resumed"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_reader_follows_a_running_stream():
+    async def scenario():
+        streams = ResumableStreams()
+        entry = streams.create()
+        gate = asyncio.Event()
+        streams.start(entry, _source(["a", "b", "c"], gate))
+
+        reader = asyncio.create_task(_collect(streams.open(entry.stream_id, 0)))
+        await asyncio.sleep(0)
+        gate.set()
+        assert await asyncio.wait_for(reader, 1) == ["a", "b", "c"]
+
+    asyncio.run(scenario())
+
+
+async def _collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_offset_dropped_from_the_buffer_is_not_resumable():
+    async def scenario():
+        streams = ResumableStreams(max_chars_per_stream=4)
+        entry = streams.create()
+        streams.start(entry, _source(["aa", "bb", "cc", "dd"]))
+        await entry.producer
+
+        assert entry.base == 2
+        with pytest.raises(StreamNotResumable):
+            streams.open(entry.stream_id, 1)
+        assert [chunk async for chunk in streams.open(entry.stream_id, 2)] == ["cc", "dd"]
+
+    asyncio.run(scenario())
+
+
+def test_upstream_error_reaches_every_reader():
+    async def scenario():
+        async def failing():
+            yield "a"
+            raise RuntimeError("upstream broke")
+
+        streams = ResumableStreams()
+        entry = streams.create()
+        streams.start(entry, failing())
+
+        received = []
+        with pytest.raises(RuntimeError):
+            async for chunk in streams.open(entry.stream_id, 0):
+                received.append(chunk)
+        assert received == ["a"]
+
+    asyncio.run(scenario())
+
+
+def test_stream_is_abandoned_only_after_the_grace_period():
+    async def scenario():
+        streams = ResumableStreams(detach_grace=0.05)
+        entry = streams.create()
+        assert not await entry.is_abandoned()
+        await asyncio.sleep(0.06)
+        assert await entry.is_abandoned()
+        with pytest.raises(StreamNotResumable):
+            streams.open(entry.stream_id, 0)
+
+    asyncio.run(scenario())
+
+
+def test_unknown_stream_is_not_resumable():
+    async def scenario():
+        streams = ResumableStreams()
+        with pytest.raises(StreamNotResumable):
+            streams.open("missing", 0)
+        assert streams.stats()["not_resumable"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id("abc:4") == ("abc", 5)
+    assert parse_last_event_id("a:b:0") == ("a:b", 1)
+    assert parse_last_event_id("abc") is None
+    assert parse_last_event_id(None) is None
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from retry_policy import CircuitBreaker, CircuitOpenError, RetryEngine, RetryPolicy
+
+
+class Upstream(Exception):
+    def __init__(self, is_retryable: bool):
+        super().__init__("upstream error")
+        self.is_retryable = is_retryable
+
+
+def _open_breaker(engine: RetryEngine, model: str) -> CircuitBreaker:
+    breaker = engine.breaker(model)
+    for _ in range(engine.failure_threshold):
+        breaker.record_failure()
+    # Skip the reset timeout: the next check() lets one probe through
+    breaker.opened_at -= engine.reset_timeout
+    return breaker
+
+
+def test_breaker_opens_and_lets_one_probe_through():
+    breaker = CircuitBreaker("m", failure_threshold=2, reset_timeout=30.0)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.is_open()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.opened_at -= 30.0
+    breaker.check()
+    assert breaker.state == "half_open"
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.check()
+
+
+def test_cancelled_probe_releases_half_open():
+    async def scenario():
+        engine = RetryEngine(RetryPolicy(max_attempts=1), failure_threshold=1)
+        breaker = _open_breaker(engine, "m")
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(10)
+
+        probe = asyncio.create_task(engine.run("m", slow))
+        await started.wait()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        assert breaker.state == "half_open"
+        # The next call is the new probe instead of a CircuitOpenError
+        async def ok():
+            return "ok"
+        assert await engine.run("m", ok) == "ok"
+        assert breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_non_retryable_error_does_not_count_against_the_model():
+    async def scenario():
+        engine = RetryEngine(RetryPolicy(max_attempts=3), failure_threshold=1)
+
+        async def bad_request():
+            raise Upstream(is_retryable=False)
+
+        with pytest.raises(Upstream):
+            await engine.run("m", bad_request)
+        assert engine.breaker("m").state == "closed"
+        assert engine.retries == 0
+
+    asyncio.run(scenario())
+
+
+def test_retryable_errors_are_retried_until_success():
+    async def scenario():
+        engine = RetryEngine(RetryPolicy(max_attempts=3, base_delay=0.0), failure_threshold=5)
+        calls = []
+
+        async def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise Upstream(is_retryable=True)
+            return "ok"
+
+        assert await engine.run("m", flaky) == "ok"
+        assert engine.retries == 2
+        assert engine.breaker("m").consecutive_failures == 0
+
+    asyncio.run(scenario())
+
+
+def test_no_hedge_before_enough_latency_samples():
+    engine = RetryEngine(RetryPolicy())
+    assert engine.hedge_delay("m") is None
+    for _ in range(20):
+        engine.latency("m").record(1.0)
+    assert engine.hedge_delay("m") == 1.0
+    assert engine.hedge_delay("m", "stream_open") is None
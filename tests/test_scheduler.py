@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+from scheduler import Priority, SchedulerRejected, UpstreamScheduler
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def _serve_in_order(scheduler: UpstreamScheduler, waiters: list) -> list:
+    """Starts every (tenant, priority) waiter behind one busy slot, then lets them through one by one."""
+    holder = await scheduler.acquire("m", "holder")
+    order = []
+
+    async def wait(tenant, priority):
+        ticket = await scheduler.acquire("m", tenant, priority)
+        order.append((tenant, priority))
+        ticket.release()
+
+    tasks = []
+    for tenant, priority in waiters:
+        tasks.append(asyncio.create_task(wait(tenant, priority)))
+        await _settle()
+    holder.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_higher_priority_is_served_first():
+    async def scenario():
+        scheduler = UpstreamScheduler(default_concurrency=1)
+        order = await _serve_in_order(scheduler, [
+            ("a", Priority.batch), ("b", Priority.standard), ("c", Priority.interactive),
+        ])
+        assert [priority for _, priority in order] == [Priority.interactive, Priority.standard, Priority.batch]
+
+    asyncio.run(scenario())
+
+
+def test_tenants_are_interleaved_within_a_priority():
+    async def scenario():
+        scheduler = UpstreamScheduler(default_concurrency=1)
+        waiters = [("busy", Priority.standard)] * 4 + [("quiet", Priority.standard)]
+        order = await _serve_in_order(scheduler, waiters)
+        # The quiet tenant's single request doesn't wait behind the busy tenant's backlog
+        assert [tenant for tenant, _ in order].index("quiet") <= 1
+
+    asyncio.run(scenario())
+
+
+def test_tenant_over_its_queue_share_gets_429():
+    async def scenario():
+        scheduler = UpstreamScheduler(default_concurrency=1, max_queue_per_tenant=1)
+        holder = await scheduler.acquire("m", "holder")
+        waiter = asyncio.create_task(scheduler.acquire("m", "t"))
+        await _settle()
+
+        with pytest.raises(SchedulerRejected) as rejected:
+            await scheduler.acquire("m", "t")
+        assert rejected.value.status_code == 429
+
+        holder.release()
+        (await waiter).release()
+
+    asyncio.run(scenario())
+
+
+def test_wait_past_max_wait_is_shed_with_503():
+    async def scenario():
+        scheduler = UpstreamScheduler(default_concurrency=1, max_wait={"standard": 0.01})
+        holder = await scheduler.acquire("m", "holder")
+        with pytest.raises(SchedulerRejected) as rejected:
+            await scheduler.acquire("m", "t")
+        assert rejected.value.status_code == 503
+        assert scheduler.snapshot()["m"]["queued"]["standard"] == 0
+        holder.release()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def scenario():
+        scheduler = UpstreamScheduler(default_concurrency=1)
+        holder = await scheduler.acquire("m", "holder")
+        leaving = asyncio.create_task(scheduler.acquire("m", "a"))
+        staying = asyncio.create_task(scheduler.acquire("m", "b"))
+        await _settle()
+
+        leaving.cancel()
+        await _settle()
+        holder.release()
+        ticket = await asyncio.wait_for(staying, 1)
+
+        snapshot = scheduler.snapshot()["m"]
+        assert snapshot["active"] == 1
+        assert snapshot["queued_by_tenant"] == {}
+        ticket.release()
+        assert scheduler.snapshot()["m"]["active"] == 0
+
+    asyncio.run(scenario())
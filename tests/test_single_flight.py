@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from single_flight import SingleFlight, SlowSubscriberError, StreamFanout
+
+
+def test_single_flight_shares_one_call():
+    async def scenario():
+        flight = SingleFlight()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "value"
+
+        results = await asyncio.gather(*(flight.do("k", fn) for _ in range(5)))
+        assert results == ["value"] * 5
+        assert len(calls) == 1
+        assert flight.stats()["followers"] == 4
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscriber_is_dropped_without_stalling_the_others():
+    async def scenario():
+        fanout = StreamFanout(max_queue_size=2)
+        release = asyncio.Event()
+
+        async def upstream():
+            await release.wait()
+            for i in range(10):
+                yield str(i)
+                await asyncio.sleep(0)
+
+        async def opener():
+            return upstream()
+
+        fast = await fanout.subscribe("k", opener)
+        slow = await fanout.subscribe("k", opener)
+        release.set()
+
+        received = [chunk async for chunk in fast]
+        assert received == [str(i) for i in range(10)]
+        assert fanout.dropped_subscribers == 1
+        with pytest.raises(SlowSubscriberError):
+            async for _chunk in slow:
+                pass
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
@@ -0,0 +1,44 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("google.genai")
+
+from routers.chat import _account, _consumer
+from stream_formatters import stream_formatter_json, stream_formatter_json_fast
+
+
+async def _chunks(usage: dict):
+    yield "a"
+    yield "b"
+    usage.update(total_tokens=3)
+
+
+async def _lines(formatter, usage):
+    return [json.loads(line) async for line in formatter(_chunks(usage if usage is not None else {}), usage=usage)]
+
+
+@pytest.mark.parametrize("formatter", [stream_formatter_json, stream_formatter_json_fast])
+def test_usage_line_only_when_requested(formatter):
+    assert asyncio.run(_lines(formatter, None)) == [{"text": "a"}, {"text": "b"}]
+    assert asyncio.run(_lines(formatter, {}))[-1] == {"type": "usage", "usage": {"total_tokens": 3}}
+
+
+def _request(headers: dict, host: str = "10.0.0.1"):
+    return SimpleNamespace(headers=headers, client=SimpleNamespace(host=host))
+
+
+def test_budgets_ignore_the_client_id_header():
+    first = _request({"x-api-key": "secret", "x-client-id": "one"})
+    second = _request({"x-api-key": "secret", "x-client-id": "two"})
+    assert _account(first) == _account(second)
+    assert "secret" not in _account(first)
+    assert _account(_request({})) == "10.0.0.1"
+
+
+def test_fair_queuing_uses_the_client_id_header():
+    assert _consumer(_request({"x-api-key": "secret", "x-client-id": "one"})) == "one"
+    assert _consumer(_request({"x-api-key": "secret"})) == _account(_request({"x-api-key": "secret"}))
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import usage
+from usage import BudgetExceeded, TokenBudgets, UsageMeter, empty_usage, usage_from_metadata, usage_headers
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(usage.time, "time", lambda: now.value)
+    return now
+
+
+def test_reservation_holds_the_budget_until_released(clock):
+    async def scenario():
+        budgets = TokenBudgets(default_limit=100, window=60)
+        held = await budgets.reserve("a", 80)
+        with pytest.raises(BudgetExceeded):
+            await budgets.reserve("a", 30)
+        assert budgets.rejected == 1
+
+        await budgets.release("a", held)
+        await budgets.spend("a", 50)
+        assert budgets.stats()["used"] == {"a": 50}
+        await budgets.reserve("a", 30)
+
+    asyncio.run(scenario())
+
+
+def test_clients_are_counted_apart_and_unlimited_without_a_limit(clock):
+    async def scenario():
+        budgets = TokenBudgets(default_limit=None, client_limits={"capped": 10}, window=60)
+        assert await budgets.reserve("free", 10_000) == 0
+        await budgets.reserve("capped", 10)
+        with pytest.raises(BudgetExceeded):
+            await budgets.reserve("capped", 1)
+        assert await budgets.reserve(None, 10_000) == 0
+
+    asyncio.run(scenario())
+
+
+def test_new_window_resets_usage_and_drops_old_clients(clock):
+    async def scenario():
+        budgets = TokenBudgets(default_limit=100, window=60)
+        for i in range(50):
+            await budgets.spend(f"client-{i}", 90)
+        assert len(budgets._used) == 50
+
+        clock.value += 60
+        await budgets.reserve("client-0", 90)
+        assert list(budgets._used) == ["client-0"]
+        assert budgets.stats()["used"] == {"client-0": 90}
+
+    asyncio.run(scenario())
+
+
+def test_rejection_reports_when_the_window_resets(clock):
+    async def scenario():
+        budgets = TokenBudgets(default_limit=10, window=60)
+        with pytest.raises(BudgetExceeded) as exceeded:
+            await budgets.reserve("a", 11)
+        assert exceeded.value.retry_after == pytest.approx(60 - 1000 % 60)
+
+    asyncio.run(scenario())
+
+
+def test_usage_from_metadata_fills_missing_counts():
+    metadata = SimpleNamespace(
+        prompt_token_count=10, candidates_token_count=5, thoughts_token_count=None,
+        cached_content_token_count=None, total_token_count=None
+    )
+    counted = usage_from_metadata(metadata)
+    assert counted["total_tokens"] == 15
+    assert counted["thinking_tokens"] == 0
+    assert usage_from_metadata(None) == empty_usage("upstream")
+
+
+def test_usage_headers():
+    headers = usage_headers({**empty_usage("cache"), "total_tokens": 3})
+    assert headers["X-Usage-Total-Tokens"] == "3"
+    assert headers["X-Usage-Source"] == "cache"
+    assert usage_headers({}) == {}
+
+
+def test_meter_totals_per_model_client_and_endpoint():
+    meter = UsageMeter()
+    meter.record_tokens("m", "a", "/complete", {"prompt_tokens": 2, "total_tokens": 5})
+    meter.record_tokens("m", None, "/complete", {"total_tokens": 1})
+    meter.record_request("m", "a", "/complete", 0.5)
+    assert meter.totals[("m", "a", "/complete")]["total_tokens"] == 5
+    assert meter.totals[("m", "a", "/complete")]["requests"] == 1
+    assert meter.totals[("m", usage.ANONYMOUS, "/complete")]["total_tokens"] == 1
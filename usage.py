@@ -0,0 +1,268 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking (Windows): one worker per usage log
+    fcntl = None
+
+from metrics import BUDGET_REJECTED, USAGE_TOKENS
+
+logger = logging.getLogger(__name__)
+
+ANONYMOUS = "anonymous"
+TOKEN_FIELDS = ("prompt_tokens", "output_tokens", "thinking_tokens", "cached_tokens", "total_tokens")
+
+
+class BudgetExceeded(Exception):
+    def __init__(self, client: str, used: float, limit: int, retry_after: float):
+        self.client = client
+        self.used = used
+        self.limit = limit
+        self.retry_after = retry_after
+        super().__init__(f"Client {client} used {used:.0f} of its {limit} token budget")
+
+
+# --- 1. Per-request usage ---
+
+def empty_usage(source: str) -> Dict[str, Any]:
+    """
+        Usage of a request that did not call upstream itself: "cache" (served from the
+        response/stream cache) or "shared" (joined an identical request already in flight).
+    """
+    usage: Dict[str, Any] = {field: 0 for field in TOKEN_FIELDS}
+    usage["source"] = source
+    return usage
+
+
+def usage_from_metadata(metadata: Any) -> Dict[str, Any]:
+    """Gemini's usage_metadata as our usage dict; missing counts are 0."""
+    usage = empty_usage("upstream")
+    if metadata is None:
+        return usage
+    usage["prompt_tokens"] = getattr(metadata, "prompt_token_count", None) or 0
+    usage["output_tokens"] = getattr(metadata, "candidates_token_count", None) or 0
+    usage["thinking_tokens"] = getattr(metadata, "thoughts_token_count", None) or 0
+    usage["cached_tokens"] = getattr(metadata, "cached_content_token_count", None) or 0
+    usage["total_tokens"] = getattr(metadata, "total_token_count", None) or (
+        usage["prompt_tokens"] + usage["output_tokens"] + usage["thinking_tokens"]
+    )
+    return usage
+
+
+def usage_headers(usage: Dict[str, Any]) -> Dict[str, str]:
+    if not usage:
+        return {}
+    headers = {f"X-Usage-{field.replace('_', '-').title()}": str(usage.get(field, 0)) for field in TOKEN_FIELDS}
+    headers["X-Usage-Source"] = usage.get("source", "upstream")
+    return headers
+
+
+# --- 2. Per-client token budgets ---
+
+class TokenBudgets:
+    """
+        Tokens per client per fixed window (aligned to the epoch, so all workers agree
+        on its boundaries). A request holds its prompt estimate while it runs, so that
+        concurrent requests can't all slip in under the same remaining budget; the
+        tokens Gemini reports are spent when the response is done, whoever is still waiting for it.
+    """
+
+    def __init__(self, default_limit: Optional[int] = None, client_limits: Optional[Dict[str, int]] = None, window: float = 86400.0):
+        self.default_limit = default_limit
+        self.client_limits = client_limits or {}
+        self.window = window
+        # client -> [window_start, used]
+        self._used: Dict[str, list] = {}
+        # Window of the last prune: entries older than it are dropped once per window
+        self._window: Optional[float] = None
+        self.rejected = 0
+
+    def limit_for(self, client: Optional[str]) -> Optional[int]:
+        if client is None:
+            return None
+        return self.client_limits.get(client, self.default_limit)
+
+    def window_start(self, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        return now - now % self.window
+
+    def _prune(self) -> float:
+        """Returns the current window start, first forgetting the clients of previous windows."""
+        start = self.window_start()
+        if start != self._window:
+            self._used = {client: entry for client, entry in self._used.items() if entry[0] >= start}
+            self._window = start
+        return start
+
+    async def _add(self, client: str, amount: float) -> float:
+        """Adds `amount` to the client's current window and returns the new total."""
+        start = self._prune()
+        entry = self._used.get(client)
+        if entry is None or entry[0] != start:
+            entry = self._used[client] = [start, 0.0]
+        entry[1] = max(0.0, entry[1] + amount)
+        return entry[1]
+
+    async def reserve(self, client: Optional[str], estimate: int) -> int:
+        """Holds `estimate` tokens or raises BudgetExceeded; returns the amount to release() afterwards."""
+        limit = self.limit_for(client)
+        if limit is None:
+            return 0
+
+        used = await self._add(client, estimate)
+        if used > limit:
+            await self._add(client, -estimate)
+            self.rejected += 1
+            BUDGET_REJECTED.labels().inc()
+            retry_after = self.window_start() + self.window - time.time()
+            raise BudgetExceeded(client, used - estimate, limit, retry_after)
+        return estimate
+
+    async def release(self, client: Optional[str], reserved: int) -> None:
+        if reserved:
+            await self._add(client, -reserved)
+
+    async def spend(self, client: Optional[str], tokens: int) -> None:
+        if tokens and self.limit_for(client) is not None:
+            await self._add(client, tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        start = self.window_start()
+        return {
+            "window_seconds": self.window,
+            "default_limit": self.default_limit,
+            "rejected": self.rejected,
+            "used": {client: round(used) for client, (window, used) in self._used.items() if window == start},
+        }
+
+
+# --- 3. Aggregation and the append-only log ---
+
+UsageKey = Tuple[str, str, str]
+
+
+def _new_counters() -> Dict[str, float]:
+    counters: Dict[str, float] = {field: 0 for field in TOKEN_FIELDS}
+    counters["requests"] = 0
+    counters["seconds"] = 0.0
+    return counters
+
+
+class UsageMeter:
+    """
+        Token usage per (model, client, endpoint), kept in memory and appended to a JSONL
+        file every `flush_interval` seconds: one line per key with the deltas since the
+        previous flush, so summing a key's lines gives its total.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = 30.0, top_clients: int = 20):
+        self.path = Path(path) if path else None
+        self.flush_interval = flush_interval
+        self.top_clients = top_clients
+        self.totals: Dict[UsageKey, Dict[str, float]] = {}
+        self._unflushed: Dict[UsageKey, Dict[str, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def _targets(self, key: UsageKey) -> list:
+        targets = [self.totals.setdefault(key, _new_counters())]
+        if self.path is not None:
+            targets.append(self._unflushed.setdefault(key, _new_counters()))
+        return targets
+
+    def record_request(self, model: str, client: Optional[str], endpoint: str, seconds: float) -> None:
+        """Every request, including those answered from the cache or by an identical one in flight."""
+        for counters in self._targets((model, client or ANONYMOUS, endpoint)):
+            counters["requests"] += 1
+            counters["seconds"] += seconds
+
+    def record_tokens(self, model: str, client: Optional[str], endpoint: str, usage: Dict[str, Any]) -> None:
+        """What an upstream call used, charged to the request that made it."""
+        for counters in self._targets((model, client or ANONYMOUS, endpoint)):
+            for field in TOKEN_FIELDS:
+                counters[field] += usage.get(field, 0)
+        USAGE_TOKENS.labels(model, endpoint, "prompt").inc(usage.get("prompt_tokens", 0))
+        USAGE_TOKENS.labels(model, endpoint, "output").inc(usage.get("output_tokens", 0) + usage.get("thinking_tokens", 0))
+
+    def start(self) -> None:
+        if self.path is not None and self._task is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.path is None or not self._unflushed:
+            return
+        batch, self._unflushed = self._unflushed, {}
+        now = round(time.time(), 3)
+        pid = os.getpid()
+        lines = [
+            json.dumps({"ts": now, "pid": pid, "model": m, "client": c, "endpoint": e, **counters}, ensure_ascii=False)
+            for (m, c, e), counters in batch.items()
+        ]
+        try:
+            await asyncio.to_thread(self._append, "\n".join(lines) + "\n")
+            self.flushes += 1
+        except OSError as e:
+            # Kept for the next flush rather than lost
+            self.flush_errors += 1
+            logger.error(f"Usage flush to {self.path} failed: {e}")
+            for key, counters in batch.items():
+                pending = self._unflushed.setdefault(key, _new_counters())
+                for name, value in counters.items():
+                    pending[name] += value
+
+    def _append(self, text: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            if fcntl is not None:
+                # Workers share the file; whole flushes must not interleave
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.write(text)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _rollup(self, index: int) -> Dict[str, Dict[str, float]]:
+        rollup: Dict[str, Dict[str, float]] = {}
+        for key, counters in self.totals.items():
+            target = rollup.setdefault(key[index], _new_counters())
+            for name, value in counters.items():
+                target[name] += value
+        return rollup
+
+    def stats(self) -> Dict[str, Any]:
+        by_client = sorted(self._rollup(1).items(), key=lambda item: item[1]["total_tokens"], reverse=True)
+        return {
+            "by_model": self._rollup(0),
+            "by_endpoint": self._rollup(2),
+            "top_clients": dict(by_client[:self.top_clients]),
+            "clients": len(by_client),
+            "log": str(self.path) if self.path else None,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+        }
+